@@ -0,0 +1,188 @@
+"""
+Backfills identity_match over a range of events_ shards of one GA4 property.
+
+The range is split into chunks of chunk_days shards and each chunk is one
+CALL update_identity_match(start_suffix, end_suffix, source_dataset), run on a
+bounded thread pool. Shards already in identity_match_run_state are skipped by the procedure
+and identity updates are commutative, so the chunks can finish in any order
+and the result is the same as running them one by one.
+
+Completed chunks are written to a progress file so an interrupted backfill
+resumes where it stopped. While the backfill runs it holds the property's
+update_identity_match lease, so its export triggers back off until it is done.
+
+    python -m bigquery.backfill_identity_match --project nzaa-mkt-guid \\
+        --dataset identity_resolution --source nzaa-datasets.analytics_291449711 \\
+        --start 20250101 --end 20250331
+"""
+import os
+import json
+import argparse
+import threading
+from concurrent import futures
+from datetime import datetime, timedelta
+from google.cloud import bigquery
+
+SUFFIX_FORMAT = '%Y%m%d'
+
+
+class LeaseUnavailable(Exception):
+    """Another update_identity_match run of the property holds the lease."""
+
+
+def split_chunks(start_suffix, end_suffix, chunk_days):
+    """Returns (start_suffix, end_suffix) pairs covering the range, chunk_days shards each."""
+    start = datetime.strptime(start_suffix, SUFFIX_FORMAT).date()
+    end = datetime.strptime(end_suffix, SUFFIX_FORMAT).date()
+    if end < start:
+        raise ValueError(f"end {end_suffix} is before start {start_suffix}")
+    if chunk_days < 1:
+        raise ValueError("chunk_days must be at least 1")
+
+    chunks = []
+    while start <= end:
+        chunk_end = min(start + timedelta(days=chunk_days - 1), end)
+        chunks.append((start.strftime(SUFFIX_FORMAT), chunk_end.strftime(SUFFIX_FORMAT)))
+        start = chunk_end + timedelta(days=1)
+    return chunks
+
+
+class BackfillProgress:
+    """Chunks completed so far, kept in a JSON file so a backfill can resume."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.completed = set()
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.completed = set(json.load(f)['completed'])
+
+    @staticmethod
+    def key(chunk):
+        return f"{chunk[0]}_{chunk[1]}"
+
+    def is_done(self, chunk):
+        return self.key(chunk) in self.completed
+
+    def mark_done(self, chunk):
+        with self.lock:
+            self.completed.add(self.key(chunk))
+            if not self.path:
+                return
+            # written to a temporary file first so an interrupted write never
+            # leaves a truncated progress file behind
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'completed': sorted(self.completed)}, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class Backfill:
+    def __init__(self, client, project_id, dataset_id, source, workers=4, lease_seconds=900,
+                 progress=None):
+        self.client = client
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.source = source
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.progress = progress or BackfillProgress()
+
+    def call(self, procedure, parameters, **kwargs):
+        """Runs a procedure in the dataset with STRING/INT64 parameters and returns its rows."""
+        placeholders = ', '.join(f"@{name}" for name, _, _ in parameters)
+        query = f"CALL `{self.project_id}.{self.dataset_id}.{procedure}`({placeholders})"
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter(name, type_, value) for name, type_, value in parameters
+        ])
+        return list(self.client.query(query, job_config=job_config, **kwargs).result())
+
+    def acquire_lease(self, holder):
+        """Takes or renews the lease for holder, returns False if another run holds it."""
+        rows = self.call('acquire_identity_match_lease', [
+            ('lease_name', 'STRING', f"update_identity_match:{self.source}"),
+            ('lease_holder', 'STRING', holder),
+            ('lease_seconds', 'INT64', self.lease_seconds)
+        ])
+        return bool(rows) and rows[0]['acquired']
+
+    def release_lease(self, holder):
+        self.call('release_identity_match_lease', [('lease_holder', 'STRING', holder)])
+
+    def run_chunk(self, chunk):
+        """Processes the shards of one chunk."""
+        start_suffix, end_suffix = chunk
+        # a transaction aborted by another chunk's commit is retried by the
+        # procedure itself, on the events it already extracted
+        self.call('update_identity_match', [
+            ('start_suffix', 'STRING', start_suffix),
+            ('end_suffix', 'STRING', end_suffix),
+            ('source_dataset', 'STRING', self.source)
+        ], job_id_prefix=f"backfill_{self.dataset_id}_{self.source.replace('.', '_')}_{start_suffix}_{end_suffix}_")
+
+        self.progress.mark_done(chunk)
+        print(f"Chunk {start_suffix}-{end_suffix} completed")
+        return chunk
+
+    def run(self, start_suffix, end_suffix, chunk_days=7):
+        """Runs every chunk of the range not already completed, returns the chunks run."""
+        chunks = [chunk for chunk in split_chunks(start_suffix, end_suffix, chunk_days)
+                  if not self.progress.is_done(chunk)]
+        if not chunks:
+            print("Nothing to backfill, all chunks are completed")
+            return []
+
+        holder = f"backfill_{self.dataset_id}_{self.source.replace('.', '_')}_{start_suffix}_{end_suffix}"
+        if not self.acquire_lease(holder):
+            raise LeaseUnavailable(f"update_identity_match is already running for {self.source}, try again later")
+
+        print(f"Backfilling {len(chunks)} chunks with {self.workers} workers")
+        try:
+            with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = {executor.submit(self.run_chunk, chunk) for chunk in chunks}
+                while pending:
+                    # renew well before the lease expires, from this thread only
+                    # so the workers do not contend on the lease row
+                    done, pending = futures.wait(pending, timeout=self.lease_seconds / 2,
+                                                 return_when=futures.FIRST_EXCEPTION)
+                    for future in done:
+                        if future.exception():
+                            for other in pending:
+                                other.cancel()
+                            raise future.exception()
+                    if pending and not self.acquire_lease(holder):
+                        raise LeaseUnavailable(f"Lease {holder} was lost during the backfill")
+        finally:
+            self.release_lease(holder)
+
+        return chunks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill identity_match over a range of events_ shards.")
+    parser.add_argument('--project', required=True, help="GCP project of the identity dataset")
+    parser.add_argument('--dataset', required=True, help="identity resolution dataset")
+    parser.add_argument('--source', required=True, help="GA4 export dataset, project.dataset")
+    parser.add_argument('--start', required=True, help="first shard suffix, YYYYMMDD")
+    parser.add_argument('--end', required=True, help="last shard suffix, YYYYMMDD")
+    parser.add_argument('--chunk-days', type=int, default=7, help="shards per procedure call")
+    parser.add_argument('--workers', type=int, default=4, help="chunks run at the same time")
+    parser.add_argument('--lease-seconds', type=int, default=900, help="lease renewal period")
+    parser.add_argument('--progress-file', help="JSON file of completed chunks, used to resume")
+    args = parser.parse_args(argv)
+
+    backfill = Backfill(
+        bigquery.Client(project=args.project),
+        args.project,
+        args.dataset,
+        args.source,
+        workers=args.workers,
+        lease_seconds=args.lease_seconds,
+        progress=BackfillProgress(args.progress_file)
+    )
+    backfill.run(args.start, args.end, args.chunk_days)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Reference implementation of the identity clustering in
+bigquery/procedures/update_identity_cluster.sql, for correctness tests.
+
+Emails, GA client IDs and alternate IDs are nodes keyed type:id, and each
+link in the history tables joins two of them. A cluster is a connected
+component and its cluster_id is the smallest node key in it, so the
+incremental result does not depend on the order links were added in.
+"""
+
+
+def node_key(node_type, node_id):
+    return f'{node_type}:{node_id}'
+
+
+def history_links(identity_history=(), alternate_history=()):
+    """Links (node, neighbour) from identity_match_history and alternate_identity_match_history rows."""
+    links = set()
+    for row in identity_history:
+        links.add((node_key('email', row['hashed_email']), node_key('ga_id', row['ga_id'])))
+    for row in alternate_history:
+        links.add((node_key('email', row['hashed_email']), node_key(row['alternate_id_type'], row['alternate_id'])))
+    return links
+
+
+class IdentityClusters:
+    """Union-find over node keys, the root of each set is its smallest key."""
+
+    def __init__(self, clusters=None):
+        # {node: parent}, seeded from existing {node: cluster_id} rows
+        self.parents = {}
+        for node, cluster_id in (clusters or {}).items():
+            self.parents.setdefault(cluster_id, cluster_id)
+            self.parents[node] = cluster_id
+
+    def find(self, node):
+        root = node
+        while self.parents.setdefault(root, root) != root:
+            root = self.parents[root]
+        # path compression
+        while self.parents[node] != root:
+            self.parents[node], node = root, self.parents[node]
+        return root
+
+    def union(self, node, neighbour):
+        root, other = sorted((self.find(node), self.find(neighbour)))
+        if root != other:
+            self.parents[other] = root
+
+    def add_links(self, links):
+        """Adds links, returns the {node: cluster_id} of the nodes that were added or moved."""
+        before = self.clusters()
+        for node, neighbour in links:
+            self.union(node, neighbour)
+        return {node: cluster_id for node, cluster_id in self.clusters().items() if before.get(node) != cluster_id}
+
+    def clusters(self):
+        """{node: cluster_id} of every node."""
+        return {node: self.find(node) for node in list(self.parents)}
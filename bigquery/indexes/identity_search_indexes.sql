@@ -0,0 +1,29 @@
+-- Search indexes for point lookups of the identity tables by hashed_email,
+-- ga_id or alternate id, so WHERE <key> = ... (or IN, or SEARCH()) reads the
+-- blocks holding the key rather than every block of the table. The ids are
+-- matched whole, without tokenizing, with NO_OP_ANALYZER.
+-- A table has one search index, so each is dropped and created again when
+-- its columns change. BigQuery builds them in the background and only for
+-- tables over 10 GB, smaller tables are scanned as before.
+
+DROP SEARCH INDEX IF EXISTS identity_match_lookup
+ON `${project_id}.${dataset_id}.identity_match`;
+
+CREATE SEARCH INDEX identity_match_lookup
+ON `${project_id}.${dataset_id}.identity_match`(hashed_email, ga_id)
+OPTIONS (analyzer = 'NO_OP_ANALYZER');
+
+DROP SEARCH INDEX IF EXISTS alternate_identity_match_lookup
+ON `${project_id}.${dataset_id}.alternate_identity_match`;
+
+CREATE SEARCH INDEX alternate_identity_match_lookup
+ON `${project_id}.${dataset_id}.alternate_identity_match`(hashed_email, current_alternate_id)
+OPTIONS (analyzer = 'NO_OP_ANALYZER');
+
+-- an alternate id that was replaced, e.g. a rotated fb_id, is only left in the history
+DROP SEARCH INDEX IF EXISTS alternate_identity_match_history_lookup
+ON `${project_id}.${dataset_id}.alternate_identity_match_history`;
+
+CREATE SEARCH INDEX alternate_identity_match_history_lookup
+ON `${project_id}.${dataset_id}.alternate_identity_match_history`(alternate_id)
+OPTIONS (analyzer = 'NO_OP_ANALYZER');
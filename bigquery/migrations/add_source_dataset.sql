@@ -0,0 +1,27 @@
+-- One-off migration to per-property run state, for deployments that ran
+-- update_identity_match before it took a source_dataset.
+--
+-- 1. Apply terraform, which adds the nullable source_dataset columns.
+-- 2. Run this script with ga4_project and ga4_dataset set to the property the
+--    existing run state was recorded for, before the function runs again.
+
+UPDATE `${project_id}.${dataset_id}.identity_match_run_state`
+SET source_dataset = '${ga4_project}.${ga4_dataset}'
+WHERE source_dataset IS NULL;
+
+UPDATE `${project_id}.${dataset_id}.identity_match_intraday_state`
+SET source_dataset = '${ga4_project}.${ga4_dataset}'
+WHERE source_dataset IS NULL;
+
+-- exports record their shards as source_dataset/shard_suffix
+UPDATE `${project_id}.${dataset_id}.identity_graph_manifest`
+SET shard_suffixes = ARRAY(
+  SELECT IF(STRPOS(shard, '/') > 0, shard, CONCAT('${ga4_project}.${ga4_dataset}', '/', shard))
+  FROM UNNEST(shard_suffixes) shard
+)
+WHERE TRUE;
+
+-- the lease of the previous single-flight run is dropped, leases are now
+-- named update_identity_match:<source_dataset>
+DELETE FROM `${project_id}.${dataset_id}.identity_match_lease`
+WHERE lease_name = 'update_identity_match';
@@ -0,0 +1,73 @@
+-- One-off migration from the array columns (updated_date, alternate_id) to
+-- the compact identity tables and their append-only history tables.
+--
+-- 1. Before applying terraform, copy the existing tables aside:
+--      CREATE TABLE `${project_id}.${dataset_id}.identity_match_legacy`
+--        COPY `${project_id}.${dataset_id}.identity_match`;
+--      CREATE TABLE `${project_id}.${dataset_id}.alternate_identity_match_legacy`
+--        COPY `${project_id}.${dataset_id}.alternate_identity_match`;
+-- 2. Apply terraform, which recreates the identity tables with the new schema.
+-- 3. Run this script, then drop the *_legacy tables.
+
+INSERT INTO `${project_id}.${dataset_id}.identity_match_history`(
+  hashed_email,
+  ga_id,
+  seen_date,
+  recorded_at
+)
+SELECT DISTINCT hashed_email, ga_id, DATE(updated) AS seen_date, CURRENT_TIMESTAMP()
+FROM `${project_id}.${dataset_id}.identity_match_legacy`,
+  UNNEST(updated_date) updated;
+
+INSERT INTO `${project_id}.${dataset_id}.identity_match`(
+  id,
+  hashed_email,
+  ga_id,
+  created_date,
+  first_seen,
+  last_seen,
+  seen_count
+)
+SELECT
+  id,
+  hashed_email,
+  ga_id,
+  created_date,
+  MIN(DATE(updated)),
+  MAX(DATE(updated)),
+  COUNT(DISTINCT DATE(updated))
+FROM `${project_id}.${dataset_id}.identity_match_legacy`,
+  UNNEST(updated_date) updated
+GROUP BY id, hashed_email, ga_id, created_date;
+
+-- alternate_id and updated_date were appended together, so they pair up by offset
+INSERT INTO `${project_id}.${dataset_id}.alternate_identity_match_history`(
+  hashed_email,
+  alternate_id_type,
+  alternate_id,
+  seen_date,
+  recorded_at
+)
+SELECT DISTINCT hashed_email, alternate_id_type, alternate_value, DATE(updated) AS seen_date, CURRENT_TIMESTAMP()
+FROM `${project_id}.${dataset_id}.alternate_identity_match_legacy`,
+  UNNEST(alternate_id) alternate_value WITH OFFSET alternate_offset
+JOIN UNNEST(updated_date) updated WITH OFFSET updated_offset
+ON alternate_offset = updated_offset;
+
+INSERT INTO `${project_id}.${dataset_id}.alternate_identity_match`(
+  hashed_email,
+  alternate_id_type,
+  current_alternate_id,
+  first_seen,
+  last_seen,
+  seen_count
+)
+SELECT
+  hashed_email,
+  alternate_id_type,
+  ARRAY_AGG(alternate_id ORDER BY seen_date DESC, alternate_id DESC LIMIT 1)[OFFSET(0)],
+  MIN(seen_date),
+  MAX(seen_date),
+  COUNT(*)
+FROM `${project_id}.${dataset_id}.alternate_identity_match_history`
+GROUP BY hashed_email, alternate_id_type;
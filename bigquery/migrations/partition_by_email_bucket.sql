@@ -0,0 +1,51 @@
+-- One-off migration of identity_match and alternate_identity_match from
+-- first_seen partitions to email_bucket partitions. Changing the
+-- partitioning recreates the tables, so their rows are copied aside first.
+--
+-- 1. Before applying terraform, copy the existing tables aside:
+--      CREATE TABLE `${project_id}.${dataset_id}.identity_match_legacy`
+--        COPY `${project_id}.${dataset_id}.identity_match`;
+--      CREATE TABLE `${project_id}.${dataset_id}.alternate_identity_match_legacy`
+--        COPY `${project_id}.${dataset_id}.alternate_identity_match`;
+-- 2. Apply terraform, which recreates both tables with the email_bucket column.
+-- 3. Run this script before the function runs again, then drop the *_legacy tables.
+
+INSERT INTO `${project_id}.${dataset_id}.identity_match`(
+  id,
+  hashed_email,
+  email_bucket,
+  ga_id,
+  created_date,
+  first_seen,
+  last_seen,
+  seen_count
+)
+SELECT
+  id,
+  hashed_email,
+  IFNULL(SAFE_CAST(CONCAT('0x', SUBSTR(hashed_email, 1, 3)) AS INT64), 0),
+  ga_id,
+  created_date,
+  first_seen,
+  last_seen,
+  seen_count
+FROM `${project_id}.${dataset_id}.identity_match_legacy`;
+
+INSERT INTO `${project_id}.${dataset_id}.alternate_identity_match`(
+  hashed_email,
+  email_bucket,
+  alternate_id_type,
+  current_alternate_id,
+  first_seen,
+  last_seen,
+  seen_count
+)
+SELECT
+  hashed_email,
+  IFNULL(SAFE_CAST(CONCAT('0x', SUBSTR(hashed_email, 1, 3)) AS INT64), 0),
+  alternate_id_type,
+  current_alternate_id,
+  first_seen,
+  last_seen,
+  seen_count
+FROM `${project_id}.${dataset_id}.alternate_identity_match_legacy`;
@@ -0,0 +1,18 @@
+CREATE OR REPLACE PROCEDURE `${project_id}.${dataset_id}.acquire_identity_match_lease`(name STRING, lease_holder STRING, lease_seconds INT64)
+BEGIN
+  -- Takes (or renews) the single-flight lease name for lease_holder,
+  -- e.g. update_identity_match:<source_dataset> for the runs of one GA4
+  -- property. The lease is only taken over once it has expired.
+  MERGE `${project_id}.${dataset_id}.identity_match_lease` lease
+  USING (SELECT name AS lease_name) request
+  ON lease.lease_name = request.lease_name
+  WHEN MATCHED AND (lease.expires_at < CURRENT_TIMESTAMP() OR lease.holder = lease_holder) THEN
+    UPDATE SET
+      holder = lease_holder,
+      expires_at = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL lease_seconds SECOND)
+  WHEN NOT MATCHED THEN
+    INSERT (lease_name, holder, expires_at)
+    VALUES (request.lease_name, lease_holder, TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL lease_seconds SECOND));
+
+  SELECT @@row_count = 1 AS acquired;
+END;
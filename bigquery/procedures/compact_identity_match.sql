@@ -0,0 +1,223 @@
+CREATE OR REPLACE PROCEDURE `${project_id}.${dataset_id}.compact_identity_match`(ttl_days INT64)
+BEGIN
+  -- Moves links not seen within ttl_days out of identity_match and
+  -- alternate_identity_match into their _archive tables, so the MERGEs of
+  -- update_identity_match only join live links. Links are only inserted
+  -- again from new history rows, so an archived link comes back when it is
+  -- seen again, as a new link from that day. The history tables are kept as
+  -- they are: they are only read for the processed days.
+  -- The clusters of the archived links are recomputed from the links that
+  -- remain, so archived links no longer join identities.
+  -- The archive keeps one row per link: a link archived again after it came
+  -- back is merged into its archive row, which spans all its sightings.
+  -- The rows and logical bytes (as billed by queries) removed from the hot
+  -- tables are logged to identity_match_run_log.
+  DECLARE cutoff DATE DEFAULT DATE_SUB(CURRENT_DATE(), INTERVAL ttl_days DAY);
+  DECLARE stage_started TIMESTAMP;
+  DECLARE exported_rows INT64;
+  DECLARE split_clusters ARRAY<STRING>;
+  DECLARE relabelled INT64;
+  DECLARE write_attempts INT64 DEFAULT 0;
+  DECLARE committed BOOL DEFAULT FALSE;
+  DECLARE run_log ARRAY<STRUCT<stage STRING, rows_affected INT64, bytes_reclaimed INT64, started_at TIMESTAMP, ended_at TIMESTAMP>> DEFAULT [];
+
+  IF ttl_days IS NULL OR ttl_days < 1 THEN
+    RAISE USING MESSAGE = "ttl_days must be at least 1";
+  END IF;
+
+  -- single-flight, a compaction still running is not started again
+  CALL `${project_id}.${dataset_id}.acquire_identity_match_lease`('compact_identity_match', @@script.job_id, ${lease_seconds});
+  IF NOT EXISTS (
+    SELECT 1 FROM `${project_id}.${dataset_id}.identity_match_lease` WHERE holder = @@script.job_id
+  ) THEN
+    RAISE USING MESSAGE = "compact_identity_match is already running";
+  END IF;
+
+  -- retried when an update_identity_match run commits to the hot tables first
+  WHILE NOT committed DO
+    SET write_attempts = write_attempts + 1;
+    SET run_log = [];
+    BEGIN
+      BEGIN TRANSACTION;
+
+      SET stage_started = CURRENT_TIMESTAMP();
+      MERGE `${project_id}.${dataset_id}.identity_match_archive` identity_match_archive
+      USING (
+        SELECT id, hashed_email, ga_id, created_date, first_seen, last_seen, seen_count
+        FROM `${project_id}.${dataset_id}.identity_match`
+        WHERE first_seen < cutoff AND last_seen < cutoff
+      ) stale
+      ON stale.hashed_email = identity_match_archive.hashed_email
+        AND stale.ga_id = identity_match_archive.ga_id
+      WHEN MATCHED THEN
+        UPDATE SET
+          first_seen = LEAST(identity_match_archive.first_seen, stale.first_seen),
+          last_seen = GREATEST(identity_match_archive.last_seen, stale.last_seen),
+          seen_count = identity_match_archive.seen_count + stale.seen_count,
+          archived_at = CURRENT_TIMESTAMP()
+      WHEN NOT MATCHED THEN
+        INSERT (
+          id,
+          hashed_email,
+          ga_id,
+          created_date,
+          first_seen,
+          last_seen,
+          seen_count,
+          archived_at
+        )
+        VALUES (
+          stale.id,
+          stale.hashed_email,
+          stale.ga_id,
+          stale.created_date,
+          stale.first_seen,
+          stale.last_seen,
+          stale.seen_count,
+          CURRENT_TIMESTAMP()
+        );
+
+      -- STRING is 2 bytes plus its length, DATETIME, DATE and INT64 are 8 bytes
+      SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+        'archive_identity_match' AS stage, @@row_count AS rows_affected,
+        (
+          SELECT IFNULL(SUM(6 + BYTE_LENGTH(id) + BYTE_LENGTH(hashed_email) + BYTE_LENGTH(ga_id) + 40), 0)
+          FROM `${project_id}.${dataset_id}.identity_match`
+          WHERE first_seen < cutoff AND last_seen < cutoff
+        ) AS bytes_reclaimed,
+        stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+      )]);
+
+      SET stage_started = CURRENT_TIMESTAMP();
+      -- the current alternate ID is the hot row's, it was seen after the archived one
+      MERGE `${project_id}.${dataset_id}.alternate_identity_match_archive` alternate_identity_match_archive
+      USING (
+        SELECT hashed_email, alternate_id_type, current_alternate_id, first_seen, last_seen, seen_count
+        FROM `${project_id}.${dataset_id}.alternate_identity_match`
+        WHERE first_seen < cutoff AND last_seen < cutoff
+      ) stale
+      ON stale.hashed_email = alternate_identity_match_archive.hashed_email
+        AND stale.alternate_id_type = alternate_identity_match_archive.alternate_id_type
+      WHEN MATCHED THEN
+        UPDATE SET
+          current_alternate_id = stale.current_alternate_id,
+          first_seen = LEAST(alternate_identity_match_archive.first_seen, stale.first_seen),
+          last_seen = GREATEST(alternate_identity_match_archive.last_seen, stale.last_seen),
+          seen_count = alternate_identity_match_archive.seen_count + stale.seen_count,
+          archived_at = CURRENT_TIMESTAMP()
+      WHEN NOT MATCHED THEN
+        INSERT (
+          hashed_email,
+          alternate_id_type,
+          current_alternate_id,
+          first_seen,
+          last_seen,
+          seen_count,
+          archived_at
+        )
+        VALUES (
+          stale.hashed_email,
+          stale.alternate_id_type,
+          stale.current_alternate_id,
+          stale.first_seen,
+          stale.last_seen,
+          stale.seen_count,
+          CURRENT_TIMESTAMP()
+        );
+
+      SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+        'archive_alternate_identity_match' AS stage, @@row_count AS rows_affected,
+        (
+          SELECT IFNULL(SUM(6 + BYTE_LENGTH(hashed_email) + BYTE_LENGTH(alternate_id_type) + BYTE_LENGTH(current_alternate_id) + 32), 0)
+          FROM `${project_id}.${dataset_id}.alternate_identity_match`
+          WHERE first_seen < cutoff AND last_seen < cutoff
+        ) AS bytes_reclaimed,
+        stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+      )]);
+
+      -- every node of a link is in the cluster of its email
+      SET split_clusters = (
+        SELECT IFNULL(ARRAY_AGG(DISTINCT cluster_id), [])
+        FROM `${project_id}.${dataset_id}.identity_cluster`
+        WHERE node_type = 'email'
+          AND node_id IN (
+            SELECT hashed_email FROM `${project_id}.${dataset_id}.identity_match`
+            WHERE first_seen < cutoff AND last_seen < cutoff
+            UNION DISTINCT
+            SELECT hashed_email FROM `${project_id}.${dataset_id}.alternate_identity_match`
+            WHERE first_seen < cutoff AND last_seen < cutoff
+          )
+      );
+
+      -- the hot tables are partitioned by email_bucket, so the partitions of
+      -- the stale links' emails are rewritten
+      SET stage_started = CURRENT_TIMESTAMP();
+      DELETE FROM `${project_id}.${dataset_id}.identity_match`
+      WHERE first_seen < cutoff AND last_seen < cutoff;
+
+      SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+        'delete_identity_match' AS stage, @@row_count AS rows_affected, CAST(NULL AS INT64) AS bytes_reclaimed,
+        stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+      )]);
+
+      SET stage_started = CURRENT_TIMESTAMP();
+      DELETE FROM `${project_id}.${dataset_id}.alternate_identity_match`
+      WHERE first_seen < cutoff AND last_seen < cutoff;
+
+      SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+        'delete_alternate_identity_match' AS stage, @@row_count AS rows_affected, CAST(NULL AS INT64) AS bytes_reclaimed,
+        stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+      )]);
+
+      SET stage_started = CURRENT_TIMESTAMP();
+      CALL `${project_id}.${dataset_id}.split_identity_cluster`(split_clusters, relabelled);
+
+      SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+        'split_identity_cluster' AS stage, relabelled AS rows_affected, CAST(NULL AS INT64) AS bytes_reclaimed,
+        stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+      )]);
+
+      COMMIT TRANSACTION;
+      SET committed = TRUE;
+    EXCEPTION WHEN ERROR THEN
+      ROLLBACK TRANSACTION;
+      IF write_attempts >= 5 OR STRPOS(@@error.message, 'concurrent update') = 0 THEN
+        RAISE USING MESSAGE = @@error.message;
+      END IF;
+    END;
+  END WHILE;
+
+  -- Deltas are upserts, so consumers only drop archived links with a new
+  -- snapshot. It runs after the commit, as EXPORT DATA cannot be part of a
+  -- transaction.
+  SET stage_started = CURRENT_TIMESTAMP();
+  IF (SELECT SUM(rows_affected) FROM UNNEST(run_log) WHERE STARTS_WITH(stage, 'delete_')) > 0 THEN
+    CALL `${project_id}.${dataset_id}.export_identity_graph`(@@script.job_id, TRUE, exported_rows);
+    SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+      'export_identity_graph' AS stage, exported_rows AS rows_affected, CAST(NULL AS INT64) AS bytes_reclaimed,
+      stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+    )]);
+  END IF;
+
+  INSERT INTO `${project_id}.${dataset_id}.identity_match_run_log`(
+    run_id,
+    stage,
+    rows_affected,
+    bytes_reclaimed,
+    started_at,
+    ended_at
+  )
+  SELECT @@script.job_id, stage, rows_affected, bytes_reclaimed, started_at, ended_at
+  FROM UNNEST(run_log);
+
+  CALL `${project_id}.${dataset_id}.release_identity_match_lease`(@@script.job_id);
+
+  SELECT
+    FORMAT("Compaction completed: links not seen since %s archived", CAST(cutoff AS STRING)) AS status,
+    (SELECT SUM(rows_affected) FROM UNNEST(run_log) WHERE STARTS_WITH(stage, 'delete_')) AS rows_reclaimed,
+    (SELECT SUM(bytes_reclaimed) FROM UNNEST(run_log)) AS bytes_reclaimed;
+
+EXCEPTION WHEN ERROR THEN
+  CALL `${project_id}.${dataset_id}.release_identity_match_lease`(@@script.job_id);
+  RAISE USING MESSAGE = @@error.message;
+END;
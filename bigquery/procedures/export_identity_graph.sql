@@ -0,0 +1,186 @@
+CREATE OR REPLACE PROCEDURE `${project_id}.${dataset_id}.export_identity_graph`(run_id STRING, force_snapshot BOOL, OUT exported_rows INT64)
+BEGIN
+  -- Exports the identity graph as Parquet under ${export_uri} for downstream
+  -- syncs, so consumers read the changes instead of the whole tables:
+  --   snapshot/<run_id>/<table>/*.parquet  every row of identity_match,
+  --                                        alternate_identity_match and identity_cluster
+  --   delta/<run_id>/<table>/*.parquet     the links of the shards processed since the
+  --                                        last export, and the nodes of their clusters
+  --   manifest/*.json                      the latest snapshot and the deltas to apply
+  --                                        on top of it (upserted by key), in order
+  -- Each export is recorded in identity_graph_manifest with the run-state
+  -- shards it covers, as source_dataset/shard_suffix. A shard is committed with its links, so the next
+  -- export picks up every shard not covered yet, also after a failed export.
+  -- A snapshot replaces the deltas when none exists, when the latest is
+  -- older than ${snapshot_days} days or when force_snapshot is set.
+  DECLARE base_snapshot_id STRING;
+  DECLARE base_snapshot_at TIMESTAMP;
+  DECLARE export_kind STRING;
+  DECLARE export_path STRING;
+  DECLARE shards ARRAY<STRING>;
+  DECLARE start_date DATE;
+  DECLARE end_date DATE;
+  DECLARE identity_match_source STRING DEFAULT 'export_identity_match';
+  DECLARE alternate_identity_match_source STRING DEFAULT 'export_alternate_identity_match';
+  DECLARE identity_cluster_source STRING DEFAULT 'export_identity_cluster';
+  DECLARE identity_match_rows INT64;
+  DECLARE alternate_identity_match_rows INT64;
+  DECLARE identity_cluster_rows INT64;
+
+  SET exported_rows = 0;
+
+  IF '${export_uri}' != '' THEN
+    SET (base_snapshot_id, base_snapshot_at) = (
+      SELECT AS STRUCT export_id, exported_at
+      FROM `${project_id}.${dataset_id}.identity_graph_manifest`
+      WHERE kind = 'snapshot'
+      ORDER BY exported_at DESC
+      LIMIT 1
+    );
+
+    -- shards are read before the tables, so a shard committed in between is
+    -- exported again by the next delta rather than missed
+    IF force_snapshot OR base_snapshot_id IS NULL
+        OR base_snapshot_at < TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL ${snapshot_days} DAY) THEN
+      SET export_kind = 'snapshot';
+      SET shards = (
+        SELECT IFNULL(ARRAY_AGG(shard ORDER BY shard), [])
+        FROM (
+          SELECT CONCAT(source_dataset, '/', shard_suffix) AS shard
+          FROM `${project_id}.${dataset_id}.identity_match_run_state`
+        )
+      );
+      SET identity_match_source = '`${project_id}.${dataset_id}.identity_match`';
+      SET alternate_identity_match_source = '`${project_id}.${dataset_id}.alternate_identity_match`';
+      SET identity_cluster_source = '`${project_id}.${dataset_id}.identity_cluster`';
+      SET (identity_match_rows, alternate_identity_match_rows, identity_cluster_rows) = (
+        (SELECT COUNT(*) FROM `${project_id}.${dataset_id}.identity_match`),
+        (SELECT COUNT(*) FROM `${project_id}.${dataset_id}.alternate_identity_match`),
+        (SELECT COUNT(*) FROM `${project_id}.${dataset_id}.identity_cluster`)
+      );
+    ELSE
+      SET shards = (
+        SELECT IFNULL(ARRAY_AGG(shard ORDER BY shard), [])
+        FROM (
+          SELECT CONCAT(source_dataset, '/', shard_suffix) AS shard
+          FROM `${project_id}.${dataset_id}.identity_match_run_state`
+        )
+        WHERE shard NOT IN (
+          SELECT exported
+          FROM `${project_id}.${dataset_id}.identity_graph_manifest`, UNNEST(shard_suffixes) exported
+        )
+      );
+
+      IF ARRAY_LENGTH(shards) > 0 THEN
+        SET export_kind = 'delta';
+        SET (start_date, end_date) = (
+          SELECT AS STRUCT MIN(PARSE_DATE("%Y%m%d", RIGHT(shard, 8))), MAX(PARSE_DATE("%Y%m%d", RIGHT(shard, 8)))
+          FROM UNNEST(shards) shard
+        );
+
+        -- links with a sighting on the shards' dates, of any property, read
+        -- from the history partitions of those dates
+        CREATE OR REPLACE TEMP TABLE export_identity_match AS
+        SELECT identity_match.*
+        FROM `${project_id}.${dataset_id}.identity_match` identity_match
+        JOIN (
+          SELECT DISTINCT hashed_email, ga_id
+          FROM `${project_id}.${dataset_id}.identity_match_history`
+          WHERE seen_date BETWEEN start_date AND end_date
+            AND FORMAT_DATE("%Y%m%d", seen_date) IN (SELECT RIGHT(shard, 8) FROM UNNEST(shards) shard)
+        ) changed
+        ON changed.hashed_email = identity_match.hashed_email
+          AND changed.ga_id = identity_match.ga_id;
+
+        CREATE OR REPLACE TEMP TABLE export_alternate_identity_match AS
+        SELECT alternate_identity_match.*
+        FROM `${project_id}.${dataset_id}.alternate_identity_match` alternate_identity_match
+        JOIN (
+          SELECT DISTINCT hashed_email, alternate_id_type
+          FROM `${project_id}.${dataset_id}.alternate_identity_match_history`
+          WHERE seen_date BETWEEN start_date AND end_date
+            AND FORMAT_DATE("%Y%m%d", seen_date) IN (SELECT RIGHT(shard, 8) FROM UNNEST(shards) shard)
+        ) changed
+        ON changed.hashed_email = alternate_identity_match.hashed_email
+          AND changed.alternate_id_type = alternate_identity_match.alternate_id_type;
+
+        -- Every link has an email, and clusters only merge through new
+        -- links, so the clusters of the changed emails hold every node that
+        -- was added or moved
+        CREATE OR REPLACE TEMP TABLE export_identity_cluster AS
+        SELECT *
+        FROM `${project_id}.${dataset_id}.identity_cluster`
+        WHERE cluster_id IN (
+          SELECT cluster_id
+          FROM `${project_id}.${dataset_id}.identity_cluster`
+          WHERE node_type = 'email'
+            AND node_id IN (
+              SELECT hashed_email FROM export_identity_match
+              UNION DISTINCT
+              SELECT hashed_email FROM export_alternate_identity_match
+            )
+        );
+
+        SET (identity_match_rows, alternate_identity_match_rows, identity_cluster_rows) = (
+          (SELECT COUNT(*) FROM export_identity_match),
+          (SELECT COUNT(*) FROM export_alternate_identity_match),
+          (SELECT COUNT(*) FROM export_identity_cluster)
+        );
+      END IF;
+    END IF;
+
+    IF export_kind IS NOT NULL THEN
+      SET export_path = FORMAT("%s/%s/%s", '${export_uri}', export_kind, run_id);
+
+      EXECUTE IMMEDIATE FORMAT("""
+        EXPORT DATA OPTIONS (uri = '%s/identity_match/*.parquet', format = 'PARQUET', overwrite = true)
+        AS SELECT * FROM %s
+      """, export_path, identity_match_source);
+      EXECUTE IMMEDIATE FORMAT("""
+        EXPORT DATA OPTIONS (uri = '%s/alternate_identity_match/*.parquet', format = 'PARQUET', overwrite = true)
+        AS SELECT * FROM %s
+      """, export_path, alternate_identity_match_source);
+      EXECUTE IMMEDIATE FORMAT("""
+        EXPORT DATA OPTIONS (uri = '%s/identity_cluster/*.parquet', format = 'PARQUET', overwrite = true)
+        AS SELECT * FROM %s
+      """, export_path, identity_cluster_source);
+
+      INSERT INTO `${project_id}.${dataset_id}.identity_graph_manifest`(
+        export_id,
+        kind,
+        base_snapshot_id,
+        uri,
+        shard_suffixes,
+        identity_match_rows,
+        alternate_identity_match_rows,
+        identity_cluster_rows,
+        exported_at
+      )
+      VALUES (
+        run_id,
+        export_kind,
+        IF(export_kind = 'delta', base_snapshot_id, NULL),
+        export_path,
+        shards,
+        identity_match_rows,
+        alternate_identity_match_rows,
+        identity_cluster_rows,
+        CURRENT_TIMESTAMP()
+      );
+
+      -- the manifest consumers read: the latest snapshot and its deltas
+      EXPORT DATA OPTIONS (uri = '${export_uri}/manifest/*.json', format = 'JSON', overwrite = true)
+      AS
+      SELECT export_id, kind, base_snapshot_id, uri, exported_at
+      FROM `${project_id}.${dataset_id}.identity_graph_manifest`
+      WHERE exported_at >= (
+        SELECT MAX(exported_at)
+        FROM `${project_id}.${dataset_id}.identity_graph_manifest`
+        WHERE kind = 'snapshot'
+      )
+      ORDER BY exported_at;
+
+      SET exported_rows = identity_match_rows + alternate_identity_match_rows + identity_cluster_rows;
+    END IF;
+  END IF;
+END;
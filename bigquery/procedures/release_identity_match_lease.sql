@@ -0,0 +1,5 @@
+CREATE OR REPLACE PROCEDURE `${project_id}.${dataset_id}.release_identity_match_lease`(lease_holder STRING)
+BEGIN
+  DELETE FROM `${project_id}.${dataset_id}.identity_match_lease`
+  WHERE holder = lease_holder;
+END;
@@ -0,0 +1,89 @@
+CREATE OR REPLACE PROCEDURE `${project_id}.${dataset_id}.split_identity_cluster`(cluster_ids ARRAY<STRING>, OUT relabelled INT64)
+BEGIN
+  -- Recomputes the clusters cluster_ids from the links left in
+  -- identity_match and alternate_identity_match, after compact_identity_match
+  -- archived some of their links. Every link has an email, and a cluster
+  -- holds every node linked to its emails, so its remaining links are the
+  -- live links of its emails. Nodes left without a live link are removed,
+  -- and a cluster that archived links held together splits into its
+  -- connected parts, each labelled with its smallest node key as in
+  -- update_identity_cluster.
+  -- An alternate id type that is live keeps every id seen for it, as
+  -- update_identity_cluster links them all from the history.
+  DECLARE changed INT64 DEFAULT 1;
+
+  CREATE OR REPLACE TEMP TABLE split_emails AS
+  SELECT node_id AS hashed_email
+  FROM `${project_id}.${dataset_id}.identity_cluster`
+  WHERE node_type = 'email'
+    AND cluster_id IN UNNEST(cluster_ids);
+
+  CREATE OR REPLACE TEMP TABLE split_links AS
+  SELECT CONCAT('email:', hashed_email) AS node, CONCAT('ga_id:', ga_id) AS neighbour
+  FROM `${project_id}.${dataset_id}.identity_match`
+  WHERE hashed_email IN (SELECT hashed_email FROM split_emails)
+  UNION DISTINCT
+  SELECT CONCAT('email:', history.hashed_email), CONCAT(history.alternate_id_type, ':', history.alternate_id)
+  FROM `${project_id}.${dataset_id}.alternate_identity_match_history` history
+  JOIN `${project_id}.${dataset_id}.alternate_identity_match` alternate_identity_match
+  ON alternate_identity_match.hashed_email = history.hashed_email
+    AND alternate_identity_match.alternate_id_type = history.alternate_id_type
+  WHERE history.hashed_email IN (SELECT hashed_email FROM split_emails);
+
+  CREATE OR REPLACE TEMP TABLE split_edges AS
+  SELECT node, neighbour FROM split_links
+  UNION DISTINCT
+  SELECT neighbour, node FROM split_links;
+
+  CREATE OR REPLACE TEMP TABLE split_labels AS
+  SELECT node, LEAST(node, MIN(neighbour)) AS label
+  FROM split_edges
+  GROUP BY node;
+
+  -- the label propagation of update_identity_cluster
+  WHILE changed > 0 DO
+    UPDATE split_labels
+    SET label = smallest.label
+    FROM (
+      SELECT split_edges.node, MIN(neighbour_labels.label) AS label
+      FROM split_edges
+      JOIN split_labels neighbour_labels
+      ON neighbour_labels.node = split_edges.neighbour
+      GROUP BY split_edges.node
+    ) smallest
+    WHERE smallest.node = split_labels.node
+      AND smallest.label < split_labels.label;
+    SET changed = @@row_count;
+
+    UPDATE split_labels
+    SET label = jump.label
+    FROM (
+      SELECT node, label FROM split_labels
+    ) jump
+    WHERE jump.node = split_labels.label
+      AND jump.label < split_labels.label;
+    SET changed = changed + @@row_count;
+  END WHILE;
+
+  DELETE FROM `${project_id}.${dataset_id}.identity_cluster`
+  WHERE cluster_id IN UNNEST(cluster_ids)
+    AND CONCAT(node_type, ':', node_id) NOT IN (SELECT node FROM split_labels);
+  SET relabelled = @@row_count;
+
+  MERGE `${project_id}.${dataset_id}.identity_cluster` identity_cluster
+  USING (
+    SELECT
+      SUBSTR(node, 1, STRPOS(node, ':') - 1) AS node_type,
+      SUBSTR(node, STRPOS(node, ':') + 1) AS node_id,
+      label AS cluster_id
+    FROM split_labels
+  ) result
+  ON result.node_type = identity_cluster.node_type
+    AND result.node_id = identity_cluster.node_id
+  WHEN MATCHED AND result.cluster_id != identity_cluster.cluster_id THEN
+    UPDATE SET
+      cluster_id = result.cluster_id,
+      updated_at = CURRENT_TIMESTAMP();
+
+  SET relabelled = relabelled + @@row_count;
+END;
@@ -1,39 +1,48 @@
+import shutil
+import tempfile
+from datetime import date, datetime, timezone
 from unittest import TestCase
 from test.bq_test_helper import BiqQueryTest
+from bigquery.identity_cluster import IdentityClusters, history_links
 from google.cloud import bigquery
 
 class TestUpdateIdentityMatch(TestCase):
-    def setUp(self):
-        # initialise the bq test class with the project and dataset id used for testing
-        self.test_helper = BiqQueryTest('nzaa-mkt-guid', 'test_identity_resolution')
+    @classmethod
+    def setUpClass(cls):
+        # initialise the bq test class with a dataset of its own, so test
+        # workers (pytest -n) and concurrent runs can run side by side. The
+        # tables and procedures are created once for the class, each test
+        # empties the tables with start_test.
+        cls.test_helper = BiqQueryTest('nzaa-mkt-guid', 'test_identity_resolution', isolated=True)
+        cls.addClassCleanup(cls.test_helper.delete_dataset)
         
         # Create a generic events table schema first
-        self.test_helper.create_table('', 'events', 
+        cls.test_helper.create_table('', 'events', 
                                     key="events_*", 
                                     path="bigquery/schemas", 
                                     use_root_path=True)
         
         # Create specific date tables using the events schema
-        events_schema = self.test_helper.tables['events']['table'].schema
+        events_schema = cls.test_helper.tables['events']['table'].schema
         
         # Create events_20250606 table
-        events_20250606_ref = f'{self.test_helper.project}.{self.test_helper.dataset}.events_20250606'
+        events_20250606_ref = f'{cls.test_helper.project}.{cls.test_helper.dataset}.events_20250606'
         table_20250606 = bigquery.Table(events_20250606_ref, events_schema)
-        self.test_helper.client.create_table(table_20250606)
+        cls.test_helper.client.create_table(table_20250606)
         
         # Create events_20250607 table
-        events_20250607_ref = f'{self.test_helper.project}.{self.test_helper.dataset}.events_20250607'
+        events_20250607_ref = f'{cls.test_helper.project}.{cls.test_helper.dataset}.events_20250607'
         table_20250607 = bigquery.Table(events_20250607_ref, events_schema)
-        self.test_helper.client.create_table(table_20250607)
+        cls.test_helper.client.create_table(table_20250607)
         
         # Add to tables dict for tracking
-        self.test_helper.tables['events_20250606'] = {
+        cls.test_helper.tables['events_20250606'] = {
             'table': table_20250606, 
             'key': 'events_20250606', 
             'table_name': 'events_20250606',
             'table_ref': events_20250606_ref
         }
-        self.test_helper.tables['events_20250607'] = {
+        cls.test_helper.tables['events_20250607'] = {
             'table': table_20250607,
             'key': 'events_20250607',
             'table_name': 'events_20250607', 
@@ -41,25 +50,79 @@ class TestUpdateIdentityMatch(TestCase):
         }
         
         # Create identity tables
-        self.test_helper.create_table('', 'identity_match', 
+        cls.test_helper.create_table('', 'identity_match', 
                                     path="bigquery/schemas", 
                                     use_root_path=True)
-        self.test_helper.create_table('', 'alternate_identity_match', 
+        cls.test_helper.create_table('', 'alternate_identity_match', 
                                     path="bigquery/schemas", 
                                     use_root_path=True)
+        cls.test_helper.create_table('', 'identity_match_history',
+                                    path="bigquery/schemas",
+                                    use_root_path=True)
+        cls.test_helper.create_table('', 'alternate_identity_match_history',
+                                    path="bigquery/schemas",
+                                    use_root_path=True)
+        cls.test_helper.create_table('', 'identity_match_run_state',
+                                    path="bigquery/schemas",
+                                    use_root_path=True)
+        cls.test_helper.create_table('', 'identity_match_lease',
+                                    path="bigquery/schemas",
+                                    use_root_path=True)
+        cls.test_helper.create_table('', 'identity_match_run_log',
+                                    path="bigquery/schemas",
+                                    use_root_path=True)
+        cls.test_helper.create_table('', 'identity_cluster',
+                                    path="bigquery/schemas",
+                                    use_root_path=True)
+        cls.test_helper.create_table('', 'identity_graph_manifest',
+                                    path="bigquery/schemas",
+                                    use_root_path=True)
+        cls.test_helper.create_table('', 'identity_match_intraday_state',
+                                    path="bigquery/schemas",
+                                    use_root_path=True)
+        cls.test_helper.create_table('', 'identity_match_archive',
+                                    path="bigquery/schemas",
+                                    use_root_path=True)
+        cls.test_helper.create_table('', 'alternate_identity_match_archive',
+                                    path="bigquery/schemas",
+                                    use_root_path=True)
+
+        # update_identity_match calls update_identity_cluster
+        create_cluster_procedure_sql = cls.test_helper.load_template(
+            '', 'bigquery/procedures/update_identity_cluster.sql', overrides={
+                'project_id': cls.test_helper.project,
+                'dataset_id': cls.test_helper.dataset
+            }, use_root_path=True)
+        cls.test_helper.client.query(create_cluster_procedure_sql).result()
+        # the export is switched off unless a test sets export_uri
+        cls.create_export_procedure('')
+        for procedure in ('acquire_identity_match_lease', 'release_identity_match_lease', 'split_identity_cluster',
+                          'compact_identity_match'):
+            cls.test_helper.client.query(cls.test_helper.load_template(
+                '', f'bigquery/procedures/{procedure}.sql', overrides={'lease_seconds': 900}, use_root_path=True
+            )).result()
         
         # Load the stored procedure template
-        create_procedure_sql = self.test_helper.load_template('', 'bigquery/procedures/update_identity_match.sql', 
+        create_procedure_sql = cls.test_helper.load_template('', 'bigquery/procedures/update_identity_match.sql', 
                                                      overrides={
-            'project_id': self.test_helper.project,
-            'dataset_id': self.test_helper.dataset,
-            'ga4_project': self.test_helper.project,
-            'ga4_dataset': self.test_helper.dataset
+            'project_id': cls.test_helper.project,
+            'dataset_id': cls.test_helper.dataset,
+            'ga4_project': cls.test_helper.project,
+            'ga4_dataset': cls.test_helper.dataset,
+            'intraday_lookback_seconds': 600
         }, use_root_path=True)
         
-        # CREATE the stored procedure (only once in setUp)
-        self.test_helper.client.query(create_procedure_sql).result()
+        # CREATE the stored procedure (only once for the class)
+        cls.test_helper.client.query(create_procedure_sql).result()
         
+    @classmethod
+    def create_export_procedure(cls, export_uri):
+        cls.test_helper.client.query(cls.test_helper.load_template(
+            '', 'bigquery/procedures/export_identity_graph.sql', overrides={
+                'export_uri': export_uri,
+                'snapshot_days': 7
+            }, use_root_path=True)).result()
+
     def test_new_identity_insertion(self):
         self.test_helper.start_test()
         
@@ -73,7 +136,7 @@ class TestUpdateIdentityMatch(TestCase):
         fb_id = first_record['event_params'][1]['value']['string_value'] if len(first_record['event_params']) > 1 else None
         
         # CALL the stored procedure (not CREATE it again)
-        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`()"
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
         self.test_helper.query([], call_procedure)
         
         # test identity match table
@@ -85,18 +148,18 @@ class TestUpdateIdentityMatch(TestCase):
         # test alternate identity match table
         alternate_identity_match = self.test_helper.get_dataframe('alternate_identity_match')
         self.assertGreater(alternate_identity_match.shape[0], 0)
+
+        # rows are partitioned by the first three hex digits of the email
+        for table in (identity_match, alternate_identity_match):
+            for _, row in table.iterrows():
+                self.assertEqual(row['email_bucket'], int(row['hashed_email'][:3], 16))
         
         if fb_id:
             self.assertTrue('fb_id' in alternate_identity_match['alternate_id_type'].values)
             
-            # Check for fb_id in alternate_id arrays
+            # Check for fb_id as the current alternate id
             fb_rows = alternate_identity_match[alternate_identity_match['alternate_id_type'] == 'fb_id']
-            fb_ids_found = False
-            for _, row in fb_rows.iterrows():
-                if fb_id in row['alternate_id']:
-                    fb_ids_found = True
-                    break
-            self.assertTrue(fb_ids_found)
+            self.assertTrue(fb_id in fb_rows['current_alternate_id'].values)
         
     def test_identity_update(self):
         self.test_helper.start_test()
@@ -113,7 +176,7 @@ class TestUpdateIdentityMatch(TestCase):
         check_date_query = f"""
         SELECT 
             IFNULL(
-                FORMAT_DATETIME("%Y%m%d", MAX(updated_date[OFFSET(ARRAY_LENGTH(updated_date) - 1)])),
+                FORMAT_DATE("%Y%m%d", MAX(last_seen)),
                 "20250603"
             ) as last_update_date
         FROM `{self.test_helper.project}.{self.test_helper.dataset}.identity_match`
@@ -136,7 +199,7 @@ class TestUpdateIdentityMatch(TestCase):
             print(f"  - Date: {event.event_date}, User: {event.user_pseudo_id}, Email: {event.email[:20] if event.email else 'None'}...")
         
         # CALL the stored procedure
-        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`()"
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
         self.test_helper.query([], call_procedure)
         
         # Check results
@@ -146,7 +209,7 @@ class TestUpdateIdentityMatch(TestCase):
         # Debug: Show what's in the identity_match table
         print("\nIdentity match contents:")
         for idx, row in identity_match.iterrows():
-            print(f"  Email: {row['hashed_email'][:20]}..., GA ID: {row['ga_id']}, Updated dates: {len(row['updated_date'])}")
+            print(f"  Email: {row['hashed_email'][:20]}..., GA ID: {row['ga_id']}, Seen count: {row['seen_count']}")
         
         # The test expectations
         self.assertGreaterEqual(identity_match.shape[0], len(existing_data))
@@ -154,7 +217,7 @@ class TestUpdateIdentityMatch(TestCase):
         # Check for updates
         records_with_updates = 0
         for _, row in identity_match.iterrows():
-            if len(row['updated_date']) > 1:
+            if row['seen_count'] > 1:
                 records_with_updates += 1
         
         self.assertGreater(records_with_updates, 0, "Some records should have been updated")
@@ -166,7 +229,7 @@ class TestUpdateIdentityMatch(TestCase):
         self.test_helper.initialise_table_from_fixture('events_20250606')
         
         # CALL the stored procedure
-        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`()"
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
         self.test_helper.query([], call_procedure)
         
         # Check for same email with multiple GA IDs
@@ -184,7 +247,7 @@ class TestUpdateIdentityMatch(TestCase):
         self.test_helper.initialise_table_from_fixture('events_20250606')
         
         # CALL the stored procedure twice to test duplicate prevention
-        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`()"
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
         self.test_helper.query([], call_procedure)
         
         # Load new events to trigger updates
@@ -195,19 +258,520 @@ class TestUpdateIdentityMatch(TestCase):
         
         # Check alternate_identity_match for duplicates
         alternate_identity_match = self.test_helper.get_dataframe('alternate_identity_match')
+        self.assertFalse(alternate_identity_match.duplicated(['hashed_email', 'alternate_id_type']).any())
+
+        # Each id is recorded once per day in the history
+        history = self.test_helper.get_dataframe('alternate_identity_match_history')
+        self.assertFalse(history.duplicated(['hashed_email', 'alternate_id_type', 'alternate_id', 'seen_date']).any(),
+                         "Duplicate daily sightings in alternate_identity_match_history")
         
-        # The MAX() logic in the procedure should prevent excessive duplicates
-        for _, row in alternate_identity_match.iterrows():
-            alternate_ids = row['alternate_id']
-            unique_ids = list(set(alternate_ids))
-            # Allow for one duplicate due to the update logic
-            self.assertLessEqual(len(alternate_ids), len(unique_ids) + 1, 
-                               f"Too many duplicates in alternate_id array for {row['alternate_id_type']}")
-        
-    def tearDown(self):
-        """Clean up test tables after each test"""
-        for table_name in self.test_helper.tables:
-            try:
-                self.test_helper.client.delete_table(self.test_helper.tables[table_name]['table_ref'])
-            except:
-                pass
\ No newline at end of file
+    def test_staged_extraction_results(self):
+        self.test_helper.start_test()
+
+        # existing links put the watermark at 20250605 so both event shards are processed
+        self.test_helper.initialise_table_from_fixture('identity_match')
+        self.test_helper.initialise_table_from_fixture('identity_match_history')
+        self.test_helper.initialise_table_from_fixture('alternate_identity_match')
+        self.test_helper.initialise_table_from_fixture('alternate_identity_match_history')
+        self.test_helper.initialise_table_from_fixture('events_20250606')
+        self.test_helper.initialise_table_from_fixture('events_20250607')
+
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
+        self.test_helper.query([], call_procedure)
+
+        email_a = 'a665a45920422f9d417e4867efdc4fb8a04a1f3fff1fa07e998e86f7f7a27ae3'
+        email_b = 'b493d48364afe44d11c0165cf470a4164d1e2609911ef998be868d46ade3de4e'
+        email_c = 'c6ba91b90d922ef159e69e70a15f7f367aea416f7a4befd396439fe24b3a5f5e'
+
+        identity_match = {
+            (row['hashed_email'], row['ga_id']): (row['first_seen'], row['last_seen'], row['seen_count'])
+            for row in self.test_helper.get_table_data('identity_match')
+        }
+        self.assertEqual(identity_match, {
+            (email_a, '1234567890.0987654321'): (date(2025, 6, 5), date(2025, 6, 7), 3),
+            (email_b, '2222222222.1111111111'): (date(2025, 6, 5), date(2025, 6, 6), 2),
+            (email_a, '3333333333.2222222222'): (date(2025, 6, 6), date(2025, 6, 6), 1),
+            (email_c, '4444444444.3333333333'): (date(2025, 6, 7), date(2025, 6, 7), 1),
+        })
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match_history')), 7)
+
+        # fb_id and tiktok_id sightings on 20250606 were already in the history
+        alternate_identity_match = {
+            (row['hashed_email'], row['alternate_id_type']):
+                (row['current_alternate_id'], row['first_seen'], row['last_seen'], row['seen_count'])
+            for row in self.test_helper.get_table_data('alternate_identity_match')
+        }
+        self.assertEqual(alternate_identity_match, {
+            (email_a, 'fb_id'): ('FB_1234567890', date(2025, 6, 6), date(2025, 6, 6), 1),
+            (email_a, 'tiktok_id'): ('TT_ABCDEF123456', date(2025, 6, 6), date(2025, 6, 6), 1),
+            (email_a, 'reddit_id'): ('RD_TEST_USER_123', date(2025, 6, 6), date(2025, 6, 6), 1),
+            (email_a, 'gads_id'): ('GA_9876543210', date(2025, 6, 7), date(2025, 6, 7), 1),
+            (email_c, 'rws_id'): ('RWS_USER_456', date(2025, 6, 7), date(2025, 6, 7), 1),
+        })
+        self.assertEqual(len(self.test_helper.get_table_data('alternate_identity_match_history')), 5)
+
+    def test_one_alternate_row_per_email_and_type(self):
+        self.test_helper.start_test()
+
+        # a new email seen with two different fb_ids in the same shard
+        def fb_event(fb_id):
+            return {
+                'event_date': '20250607',
+                'event_timestamp': 1749312200000000,
+                'event_name': 'form_submit',
+                'user_pseudo_id': '5555555555.4444444444',
+                'event_params': [
+                    {'key': key, 'value': {
+                        'string_value': value,
+                        'int_value': '_NULL_',
+                        'float_value': '_CAST(NULL AS FLOAT64)_',
+                        'double_value': '_CAST(NULL AS FLOAT64)_',
+                        'set_timestamp_micros': 1749312200000000
+                    }}
+                    for key, value in [('guid_email', 'new_user_hash'), ('guid_fb_id', fb_id)]
+                ],
+                'user_properties': []
+            }
+
+        self.test_helper.initialise_table_from_fixture('identity_match')
+        self.test_helper.initialise_table_from_fixture(
+            'events_20250607', add=[fb_event('FB_AAA'), fb_event('FB_BBB')]
+        )
+
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
+        self.test_helper.query([], call_procedure)
+
+        rows = [
+            row for row in self.test_helper.get_table_data('alternate_identity_match')
+            if row['hashed_email'] == 'new_user_hash'
+        ]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['current_alternate_id'], 'FB_BBB')
+        self.assertEqual(rows[0]['seen_count'], 2)
+
+    def test_single_shard_processing(self):
+        self.test_helper.start_test()
+
+        self.test_helper.initialise_table_from_fixture('identity_match')
+        self.test_helper.initialise_table_from_fixture('events_20250606')
+        self.test_helper.initialise_table_from_fixture('events_20250607')
+
+        # only the named shard is read, events_20250607 is left for its own run
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`('20250606', '20250606', NULL)"
+        self.test_helper.query([], call_procedure)
+
+        identity_match = self.test_helper.get_table_data('identity_match')
+        self.assertEqual(len(identity_match), 3)
+        self.assertNotIn('4444444444.3333333333', self.test_helper.get_column(identity_match, 'ga_id'))
+        for row in identity_match:
+            self.assertEqual(row['last_seen'], date(2025, 6, 6))
+
+        alternate_identity_match = self.test_helper.get_table_data('alternate_identity_match')
+        self.assertEqual(
+            sorted(self.test_helper.get_column(alternate_identity_match, 'alternate_id_type')),
+            ['fb_id', 'reddit_id', 'tiktok_id']
+        )
+
+    def test_run_state_watermark(self):
+        self.test_helper.start_test()
+
+        self.test_helper.initialise_table_from_fixture('events_20250606')
+        self.test_helper.initialise_table_from_fixture('events_20250607')
+
+        call_shard = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`('20250606', '20250606', NULL)"
+        self.test_helper.query([], call_shard)
+
+        run_state = self.test_helper.get_table_data('identity_match_run_state')
+        self.assertEqual(self.test_helper.get_column(run_state, 'shard_suffix'), ['20250606'])
+        self.assertEqual(self.test_helper.get_column(run_state, 'high_water_mark'), ['20250606'])
+
+        # a redelivered trigger for an already processed shard changes nothing
+        self.test_helper.query([], call_shard)
+        for row in self.test_helper.get_table_data('identity_match'):
+            self.assertEqual(row['seen_count'], 1)
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match_run_state')), 1)
+
+        # without a shard, only the shards after the high-water mark are processed
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
+        self.test_helper.query([], call_procedure)
+
+        run_state = self.test_helper.get_table_data('identity_match_run_state')
+        self.assertEqual(sorted(self.test_helper.get_column(run_state, 'shard_suffix')), ['20250606', '20250607'])
+        self.assertEqual(max(self.test_helper.get_column(run_state, 'high_water_mark')), '20250607')
+
+        identity_match = {
+            (row['hashed_email'], row['ga_id']): (row['first_seen'], row['last_seen'], row['seen_count'])
+            for row in self.test_helper.get_table_data('identity_match')
+        }
+        self.assertEqual(
+            identity_match[('a665a45920422f9d417e4867efdc4fb8a04a1f3fff1fa07e998e86f7f7a27ae3', '1234567890.0987654321')],
+            (date(2025, 6, 6), date(2025, 6, 7), 2)
+        )
+
+    def test_intraday_then_daily_reconciliation(self):
+        self.test_helper.start_test()
+
+        # events_intraday_20250607 is read through events_* as intraday_20250607
+        events_schema = self.test_helper.tables['events']['table'].schema
+        intraday_ref = f'{self.test_helper.project}.{self.test_helper.dataset}.events_intraday_20250607'
+        intraday_table = bigquery.Table(intraday_ref, events_schema)
+        self.test_helper.client.create_table(intraday_table)
+        self.test_helper.tables['events_intraday_20250607'] = {
+            'table': intraday_table,
+            'key': 'events_intraday_20250607',
+            'table_name': 'events_intraday_20250607',
+            'table_ref': intraday_ref
+        }
+
+        events = self.test_helper.load_fixture('events_20250607')
+        call_intraday = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`('intraday_', 'intraday_99999999', NULL)"
+
+        self.test_helper.load_table('events_intraday_20250607', events[:1])
+        self.test_helper.query([], call_intraday)
+
+        identity_match = self.test_helper.get_table_data('identity_match')
+        self.assertEqual(self.test_helper.get_column(identity_match, 'ga_id'), ['1234567890.0987654321'])
+        intraday_state = self.test_helper.get_table_data('identity_match_intraday_state')
+        self.assertEqual(self.test_helper.get_column(intraday_state, 'shard_suffix'), ['intraday_20250607'])
+        self.assertEqual(self.test_helper.get_column(intraday_state, 'event_timestamp_watermark'), [events[0]['event_timestamp']])
+        # the day is only marked processed by its daily shard
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match_run_state')), 0)
+
+        # an event streamed since the last run, the first is read again within the lookback
+        self.test_helper.load_table('events_intraday_20250607', events[1:])
+        self.test_helper.query([], call_intraday)
+
+        identity_match = self.test_helper.get_table_data('identity_match')
+        self.assertEqual(
+            sorted(self.test_helper.get_column(identity_match, 'ga_id')),
+            ['1234567890.0987654321', '4444444444.3333333333']
+        )
+        self.assertEqual(
+            max(self.test_helper.get_column(self.test_helper.get_table_data('identity_match_intraday_state'),
+                                            'event_timestamp_watermark')),
+            events[1]['event_timestamp']
+        )
+
+        # the daily shard reconciles the day without counting its sightings twice
+        history = self.test_helper.get_table_data('identity_match_history')
+        alternate_history = self.test_helper.get_table_data('alternate_identity_match_history')
+        self.test_helper.load_table('events_20250607', events)
+        call_daily = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`('20250607', '20250607', NULL)"
+        self.test_helper.query([], call_daily)
+
+        for row in self.test_helper.get_table_data('identity_match'):
+            self.assertEqual(row['seen_count'], 1)
+            self.assertEqual(row['last_seen'], date(2025, 6, 7))
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match_history')), len(history))
+        self.assertEqual(len(self.test_helper.get_table_data('alternate_identity_match_history')), len(alternate_history))
+        run_state = self.test_helper.get_table_data('identity_match_run_state')
+        self.assertEqual(self.test_helper.get_column(run_state, 'shard_suffix'), ['20250607'])
+
+        # once the daily shard is processed, its intraday table is skipped
+        self.test_helper.query([], call_intraday)
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match_history')), len(history))
+
+    def test_properties_share_identity_tables(self):
+        self.test_helper.start_test()
+
+        # a second GA4 property exporting the same day to its own dataset
+        property_dataset = f'{self.test_helper.dataset}_property'
+        self.test_helper.client.create_dataset(f'{self.test_helper.project}.{property_dataset}', exists_ok=True)
+        self.addCleanup(self.test_helper.client.delete_dataset, f'{self.test_helper.project}.{property_dataset}',
+                        delete_contents=True, not_found_ok=True)
+        events_schema = self.test_helper.tables['events']['table'].schema
+        property_events_ref = f'{self.test_helper.project}.{property_dataset}.events_20250606'
+        self.test_helper.client.create_table(bigquery.Table(property_events_ref, events_schema))
+
+        events = self.test_helper.initialise_table_from_fixture('events_20250606')
+        self.test_helper.client.load_table_from_json(
+            [self.test_helper.to_load_value(row) for row in events], property_events_ref,
+            job_config=bigquery.LoadJobConfig(schema=events_schema, write_disposition='WRITE_APPEND')
+        ).result()
+
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, %s)"
+        self.test_helper.query([], call_procedure % 'NULL')
+        identity_match = self.test_helper.get_table_data('identity_match')
+
+        # the other property's shard of the same day is not skipped, and its
+        # sightings of the same links on the same day are not counted again
+        self.test_helper.query([], call_procedure % f"'{self.test_helper.project}.{property_dataset}'")
+        run_state = self.test_helper.get_table_data('identity_match_run_state')
+        self.assertEqual(
+            sorted((row['source_dataset'], row['shard_suffix']) for row in run_state),
+            [(f'{self.test_helper.project}.{self.test_helper.dataset}', '20250606'),
+             (f'{self.test_helper.project}.{property_dataset}', '20250606')]
+        )
+        self.assertEqual(
+            sorted((row['hashed_email'], row['ga_id'], row['seen_count'])
+                   for row in self.test_helper.get_table_data('identity_match')),
+            sorted((row['hashed_email'], row['ga_id'], row['seen_count']) for row in identity_match)
+        )
+
+        with self.assertRaisesRegex(Exception, 'Invalid source dataset'):
+            self.test_helper.query([], call_procedure % "'not a dataset'")
+
+    def test_compaction_archives_stale_links(self):
+        self.test_helper.start_test()
+
+        self.test_helper.initialise_table_from_fixture('events_20250606')
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
+        self.test_helper.query([], call_procedure)
+        identity_match = self.test_helper.get_table_data('identity_match')
+        alternate_identity_match = self.test_helper.get_table_data('alternate_identity_match')
+
+        # links seen within the TTL are kept
+        call_compaction = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.compact_identity_match`(%d)"
+        self.test_helper.query([], call_compaction % 100000)
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match')), len(identity_match))
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match_archive')), 0)
+
+        # the fixture's 2025-06-06 links are older than 30 days
+        self.test_helper.query([], call_compaction % 30)
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match')), 0)
+        self.assertEqual(len(self.test_helper.get_table_data('alternate_identity_match')), 0)
+        archive = self.test_helper.get_table_data('identity_match_archive')
+        self.assertEqual(
+            sorted((row['hashed_email'], row['ga_id'], row['seen_count']) for row in archive),
+            sorted((row['hashed_email'], row['ga_id'], row['seen_count']) for row in identity_match)
+        )
+        self.assertEqual(len(self.test_helper.get_table_data('alternate_identity_match_archive')),
+                         len(alternate_identity_match))
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match_lease')), 0)
+
+        # the archived links no longer join the email to its devices and alternate ids
+        self.assertEqual(self.test_helper.get_table_data('identity_cluster'), [])
+
+        # logical bytes: strings are 2 bytes plus their length, the other columns 8 bytes
+        run_log = {row['stage']: row for row in self.test_helper.get_table_data('identity_match_run_log')
+                   if row['stage'].startswith(('archive_', 'delete_'))}
+        self.assertEqual(run_log['delete_identity_match']['rows_affected'], len(identity_match))
+        self.assertEqual(run_log['archive_identity_match']['bytes_reclaimed'], sum(
+            6 + len(row['id']) + len(row['hashed_email']) + len(row['ga_id']) + 40 for row in identity_match
+        ))
+        self.assertEqual(run_log['archive_alternate_identity_match']['bytes_reclaimed'], sum(
+            6 + len(row['hashed_email']) + len(row['alternate_id_type']) + len(row['current_alternate_id']) + 32
+            for row in alternate_identity_match
+        ))
+
+        # replaying the shard does not bring the links back, their sightings are in the history
+        self.test_helper.client.query(
+            f"DELETE FROM `{self.test_helper.tables['identity_match_run_state']['table_ref']}` WHERE TRUE"
+        ).result()
+        self.test_helper.query([], call_procedure)
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match')), 0)
+
+        # a link seen again comes back from the day it was seen
+        self.test_helper.initialise_table_from_fixture('events_20250607')
+        self.test_helper.query([], call_procedure)
+        identity_match = {
+            (row['hashed_email'], row['ga_id']): (row['first_seen'], row['seen_count'])
+            for row in self.test_helper.get_table_data('identity_match')
+        }
+        self.assertEqual(
+            identity_match[('a665a45920422f9d417e4867efdc4fb8a04a1f3fff1fa07e998e86f7f7a27ae3', '1234567890.0987654321')],
+            (date(2025, 6, 7), 1)
+        )
+        self.assertEqual(len(identity_match), 2)
+
+        # only the links seen again are clustered
+        self.assertEqual(
+            {f"{row['node_type']}:{row['node_id']}" for row in self.test_helper.get_table_data('identity_cluster')},
+            {node for link in self.live_links() for node in link}
+        )
+
+        # archived again, the link's sightings are merged into its archive row
+        archived = {(row['hashed_email'], row['ga_id']): row for row in archive}
+        archived_alternate = {(row['hashed_email'], row['alternate_id_type']): row
+                              for row in self.test_helper.get_table_data('alternate_identity_match_archive')}
+        # an alternate id type of an archived email seen again, with a new id
+        hashed_email, alternate_id_type = min(archived_alternate)
+        self.test_helper.client.query(
+            f"INSERT INTO `{self.test_helper.tables['alternate_identity_match']['table_ref']}` VALUES "
+            f"('{hashed_email}', {int(hashed_email[:3], 16)}, '{alternate_id_type}', 'SEEN_AGAIN', "
+            f"DATE '2025-06-07', DATE '2025-06-07', 2)"
+        ).result()
+        seen_again = {(row['hashed_email'], row['alternate_id_type'])
+                      for row in self.test_helper.get_table_data('alternate_identity_match')}
+        ttl_days = (datetime.now(timezone.utc).date() - date(2025, 6, 8)).days
+        self.test_helper.query([], call_compaction % ttl_days)
+        archive = self.test_helper.get_table_data('identity_match_archive')
+        self.assertEqual(len(archive), len(archived.keys() | identity_match.keys()))
+        row = next(row for row in archive if (row['hashed_email'], row['ga_id']) == (
+            'a665a45920422f9d417e4867efdc4fb8a04a1f3fff1fa07e998e86f7f7a27ae3', '1234567890.0987654321'))
+        earlier = archived[(row['hashed_email'], row['ga_id'])]
+        self.assertEqual(
+            (row['id'], row['first_seen'], row['last_seen'], row['seen_count']),
+            (earlier['id'], earlier['first_seen'], date(2025, 6, 7), earlier['seen_count'] + 1)
+        )
+        alternate_archive = self.test_helper.get_table_data('alternate_identity_match_archive')
+        self.assertEqual(len(alternate_archive), len(archived_alternate.keys() | seen_again))
+        row = next(row for row in alternate_archive
+                   if (row['hashed_email'], row['alternate_id_type']) == (hashed_email, alternate_id_type))
+        earlier = archived_alternate[(hashed_email, alternate_id_type)]
+        self.assertEqual(
+            (row['current_alternate_id'], row['first_seen'], row['last_seen'], row['seen_count']),
+            ('SEEN_AGAIN', earlier['first_seen'], date(2025, 6, 7), earlier['seen_count'] + 2)
+        )
+
+    def live_links(self):
+        """Links of identity_match, and the history of the alternate ids of alternate_identity_match."""
+        alternate_types = {
+            (row['hashed_email'], row['alternate_id_type'])
+            for row in self.test_helper.get_table_data('alternate_identity_match')
+        }
+        return history_links(
+            self.test_helper.get_table_data('identity_match'),
+            [row for row in self.test_helper.get_table_data('alternate_identity_match_history')
+             if (row['hashed_email'], row['alternate_id_type']) in alternate_types]
+        )
+
+    def test_compaction_splits_clusters(self):
+        self.test_helper.start_test()
+
+        self.test_helper.initialise_table_from_fixture('events_20250606')
+        self.test_helper.initialise_table_from_fixture('events_20250607')
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
+        self.test_helper.query([], call_procedure)
+        email_a = 'email:a665a45920422f9d417e4867efdc4fb8a04a1f3fff1fa07e998e86f7f7a27ae3'
+        clusters = {
+            f"{row['node_type']}:{row['node_id']}": row['cluster_id']
+            for row in self.test_helper.get_table_data('identity_cluster')
+        }
+        self.assertEqual(clusters['ga_id:3333333333.2222222222'], clusters[email_a])
+
+        # archives the links last seen on 2025-06-06, the cutoff is today minus the TTL
+        ttl_days = (datetime.now(timezone.utc).date() - date(2025, 6, 7)).days
+        call_compaction = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.compact_identity_match`({ttl_days})"
+        self.test_helper.query([], call_compaction)
+        self.assertEqual(len(self.test_helper.get_table_data('identity_match')), 2)
+
+        # the clusters are those of the links left, the device and ids only seen on 2025-06-06 are dropped
+        expected = IdentityClusters()
+        expected.add_links(self.live_links())
+        clusters = {
+            f"{row['node_type']}:{row['node_id']}": row['cluster_id']
+            for row in self.test_helper.get_table_data('identity_cluster')
+        }
+        self.assertEqual(clusters, expected.clusters())
+        self.assertNotIn('ga_id:3333333333.2222222222', clusters)
+        self.assertNotIn('fb_id:FB_123456789', clusters)
+        self.assertEqual(clusters['ga_id:1234567890.0987654321'], clusters[email_a])
+        run_log = {row['stage']: row for row in self.test_helper.get_table_data('identity_match_run_log')}
+        self.assertGreater(run_log['split_identity_cluster']['rows_affected'], 0)
+
+    def test_run_log_stages(self):
+        self.test_helper.start_test()
+
+        self.test_helper.initialise_table_from_fixture('identity_match')
+        self.test_helper.initialise_table_from_fixture('events_20250606')
+        self.test_helper.initialise_table_from_fixture('events_20250607')
+
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
+        self.test_helper.query([], call_procedure)
+
+        run_log = {row['stage']: row for row in self.test_helper.get_table_data('identity_match_run_log')}
+        self.assertEqual(sorted(run_log), sorted([
+            'extract_identity_events', 'insert_identity_match_history', 'insert_alternate_identity_match_history',
+            'merge_identity_match', 'merge_alternate_identity_match', 'insert_run_state',
+            'update_identity_cluster', 'export_identity_graph'
+        ]))
+        self.assertEqual(len({row['run_id'] for row in run_log.values()}), 1)
+        for row in run_log.values():
+            self.assertEqual((row['first_shard'], row['last_shard']), ('20250606', '20250607'))
+            self.assertLessEqual(row['started_at'], row['ended_at'])
+
+        # one history row and one identity_match insert or update per link and day
+        self.assertEqual(run_log['insert_run_state']['rows_affected'], 2)
+        self.assertEqual(run_log['insert_identity_match_history']['rows_affected'],
+                         len(self.test_helper.get_table_data('identity_match_history')))
+        self.assertEqual(run_log['merge_identity_match']['rows_affected'],
+                         len(self.test_helper.get_table_data('identity_match')))
+
+    def test_identity_clusters(self):
+        self.test_helper.start_test()
+
+        self.test_helper.initialise_table_from_fixture('events_20250606')
+        self.test_helper.initialise_table_from_fixture('events_20250607')
+
+        def stored_clusters():
+            return {
+                f"{row['node_type']}:{row['node_id']}": row['cluster_id']
+                for row in self.test_helper.get_table_data('identity_cluster')
+            }
+
+        def reference_clusters():
+            clusters = IdentityClusters()
+            clusters.add_links(history_links(
+                self.test_helper.get_table_data('identity_match_history'),
+                self.test_helper.get_table_data('alternate_identity_match_history')
+            ))
+            return clusters.clusters()
+
+        # the second shard's links are merged into the clusters of the first
+        for shard in ['20250606', '20250607']:
+            call_shard = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`('{shard}', '{shard}', NULL)"
+            self.test_helper.query([], call_shard)
+            self.assertEqual(stored_clusters(), reference_clusters())
+
+        # email_a is seen on two devices, both are in its cluster
+        clusters = stored_clusters()
+        email_a = 'email:a665a45920422f9d417e4867efdc4fb8a04a1f3fff1fa07e998e86f7f7a27ae3'
+        self.assertEqual(clusters['ga_id:1234567890.0987654321'], clusters[email_a])
+        self.assertEqual(clusters['ga_id:3333333333.2222222222'], clusters[email_a])
+
+        # a write retried after a concurrent update calls it again in the same script
+        self.test_helper.query([], f"""
+            DECLARE relabelled INT64;
+            CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_cluster`(NULL, NULL, relabelled);
+            CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_cluster`(NULL, NULL, relabelled);
+        """)
+        self.assertEqual(stored_clusters(), clusters)
+
+    def test_identity_graph_export(self):
+        if self.test_helper.backend != 'local':
+            self.skipTest("exports to a local directory, run with TEST_BACKEND=local")
+        import duckdb
+        self.test_helper.start_test()
+
+        export_uri = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_uri)
+        self.create_export_procedure(export_uri)
+        # the other tests of the class run with the export switched off
+        self.addCleanup(self.create_export_procedure, '')
+
+        self.test_helper.initialise_table_from_fixture('events_20250606')
+        self.test_helper.initialise_table_from_fixture('events_20250607')
+
+        # the first run exports a snapshot, the next one the links it changed
+        for shard in ['20250606', '20250607']:
+            call_shard = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`('{shard}', '{shard}', NULL)"
+            self.test_helper.query([], call_shard)
+
+        manifest = duckdb.sql(f"SELECT * FROM read_json('{export_uri}/manifest/*.json')").fetchall()
+        (snapshot_id, snapshot_kind, _, snapshot_uri, _), (delta_id, delta_kind, base_snapshot_id, delta_uri, _) = manifest
+        self.assertEqual((snapshot_kind, delta_kind), ('snapshot', 'delta'))
+        self.assertEqual(base_snapshot_id, snapshot_id)
+
+        # only the links seen on 20250607 are in the delta
+        def links(uri, table):
+            return {
+                (hashed_email, ga_id): (first_seen, last_seen, seen_count)
+                for hashed_email, ga_id, first_seen, last_seen, seen_count in duckdb.sql(
+                    f"SELECT hashed_email, ga_id, first_seen, last_seen, seen_count FROM read_parquet('{uri}/{table}/*.parquet')"
+                ).fetchall()
+            }
+        delta = links(delta_uri, 'identity_match')
+        self.assertEqual({last_seen for _, last_seen, _ in delta.values()}, {date(2025, 6, 7)})
+
+        # the delta upserted onto the snapshot is the identity_match table
+        identity_match = {
+            (row['hashed_email'], row['ga_id']): (row['first_seen'], row['last_seen'], row['seen_count'])
+            for row in self.test_helper.get_table_data('identity_match')
+        }
+        self.assertEqual(links(snapshot_uri, 'identity_match') | delta, identity_match)
+
+        # nothing new to export on a run without new shards
+        call_procedure = f"CALL `{self.test_helper.project}.{self.test_helper.dataset}.update_identity_match`(NULL, NULL, NULL)"
+        self.test_helper.query([], call_procedure)
+        self.assertEqual(len(self.test_helper.get_table_data('identity_graph_manifest')), 2)
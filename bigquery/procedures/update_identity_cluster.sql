@@ -0,0 +1,109 @@
+CREATE OR REPLACE PROCEDURE `${project_id}.${dataset_id}.update_identity_cluster`(start_date DATE, end_date DATE, OUT relabelled INT64)
+BEGIN
+  -- Links are undirected edges between nodes keyed type:id, e.g.
+  -- email:<hashed_email>, ga_id:<user_pseudo_id> or fb_id:<alternate id>.
+  -- A cluster's cluster_id is the smallest node key in it, so merging
+  -- clusters keeps the smallest of their ids and relabelling only the
+  -- clusters touched by new links gives the same result as a full recompute
+  -- (bigquery/identity_cluster.py is the reference implementation).
+  -- This procedure only adds links, so here clusters merge but never split.
+  -- compact_identity_match removes links, and split_identity_cluster
+  -- recomputes the clusters they were in.
+  -- The temp tables are replaced, as update_identity_match calls this again
+  -- in the same script when its write is retried after a concurrent update.
+  DECLARE changed INT64 DEFAULT 1;
+
+  -- Links seen between start_date and end_date, every link when both are NULL.
+  -- The history tables are partitioned on seen_date. Sightings of links
+  -- compact_identity_match archived stay in the history, so only the links
+  -- still in identity_match and alternate_identity_match are clustered.
+  CREATE OR REPLACE TEMP TABLE cluster_links AS
+  SELECT CONCAT('email:', history.hashed_email) AS node, CONCAT('ga_id:', history.ga_id) AS neighbour
+  FROM `${project_id}.${dataset_id}.identity_match_history` history
+  JOIN `${project_id}.${dataset_id}.identity_match` identity_match
+  ON identity_match.hashed_email = history.hashed_email
+    AND identity_match.ga_id = history.ga_id
+  WHERE history.seen_date BETWEEN IFNULL(start_date, DATE '1970-01-01') AND IFNULL(end_date, DATE '9999-12-31')
+  UNION DISTINCT
+  SELECT CONCAT('email:', history.hashed_email), CONCAT(history.alternate_id_type, ':', history.alternate_id)
+  FROM `${project_id}.${dataset_id}.alternate_identity_match_history` history
+  JOIN `${project_id}.${dataset_id}.alternate_identity_match` alternate_identity_match
+  ON alternate_identity_match.hashed_email = history.hashed_email
+    AND alternate_identity_match.alternate_id_type = history.alternate_id_type
+  WHERE history.seen_date BETWEEN IFNULL(start_date, DATE '1970-01-01') AND IFNULL(end_date, DATE '9999-12-31');
+
+  -- Every node of a cluster the links touch is linked to its cluster_id,
+  -- itself a node of the cluster, so the existing clusters are merged
+  -- without reading the links they were built from.
+  INSERT INTO cluster_links(node, neighbour)
+  SELECT CONCAT(node_type, ':', node_id), cluster_id
+  FROM `${project_id}.${dataset_id}.identity_cluster`
+  WHERE cluster_id IN (
+    SELECT identity_cluster.cluster_id
+    FROM `${project_id}.${dataset_id}.identity_cluster` identity_cluster
+    JOIN (
+      SELECT node FROM cluster_links
+      UNION DISTINCT
+      SELECT neighbour FROM cluster_links
+    ) linked
+    ON linked.node = CONCAT(identity_cluster.node_type, ':', identity_cluster.node_id)
+  );
+
+  CREATE OR REPLACE TEMP TABLE cluster_edges AS
+  SELECT node, neighbour FROM cluster_links
+  UNION DISTINCT
+  SELECT neighbour, node FROM cluster_links;
+
+  CREATE OR REPLACE TEMP TABLE cluster_labels AS
+  SELECT node, LEAST(node, MIN(neighbour)) AS label
+  FROM cluster_edges
+  GROUP BY node;
+
+  -- Propagate the smallest label to the neighbours, and jump each label to
+  -- its own label (a label is always a node of the same cluster), until no
+  -- label changes. The number of rounds grows with the log of the cluster
+  -- diameter rather than with the number of nodes.
+  WHILE changed > 0 DO
+    UPDATE cluster_labels
+    SET label = smallest.label
+    FROM (
+      SELECT cluster_edges.node, MIN(neighbour_labels.label) AS label
+      FROM cluster_edges
+      JOIN cluster_labels neighbour_labels
+      ON neighbour_labels.node = cluster_edges.neighbour
+      GROUP BY cluster_edges.node
+    ) smallest
+    WHERE smallest.node = cluster_labels.node
+      AND smallest.label < cluster_labels.label;
+    SET changed = @@row_count;
+
+    UPDATE cluster_labels
+    SET label = jump.label
+    FROM (
+      SELECT node, label FROM cluster_labels
+    ) jump
+    WHERE jump.node = cluster_labels.label
+      AND jump.label < cluster_labels.label;
+    SET changed = changed + @@row_count;
+  END WHILE;
+
+  MERGE `${project_id}.${dataset_id}.identity_cluster` identity_cluster
+  USING (
+    SELECT
+      SUBSTR(node, 1, STRPOS(node, ':') - 1) AS node_type,
+      SUBSTR(node, STRPOS(node, ':') + 1) AS node_id,
+      label AS cluster_id
+    FROM cluster_labels
+  ) result
+  ON result.node_type = identity_cluster.node_type
+    AND result.node_id = identity_cluster.node_id
+  WHEN MATCHED AND result.cluster_id != identity_cluster.cluster_id THEN
+    UPDATE SET
+      cluster_id = result.cluster_id,
+      updated_at = CURRENT_TIMESTAMP()
+  WHEN NOT MATCHED THEN
+    INSERT (node_type, node_id, cluster_id, updated_at)
+    VALUES (result.node_type, result.node_id, result.cluster_id, CURRENT_TIMESTAMP());
+
+  SET relabelled = @@row_count;
+END;
@@ -1,122 +1,490 @@
-CREATE OR REPLACE PROCEDURE `${project_id}.${dataset_id}.update_identity_match`()
+CREATE OR REPLACE PROCEDURE `${project_id}.${dataset_id}.update_identity_match`(start_suffix STRING, end_suffix STRING, source_dataset STRING)
 BEGIN
-  DECLARE last_update_date STRING;
-  SET last_update_date = (
-    SELECT IFNULL(
-      FORMAT_DATETIME("%Y%m%d", MAX(updated_date[OFFSET(ARRAY_LENGTH(updated_date) - 1)])),
-      "20250616"
+  -- GA4 export dataset (project.dataset) read by the run, the deployment's
+  -- own property when NULL. Runs of different properties can overlap: the
+  -- run state is kept per property, and a transaction aborted by another
+  -- property's commit retries its write stages on the extracted events.
+  DECLARE source STRING DEFAULT IFNULL(source_dataset, '${ga4_project}.${ga4_dataset}');
+  DECLARE write_attempts INT64 DEFAULT 0;
+  DECLARE committed BOOL DEFAULT FALSE;
+  -- event_params keys carrying alternate platform ids, stored without the
+  -- guid_ prefix as alternate_id_type
+  DECLARE alternate_id_keys ARRAY<STRING> DEFAULT [
+    'guid_floodlight_id', 'guid_gads_id', 'guid_floodlight_gads_id',
+    'guid_fb_id', 'guid_tiktok_id', 'guid_reddit_id', 'guid_rws_id'
+  ];
+  -- Latest events_* shard suffix processed, kept in the small run-state table
+  -- so it is not derived from the growing identity_match table on each run.
+  DECLARE high_water_mark STRING;
+  -- events_* shard suffixes processed by this run, and their range.
+  -- When called with a suffix range (e.g. '20250607', '20250607' from the
+  -- export log sink, or a backfill chunk) the unprocessed daily shards in
+  -- that range are read, otherwise every daily shard after the high-water
+  -- mark is read.
+  -- A range of intraday_ suffixes (e.g. 'intraday_', 'intraday_99999999'
+  -- from the intraday schedule) reads the events_intraday_* tables of days
+  -- whose daily shard is not processed yet, from the event_timestamp
+  -- watermark on. Their links are recorded in the history like any other,
+  -- so the daily shard later only adds the sightings intraday runs missed.
+  DECLARE intraday BOOL DEFAULT STARTS_WITH(IFNULL(start_suffix, ''), 'intraday_');
+  DECLARE intraday_watermark INT64;
+  DECLARE shards ARRAY<STRING>;
+  DECLARE first_shard STRING;
+  DECLARE last_shard STRING;
+  DECLARE start_date DATE;
+  DECLARE end_date DATE;
+  -- email_bucket of the extracted emails. identity_match and
+  -- alternate_identity_match are partitioned on email_bucket, the first
+  -- three hex digits of hashed_email, so the MERGEs only read the
+  -- partitions of the batch's emails. A batch of n emails reads about
+  -- 1 - (1 - 1/4096)^n of the partitions, e.g. 22% for 1,000 emails.
+  DECLARE email_buckets ARRAY<INT64>;
+  -- Rows and timings of each stage, written to identity_match_run_log once
+  -- the run has committed so cost and latency regressions show per stage.
+  DECLARE stage_started TIMESTAMP;
+  DECLARE relabelled INT64;
+  DECLARE exported_rows INT64;
+  DECLARE run_log ARRAY<STRUCT<stage STRING, rows_affected INT64, started_at TIMESTAMP, ended_at TIMESTAMP>> DEFAULT [];
+  DECLARE extract_log ARRAY<STRUCT<stage STRING, rows_affected INT64, started_at TIMESTAMP, ended_at TIMESTAMP>>;
+
+  -- the source is formatted into the GA4 queries below
+  IF NOT REGEXP_CONTAINS(source, r'^[a-z][a-z0-9-]*\.[A-Za-z0-9_]+$') THEN
+    RAISE USING MESSAGE = FORMAT("Invalid source dataset %s, expected project.dataset", source);
+  END IF;
+
+  SET high_water_mark = (
+    SELECT MAX(high_water_mark)
+    FROM `${project_id}.${dataset_id}.identity_match_run_state`
+    WHERE source_dataset = source
+  );
+  IF high_water_mark IS NULL AND NOT EXISTS (
+    SELECT 1 FROM `${project_id}.${dataset_id}.identity_match_run_state`
+  ) THEN
+    -- first run against identity tables populated before the run state existed
+    SET high_water_mark = (
+      SELECT FORMAT_DATE("%Y%m%d", MAX(last_seen))
+      FROM `${project_id}.${dataset_id}.identity_match`
+    );
+  END IF;
+
+  -- Intraday runs re-read a lookback window before the watermark, for events
+  -- streamed late. Sightings already in the history are not counted again.
+  IF intraday THEN
+    SET intraday_watermark = (
+      SELECT IFNULL(MAX(event_timestamp_watermark), 0) - ${intraday_lookback_seconds} * 1000000
+      FROM `${project_id}.${dataset_id}.identity_match_intraday_state`
+      WHERE source_dataset = source
+    );
+  END IF;
+
+  -- daily shards only unless intraday, events_intraday_* sorts after '99999999'.
+  -- The GA4 queries read the source through dynamic SQL, which only sees
+  -- the script's variables passed as parameters.
+  EXECUTE IMMEDIATE FORMAT("""
+    CREATE TEMP TABLE source_shards AS
+    SELECT DISTINCT _TABLE_SUFFIX AS shard_suffix
+    FROM `%s.events_*`
+    WHERE _TABLE_SUFFIX BETWEEN IFNULL(@start_suffix, '') AND IFNULL(@end_suffix, '99999999')
+      AND (@intraday OR _TABLE_SUFFIX <= '99999999')
+      AND (@start_suffix IS NOT NULL OR _TABLE_SUFFIX > IFNULL(@high_water_mark, ''))
+  """, source)
+  USING start_suffix AS start_suffix, end_suffix AS end_suffix, intraday AS intraday,
+    high_water_mark AS high_water_mark;
+
+  SET shards = (
+    SELECT IFNULL(ARRAY_AGG(shard_suffix ORDER BY shard_suffix), [])
+    FROM source_shards
+    WHERE REPLACE(shard_suffix, 'intraday_', '') NOT IN (
+      SELECT shard_suffix FROM `${project_id}.${dataset_id}.identity_match_run_state`
+      WHERE source_dataset = source
     )
-    FROM `${project_id}.${dataset_id}.identity_match`
   );
 
-  -- Update existing identity_match records
-  UPDATE `${project_id}.${dataset_id}.identity_match` identity_match
-  SET identity_match.updated_date = ARRAY_CONCAT(identity_match.updated_date, [PARSE_DATETIME("%Y%m%d", result.latest_date)])
-  FROM (
-    SELECT 
-      email.value.string_value as hashed_email,
-      user_pseudo_id as ga_id,
-      MAX(event_date) as latest_date
-    FROM `${ga4_project}.${ga4_dataset}.events_*`,
-    UNNEST(event_params) email
-    WHERE _TABLE_SUFFIX > last_update_date
-      AND email.key = 'guid_email'
-      AND email.value.string_value IS NOT NULL
-    GROUP BY 1, 2
-  ) result
-  WHERE result.hashed_email = identity_match.hashed_email
-    AND result.ga_id = identity_match.ga_id;
-
-  -- Insert new identity_match records
-  INSERT INTO `${project_id}.${dataset_id}.identity_match`(
-    id,
-    hashed_email,
-    ga_id,
-    created_date,
-    updated_date
-  )
-  SELECT
-    GENERATE_UUID() AS id,
-    email.value.string_value AS hashed_email,
-    user_pseudo_id AS ga_id,
-    CURRENT_DATETIME() AS created_date,
-    ARRAY<DATETIME>[PARSE_DATETIME("%Y%m%d", MAX(event_date))] AS updated_date
-  FROM
-    `${ga4_project}.${ga4_dataset}.events_*`,
-    UNNEST(event_params) email
-  LEFT JOIN
-    `${project_id}.${dataset_id}.identity_match` AS identity_match
-  ON
-    email.value.string_value = identity_match.hashed_email
-    AND user_pseudo_id = identity_match.ga_id
-  WHERE
-    _TABLE_SUFFIX > last_update_date
-    AND email.key = 'guid_email'
-    AND email.value.string_value IS NOT NULL
-    AND identity_match.id IS NULL
-  GROUP BY 2, 3;
-
-  -- Update existing alternate_identity_match records
-  -- Take the MAX alternate ID value for each email/type to ensure one row per combination
-  UPDATE `${project_id}.${dataset_id}.alternate_identity_match` alternate_identity_match
-  SET 
-    alternate_identity_match.updated_date = ARRAY_CONCAT(alternate_identity_match.updated_date, [PARSE_DATETIME("%Y%m%d", result.latest_date)]),
-    alternate_identity_match.alternate_id = ARRAY_CONCAT(alternate_identity_match.alternate_id, result.alternate_id)
-  FROM (
+  SET (first_shard, last_shard) = (
+    SELECT AS STRUCT MIN(shard), MAX(shard) FROM UNNEST(shards) shard
+  );
+
+  -- Extract the guid_* params from the new events_* shards once, so the
+  -- write stages below read a small session table instead of each scanning
+  -- and unnesting the GA4 export again.
+  -- Each event's params are looked up by key in a single pass, so the
+  -- intermediate rows grow with the number of alternate ids rather than
+  -- the square of the number of params.
+  -- One row per (shard, email, ga_id, seen_date); alternate_id_type and
+  -- alternate_value are populated when the event also carries an alternate id.
+  -- event_timestamp is the latest event of the row, for the intraday watermark.
+  -- The scan runs before the transaction so concurrent runs (e.g. a
+  -- backfill) only contend for the short write stages.
+  SET stage_started = CURRENT_TIMESTAMP();
+  EXECUTE IMMEDIATE FORMAT("""
+    CREATE TEMP TABLE identity_events AS
     SELECT
-      hashed_email,
-      ARRAY<STRING>[MAX(alternate_value)] AS alternate_id,
-      alternate_id_type,
-      MAX(latest_date) as latest_date
+      event.shard_suffix,
+      event.hashed_email,
+      event.ga_id,
+      alt.alternate_id_type,
+      alt.alternate_value,
+      event.seen_date,
+      MAX(event.event_timestamp) AS event_timestamp
     FROM (
-      SELECT DISTINCT
-        email.value.string_value AS hashed_email,
-        alt.value.string_value AS alternate_value,
-        REPLACE(alt.key, 'guid_', '') AS alternate_id_type,
-        event_date as latest_date
-      FROM `${ga4_project}.${ga4_dataset}.events_*`,
-        UNNEST(event_params) email,
-        UNNEST(event_params) alt
-      WHERE _TABLE_SUFFIX > last_update_date
-        AND email.key = 'guid_email'
-        AND alt.key IN ('guid_floodlight_id', 'guid_gads_id', 'guid_floodlight_gads_id', 
-                        'guid_fb_id', 'guid_tiktok_id', 'guid_reddit_id', 'guid_rws_id')
-        AND email.value.string_value IS NOT NULL
-        AND alt.value.string_value IS NOT NULL
-    )
-    GROUP BY hashed_email, alternate_id_type
-  ) as result
-  WHERE result.hashed_email = alternate_identity_match.hashed_email
-    AND result.alternate_id_type = alternate_identity_match.alternate_id_type
-    AND result.alternate_id[SAFE_OFFSET(0)] != ARRAY_REVERSE(alternate_identity_match.alternate_id)[SAFE_OFFSET(0)];
-
-  -- Insert new alternate_identity_match records
-  INSERT INTO `${project_id}.${dataset_id}.alternate_identity_match`(
-    hashed_email,
-    alternate_id,
-    alternate_id_type,
-    updated_date
+      SELECT
+        _TABLE_SUFFIX AS shard_suffix,
+        (
+          SELECT MAX(value.string_value)
+          FROM UNNEST(event_params)
+          WHERE key = 'guid_email'
+        ) AS hashed_email,
+        user_pseudo_id AS ga_id,
+        ARRAY(
+          SELECT AS STRUCT
+            REPLACE(key, 'guid_', '') AS alternate_id_type,
+            value.string_value AS alternate_value
+          FROM UNNEST(event_params)
+          WHERE key IN UNNEST(@alternate_id_keys)
+            AND value.string_value IS NOT NULL
+        ) AS alternate_ids,
+        PARSE_DATE('%%Y%%m%%d', event_date) AS seen_date,
+        event_timestamp
+      FROM `%s.events_*`
+      WHERE _TABLE_SUFFIX IN UNNEST(@shards)
+        AND _TABLE_SUFFIX BETWEEN @first_shard AND @last_shard
+        AND (NOT @intraday OR event_timestamp > @intraday_watermark)
+    ) event
+    LEFT JOIN UNNEST(event.alternate_ids) alt
+    WHERE event.hashed_email IS NOT NULL
+    GROUP BY 1, 2, 3, 4, 5, 6
+  """, source)
+  USING alternate_id_keys AS alternate_id_keys, shards AS shards, first_shard AS first_shard,
+    last_shard AS last_shard, intraday AS intraday, intraday_watermark AS intraday_watermark;
+
+  SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+    'extract_identity_events' AS stage, (SELECT COUNT(*) FROM identity_events) AS rows_affected,
+    stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+  )]);
+  SET extract_log = run_log;
+
+  -- The run state is read again and written in the same transaction as the
+  -- identity tables, so a failed run leaves both untouched and shards
+  -- committed by a concurrent run in the meantime are not applied twice.
+  -- A transaction aborted by another run's commit to the identity tables
+  -- (e.g. another property's) is retried on the same extracted events.
+  WHILE NOT committed DO
+    SET write_attempts = write_attempts + 1;
+    SET run_log = extract_log;
+    BEGIN
+      BEGIN TRANSACTION;
+
+      SET high_water_mark = (
+        SELECT MAX(high_water_mark)
+        FROM `${project_id}.${dataset_id}.identity_match_run_state`
+        WHERE source_dataset = source
+      );
+
+      DELETE FROM identity_events
+      WHERE REPLACE(shard_suffix, 'intraday_', '') IN (
+        SELECT shard_suffix FROM `${project_id}.${dataset_id}.identity_match_run_state`
+        WHERE source_dataset = source
+      );
+
+      SET shards = ARRAY(
+        SELECT shard
+        FROM UNNEST(shards) shard
+        WHERE REPLACE(shard, 'intraday_', '') NOT IN (
+          SELECT shard_suffix FROM `${project_id}.${dataset_id}.identity_match_run_state`
+          WHERE source_dataset = source
+        )
+        ORDER BY shard
+      );
+
+      SET (first_shard, last_shard) = (
+        SELECT AS STRUCT MIN(shard), MAX(shard) FROM UNNEST(shards) shard
+      );
+
+      IF ARRAY_LENGTH(shards) > 0 THEN
+        SET (start_date, end_date) = (
+          PARSE_DATE("%Y%m%d", REPLACE(first_shard, 'intraday_', '')),
+          PARSE_DATE("%Y%m%d", REPLACE(last_shard, 'intraday_', ''))
+        );
+        SET email_buckets = ARRAY(
+          SELECT DISTINCT IFNULL(SAFE_CAST(CONCAT('0x', SUBSTR(hashed_email, 1, 3)) AS INT64), 0)
+          FROM identity_events
+        );
+
+        -- Daily sightings not already in the history tables. The history is
+        -- append-only, one row per link per day, and the main tables only keep
+        -- first_seen/last_seen/seen_count so their rows stay a constant width.
+        -- The history is read only for the processed dates (partitions).
+        SET stage_started = CURRENT_TIMESTAMP();
+        CREATE OR REPLACE TEMP TABLE new_identity_days AS
+        SELECT DISTINCT
+          identity_events.hashed_email,
+          identity_events.ga_id,
+          identity_events.seen_date
+        FROM identity_events
+        LEFT JOIN (
+          SELECT hashed_email, ga_id, seen_date
+          FROM `${project_id}.${dataset_id}.identity_match_history`
+          WHERE seen_date BETWEEN start_date AND end_date
+        ) AS history
+        ON history.hashed_email = identity_events.hashed_email
+          AND history.ga_id = identity_events.ga_id
+          AND history.seen_date = identity_events.seen_date
+        WHERE history.hashed_email IS NULL;
+
+        CREATE OR REPLACE TEMP TABLE new_alternate_days AS
+        SELECT DISTINCT
+          identity_events.hashed_email,
+          identity_events.alternate_id_type,
+          identity_events.alternate_value,
+          identity_events.seen_date
+        FROM identity_events
+        LEFT JOIN (
+          SELECT hashed_email, alternate_id_type, alternate_id, seen_date
+          FROM `${project_id}.${dataset_id}.alternate_identity_match_history`
+          WHERE seen_date BETWEEN start_date AND end_date
+        ) AS history
+        ON history.hashed_email = identity_events.hashed_email
+          AND history.alternate_id_type = identity_events.alternate_id_type
+          AND history.alternate_id = identity_events.alternate_value
+          AND history.seen_date = identity_events.seen_date
+        WHERE identity_events.alternate_value IS NOT NULL
+          AND history.hashed_email IS NULL;
+
+        INSERT INTO `${project_id}.${dataset_id}.identity_match_history`(
+          hashed_email,
+          ga_id,
+          seen_date,
+          recorded_at
+        )
+        SELECT hashed_email, ga_id, seen_date, CURRENT_TIMESTAMP()
+        FROM new_identity_days;
+
+        SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+          'insert_identity_match_history' AS stage, @@row_count AS rows_affected,
+          stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+        )]);
+        SET stage_started = CURRENT_TIMESTAMP();
+
+        INSERT INTO `${project_id}.${dataset_id}.alternate_identity_match_history`(
+          hashed_email,
+          alternate_id_type,
+          alternate_id,
+          seen_date,
+          recorded_at
+        )
+        SELECT hashed_email, alternate_id_type, alternate_value, seen_date, CURRENT_TIMESTAMP()
+        FROM new_alternate_days;
+
+        SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+          'insert_alternate_identity_match_history' AS stage, @@row_count AS rows_affected,
+          stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+        )]);
+
+        SET stage_started = CURRENT_TIMESTAMP();
+
+        -- Update existing and insert new identity_match records
+        MERGE `${project_id}.${dataset_id}.identity_match` identity_match
+        USING (
+          SELECT
+            hashed_email,
+            IFNULL(SAFE_CAST(CONCAT('0x', SUBSTR(hashed_email, 1, 3)) AS INT64), 0) AS email_bucket,
+            ga_id,
+            MIN(seen_date) AS first_seen,
+            MAX(seen_date) AS last_seen,
+            COUNT(*) AS seen_count
+          FROM new_identity_days
+          GROUP BY 1, 2, 3
+        ) result
+        ON identity_match.email_bucket IN UNNEST(email_buckets)
+          AND result.hashed_email = identity_match.hashed_email
+          AND result.ga_id = identity_match.ga_id
+        WHEN MATCHED THEN
+          UPDATE SET
+            first_seen = LEAST(identity_match.first_seen, result.first_seen),
+            last_seen = GREATEST(identity_match.last_seen, result.last_seen),
+            seen_count = identity_match.seen_count + result.seen_count
+        WHEN NOT MATCHED THEN
+          INSERT (
+            id,
+            hashed_email,
+            email_bucket,
+            ga_id,
+            created_date,
+            first_seen,
+            last_seen,
+            seen_count
+          )
+          VALUES (
+            GENERATE_UUID(),
+            result.hashed_email,
+            result.email_bucket,
+            result.ga_id,
+            CURRENT_DATETIME(),
+            result.first_seen,
+            result.last_seen,
+            result.seen_count
+          );
+
+        SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+          'merge_identity_match' AS stage, @@row_count AS rows_affected,
+          stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+        )]);
+
+        -- Update existing and insert new alternate_identity_match records
+        -- The current alternate ID is the one seen on the latest date, taking the
+        -- MAX value on ties, to ensure one row per email/type combination
+        SET stage_started = CURRENT_TIMESTAMP();
+        MERGE `${project_id}.${dataset_id}.alternate_identity_match` alternate_identity_match
+        USING (
+          SELECT
+            hashed_email,
+            IFNULL(SAFE_CAST(CONCAT('0x', SUBSTR(hashed_email, 1, 3)) AS INT64), 0) AS email_bucket,
+            alternate_id_type,
+            ARRAY_AGG(alternate_value ORDER BY seen_date DESC, alternate_value DESC LIMIT 1)[OFFSET(0)] AS current_alternate_id,
+            MIN(seen_date) AS first_seen,
+            MAX(seen_date) AS last_seen,
+            COUNT(*) AS seen_count
+          FROM new_alternate_days
+          GROUP BY hashed_email, email_bucket, alternate_id_type
+        ) result
+        ON alternate_identity_match.email_bucket IN UNNEST(email_buckets)
+          AND result.hashed_email = alternate_identity_match.hashed_email
+          AND result.alternate_id_type = alternate_identity_match.alternate_id_type
+        WHEN MATCHED THEN
+          UPDATE SET
+            current_alternate_id = CASE
+              WHEN result.last_seen > alternate_identity_match.last_seen THEN result.current_alternate_id
+              WHEN result.last_seen = alternate_identity_match.last_seen
+                THEN GREATEST(result.current_alternate_id, alternate_identity_match.current_alternate_id)
+              ELSE alternate_identity_match.current_alternate_id
+            END,
+            first_seen = LEAST(alternate_identity_match.first_seen, result.first_seen),
+            last_seen = GREATEST(alternate_identity_match.last_seen, result.last_seen),
+            seen_count = alternate_identity_match.seen_count + result.seen_count
+        WHEN NOT MATCHED THEN
+          INSERT (
+            hashed_email,
+            email_bucket,
+            alternate_id_type,
+            current_alternate_id,
+            first_seen,
+            last_seen,
+            seen_count
+          )
+          VALUES (
+            result.hashed_email,
+            result.email_bucket,
+            result.alternate_id_type,
+            result.current_alternate_id,
+            result.first_seen,
+            result.last_seen,
+            result.seen_count
+          );
+
+        SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+          'merge_alternate_identity_match' AS stage, @@row_count AS rows_affected,
+          stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+        )]);
+
+        -- Record the processed shards and the new high-water mark. Intraday
+        -- tables are still being written, so they only move the intraday
+        -- watermark and their day is processed again from the daily shard.
+        SET stage_started = CURRENT_TIMESTAMP();
+        IF intraday THEN
+          INSERT INTO `${project_id}.${dataset_id}.identity_match_intraday_state`(
+            source_dataset,
+            shard_suffix,
+            event_timestamp_watermark,
+            processed_at
+          )
+          SELECT source, shard_suffix, MAX(event_timestamp), CURRENT_TIMESTAMP()
+          FROM identity_events
+          GROUP BY shard_suffix;
+        ELSE
+          INSERT INTO `${project_id}.${dataset_id}.identity_match_run_state`(
+            source_dataset,
+            shard_suffix,
+            high_water_mark,
+            processed_at
+          )
+          SELECT
+            source,
+            shard,
+            GREATEST(IFNULL(high_water_mark, last_shard), last_shard),
+            CURRENT_TIMESTAMP()
+          FROM UNNEST(shards) shard;
+        END IF;
+
+        SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+          IF(intraday, 'insert_intraday_state', 'insert_run_state') AS stage, @@row_count AS rows_affected,
+          stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+        )]);
+
+        -- Merge the clusters touched by the processed days' links
+        SET stage_started = CURRENT_TIMESTAMP();
+        CALL `${project_id}.${dataset_id}.update_identity_cluster`(start_date, end_date, relabelled);
+
+        SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+          'update_identity_cluster' AS stage, relabelled AS rows_affected,
+          stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+        )]);
+      END IF;
+
+      COMMIT TRANSACTION;
+      SET committed = TRUE;
+    EXCEPTION WHEN ERROR THEN
+      ROLLBACK TRANSACTION;
+      IF write_attempts >= 5 OR STRPOS(@@error.message, 'concurrent update') = 0 THEN
+        RAISE USING MESSAGE = @@error.message;
+      END IF;
+    END;
+  END WHILE;
+
+  -- Export the links of the committed shards for downstream syncs. It runs
+  -- after the commit, as EXPORT DATA cannot be part of a transaction, and
+  -- also on runs without new shards to catch up after a failed export.
+  SET stage_started = CURRENT_TIMESTAMP();
+  CALL `${project_id}.${dataset_id}.export_identity_graph`(@@script.job_id, FALSE, exported_rows);
+
+  SET run_log = ARRAY_CONCAT(run_log, [STRUCT(
+    'export_identity_graph' AS stage, exported_rows AS rows_affected,
+    stage_started AS started_at, CURRENT_TIMESTAMP() AS ended_at
+  )]);
+
+  INSERT INTO `${project_id}.${dataset_id}.identity_match_run_log`(
+    run_id,
+    stage,
+    rows_affected,
+    started_at,
+    ended_at,
+    high_water_mark,
+    first_shard,
+    last_shard
   )
   SELECT
-    email.value.string_value AS hashed_email,
-    ARRAY<STRING>[alt.value.string_value] AS alternate_id,
-    REPLACE(alt.key, 'guid_', '') AS alternate_id_type,
-    ARRAY<DATETIME>[PARSE_DATETIME("%Y%m%d", MAX(event_date))] AS updated_date
-  FROM `${ga4_project}.${ga4_dataset}.events_*`,
-    UNNEST(event_params) email,
-    UNNEST(event_params) alt
-  LEFT JOIN
-    `${project_id}.${dataset_id}.alternate_identity_match` AS alternate_identity_match
-  ON
-    email.value.string_value = alternate_identity_match.hashed_email
-    AND REPLACE(alt.key, 'guid_', '') = alternate_identity_match.alternate_id_type
-  WHERE _TABLE_SUFFIX > last_update_date
-    AND email.key = 'guid_email'
-    AND alt.key IN ('guid_floodlight_id', 'guid_gads_id', 'guid_floodlight_gads_id',
-                    'guid_fb_id', 'guid_tiktok_id', 'guid_reddit_id', 'guid_rws_id')
-    AND email.value.string_value IS NOT NULL
-    AND alt.value.string_value IS NOT NULL
-    AND alternate_identity_match.hashed_email IS NULL
-  GROUP BY email.value.string_value, alt.value.string_value, alt.key;
-
-END;
\ No newline at end of file
+    @@script.job_id,
+    stage,
+    rows_affected,
+    started_at,
+    ended_at,
+    high_water_mark,
+    first_shard,
+    last_shard
+  FROM UNNEST(run_log);
+
+  -- Release the single-flight lease taken by the identity_match function
+  -- for this job, if any
+  DELETE FROM `${project_id}.${dataset_id}.identity_match_lease`
+  WHERE holder = @@script.job_id;
+
+  SELECT IF(
+    ARRAY_LENGTH(shards) = 0,
+    "Processing completed: no new events shards",
+    FORMAT("Processing completed for events_%s to events_%s", first_shard, last_shard)
+  ) AS status;
+
+EXCEPTION WHEN ERROR THEN
+  DELETE FROM `${project_id}.${dataset_id}.identity_match_lease`
+  WHERE holder = @@script.job_id;
+  RAISE USING MESSAGE = @@error.message;
+END;
@@ -0,0 +1,186 @@
+import json
+import threading
+import pytest
+from datetime import date
+from google.api_core.exceptions import BadRequest
+
+from bigquery.backfill_identity_match import Backfill, BackfillProgress, LeaseUnavailable, split_chunks
+from test.bq_test_helper import BiqQueryTest
+from test.ga4_event_generator import GA4EventGenerator
+from test.benchmark_identity_match import create_tables
+
+DAYS = 12
+START_DATE = date(2025, 6, 1)
+
+
+class RecordingClient:
+    """
+    Passes queries on to the local backend's client, recording the
+    update_identity_match calls and how many were submitted at the same time.
+    A chunk in failures fails its first call.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+        self.failures = set()
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def query(self, query, job_config=None, **kwargs):
+        if 'update_identity_match`' not in query:
+            return self.client.query(query, job_config=job_config, **kwargs)
+
+        parameters = {parameter.name: parameter.value for parameter in job_config.query_parameters}
+        chunk = (parameters['start_suffix'], parameters['end_suffix'])
+        with self.lock:
+            self.calls.append(chunk)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            if chunk in self.failures:
+                self.failures.remove(chunk)
+                raise BadRequest(f'Chunk {chunk} failed')
+            return self.client.query(query, job_config=job_config, **kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@pytest.fixture(scope='module')
+def events(tmp_path_factory):
+    generator = GA4EventGenerator(emails=20, anonymous_devices=10, seed=1)
+    return generator.write_ndjson(str(tmp_path_factory.mktemp('events')), START_DATE, DAYS, 20)
+
+
+def create_helper(events):
+    """A dataset with the identity tables, the procedures and the events shards, the backfill's source."""
+    helper = BiqQueryTest('nzaa-mkt-guid', 'test_backfill_identity_match', backend='local', isolated=True)
+    create_tables(helper, events)
+    for procedure in ('acquire_identity_match_lease', 'release_identity_match_lease'):
+        helper.client.query(helper.load_template(
+            '', f'bigquery/procedures/{procedure}.sql', use_root_path=True)).result()
+    for suffix, path in events.items():
+        helper.load_table_from_ndjson(f'events_{suffix}', path)
+    return helper
+
+
+@pytest.fixture
+def helper(events):
+    helper = create_helper(events)
+    yield helper
+    helper.delete_dataset()
+
+
+def backfill(helper, client=None, **kwargs):
+    return Backfill(client or helper.client, helper.project, helper.dataset, f'{helper.project}.{helper.dataset}',
+                    **kwargs)
+
+
+def rows(helper, table, columns):
+    job = helper.client.query(
+        f"SELECT {columns} FROM `{helper.project}.{helper.dataset}.{table}` ORDER BY {columns}"
+    )
+    return [tuple(row.values()) for row in job.result()]
+
+
+def lease_holders(helper):
+    return rows(helper, 'identity_match_lease', 'holder')
+
+
+def identity_tables(helper):
+    return {
+        'identity_match': rows(helper, 'identity_match', 'hashed_email, ga_id, first_seen, last_seen, seen_count'),
+        'alternate_identity_match': rows(
+            helper, 'alternate_identity_match',
+            'hashed_email, alternate_id_type, current_alternate_id, first_seen, last_seen, seen_count'
+        ),
+        'identity_match_history': rows(helper, 'identity_match_history', 'hashed_email, ga_id, seen_date'),
+        'identity_cluster': rows(helper, 'identity_cluster', 'node_type, node_id, cluster_id'),
+        'identity_match_run_state': rows(helper, 'identity_match_run_state', 'shard_suffix'),
+    }
+
+
+class TestBackfillIdentityMatch:
+
+    def test_split_chunks(self):
+        assert split_chunks('20250128', '20250203', 3) == [
+            ('20250128', '20250130'), ('20250131', '20250202'), ('20250203', '20250203')
+        ]
+        with pytest.raises(ValueError):
+            split_chunks('20250203', '20250128', 3)
+
+    def test_parallel_matches_serial(self, events):
+        serial, parallel = create_helper(events), create_helper(events)
+        try:
+            backfill(serial, workers=1).run('20250601', '20250612', chunk_days=1)
+            backfill(parallel, workers=4).run('20250601', '20250612', chunk_days=4)
+
+            expected = identity_tables(serial)
+            assert len(expected['identity_match']) > 0
+            assert len(expected['identity_match_run_state']) == DAYS
+            assert identity_tables(parallel) == expected
+        finally:
+            serial.delete_dataset()
+            parallel.delete_dataset()
+
+    def test_concurrency_is_bounded(self, helper):
+        client = RecordingClient(helper.client)
+        backfill(helper, client, workers=3).run('20250601', '20250612', chunk_days=2)
+
+        assert len(client.calls) == 6
+        assert 1 < client.max_active <= 3
+        assert len(rows(helper, 'identity_match_run_state', 'shard_suffix')) == DAYS
+
+    def test_resumes_from_progress_file(self, helper, tmp_path):
+        progress_file = str(tmp_path / 'progress.json')
+        with open(progress_file, 'w') as f:
+            json.dump({'completed': ['20250601_20250604']}, f)
+
+        client = RecordingClient(helper.client)
+        chunks = backfill(helper, client, progress=BackfillProgress(progress_file)).run(
+            '20250601', '20250612', chunk_days=4)
+
+        assert chunks == [('20250605', '20250608'), ('20250609', '20250612')]
+        assert sorted(client.calls) == chunks
+        assert rows(helper, 'identity_match_run_state', 'shard_suffix')[0] == ('20250605',)
+        with open(progress_file, 'r') as f:
+            assert len(json.load(f)['completed']) == 3
+
+        # a finished backfill has nothing left to run
+        assert backfill(helper, client, progress=BackfillProgress(progress_file)).run(
+            '20250601', '20250612', chunk_days=4) == []
+
+    def test_failed_chunk_is_resumed(self, helper, tmp_path):
+        progress_file = str(tmp_path / 'progress.json')
+        client = RecordingClient(helper.client)
+        client.failures = {('20250601', '20250606')}
+
+        with pytest.raises(BadRequest):
+            backfill(helper, client, workers=1, progress=BackfillProgress(progress_file)).run(
+                '20250601', '20250612', chunk_days=6)
+        assert lease_holders(helper) == []
+
+        # the failed chunk is not marked done and runs again on resume
+        chunks = backfill(helper, client, workers=1, progress=BackfillProgress(progress_file)).run(
+            '20250601', '20250612', chunk_days=6)
+        assert ('20250601', '20250606') in chunks
+        assert len(rows(helper, 'identity_match_run_state', 'shard_suffix')) == DAYS
+
+    def test_lease_held_by_another_run(self, helper):
+        helper.client.query(
+            f"CALL `{helper.project}.{helper.dataset}.acquire_identity_match_lease`("
+            f"'update_identity_match:{helper.project}.{helper.dataset}', 'identity_match_20250701_0', 900)"
+        ).result()
+        client = RecordingClient(helper.client)
+
+        with pytest.raises(LeaseUnavailable):
+            backfill(helper, client).run('20250601', '20250612')
+        assert client.calls == []
+        assert lease_holders(helper) == [('identity_match_20250701_0',)]
+
+    def test_lease_released_after_backfill(self, helper):
+        backfill(helper).run('20250601', '20250612')
+
+        assert lease_holders(helper) == []
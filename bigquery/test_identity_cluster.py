@@ -0,0 +1,56 @@
+import random
+
+from bigquery.identity_cluster import IdentityClusters, history_links, node_key
+
+
+def random_links(rng, count, nodes=40):
+    node_types = ['email', 'ga_id', 'fb_id']
+    return [
+        (node_key('email', rng.randrange(nodes)), node_key(rng.choice(node_types[1:]), rng.randrange(nodes)))
+        for _ in range(count)
+    ]
+
+
+class TestIdentityCluster:
+
+    def test_device_shared_by_two_emails(self):
+        links = history_links(
+            identity_history=[
+                {'hashed_email': 'b', 'ga_id': 'ga_1'},
+                {'hashed_email': 'a', 'ga_id': 'ga_1'},
+                {'hashed_email': 'c', 'ga_id': 'ga_2'},
+            ],
+            alternate_history=[
+                {'hashed_email': 'c', 'alternate_id_type': 'fb_id', 'alternate_id': 'fb_1'},
+            ]
+        )
+        clusters = IdentityClusters()
+        clusters.add_links(links)
+
+        assert clusters.clusters() == {
+            'email:a': 'email:a', 'email:b': 'email:a', 'ga_id:ga_1': 'email:a',
+            'email:c': 'email:c', 'ga_id:ga_2': 'email:c', 'fb_id:fb_1': 'email:c',
+        }
+
+    def test_add_links_returns_moved_nodes(self):
+        clusters = IdentityClusters({'email:b': 'email:b', 'ga_id:ga_1': 'email:b', 'email:c': 'email:c'})
+
+        moved = clusters.add_links([('email:a', 'ga_id:ga_1'), ('email:c', 'fb_id:fb_1')])
+
+        assert moved == {'email:a': 'email:a', 'email:b': 'email:a', 'ga_id:ga_1': 'email:a',
+                         'fb_id:fb_1': 'email:c'}
+
+    def test_incremental_matches_full_recompute(self):
+        rng = random.Random(0)
+        days = [random_links(rng, 15) for _ in range(10)]
+
+        incremental = IdentityClusters()
+        for links in days:
+            # each day starts from the stored cluster ids, as the procedure does
+            incremental = IdentityClusters(incremental.clusters())
+            incremental.add_links(links)
+
+        full = IdentityClusters()
+        full.add_links([link for links in reversed(days) for link in links])
+
+        assert incremental.clusters() == full.clusters()
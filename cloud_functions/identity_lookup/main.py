@@ -0,0 +1,349 @@
+import os
+import json
+import gzip
+import base64
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from google.cloud import bigquery
+import functions_framework
+
+# key types a lookup can be made by: emails, GA client IDs and the
+# alternate_id_type values of alternate_identity_match
+KEY_TYPES = (
+    'hashed_email', 'ga_id', 'floodlight_id', 'gads_id', 'floodlight_gads_id', 'fb_id', 'tiktok_id', 'reddit_id',
+    'rws_id'
+)
+
+# most keys in one batch lookup
+MAX_BATCH_SIZE = 1000
+
+# most keys in a snapshot. An index takes about 450 bytes per key and a
+# lookup instance holds two while it reads a new snapshot, so a 2G instance
+# runs out of memory not far above this
+SNAPSHOT_MAX_KEYS = 1500000
+
+# one row per link, the cluster of the email from identity_cluster when it
+# has one, otherwise the email is a cluster of its own
+SNAPSHOT_QUERY = """
+SELECT
+  IFNULL(identity_cluster.cluster_id, CONCAT('email:', links.hashed_email)) AS cluster_id,
+  links.hashed_email,
+  links.id_type,
+  links.id
+FROM (
+  SELECT hashed_email, 'ga_id' AS id_type, ga_id AS id
+  FROM `{project_id}.{dataset_id}.identity_match`
+  UNION ALL
+  SELECT hashed_email, alternate_id_type, current_alternate_id
+  FROM `{project_id}.{dataset_id}.alternate_identity_match`
+) links
+LEFT JOIN `{project_id}.{dataset_id}.identity_cluster` identity_cluster
+ON identity_cluster.node_type = 'email'
+  AND identity_cluster.node_id = links.hashed_email
+"""
+
+# created on first use and reused by later invocations on the same instance
+_client = None
+_index = None
+# whether a thread is reading a new snapshot, guarded by _lock
+_loading = False
+_lock = threading.Condition()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = bigquery.Client()
+    return _client
+
+
+class LRUCache:
+    """Least recently used cache whose entries expire ttl seconds after they are set."""
+
+    def __init__(self, max_size=10000, ttl=300, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= self.clock():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+def build_snapshot(rows, created_at=None):
+    """
+    Groups (cluster_id, hashed_email, id_type, id) rows into the snapshot:
+    {"created_at": ..., "clusters": [{"cluster_id", "hashed_emails", "ga_ids", "alternate_ids"}]}.
+    """
+    clusters = {}
+    for row in rows:
+        cluster = clusters.setdefault(row['cluster_id'], {
+            'cluster_id': row['cluster_id'], 'hashed_emails': set(), 'ga_ids': set(), 'alternate_ids': {}
+        })
+        cluster['hashed_emails'].add(row['hashed_email'])
+        if row['id'] is None:
+            continue
+        if row['id_type'] == 'ga_id':
+            cluster['ga_ids'].add(row['id'])
+        else:
+            cluster['alternate_ids'].setdefault(row['id_type'], set()).add(row['id'])
+
+    return {
+        'created_at': (created_at or datetime.now(timezone.utc)).isoformat(),
+        'clusters': [{
+            'cluster_id': cluster['cluster_id'],
+            'hashed_emails': sorted(cluster['hashed_emails']),
+            'ga_ids': sorted(cluster['ga_ids']),
+            'alternate_ids': {
+                id_type: sorted(ids) for id_type, ids in sorted(cluster['alternate_ids'].items())
+            }
+        } for cluster in clusters.values()]
+    }
+
+
+def snapshot_keys(snapshot):
+    """Number of keys the lookup indexes of a snapshot: its emails, ga_ids and alternate ids."""
+    return sum(
+        len(cluster['hashed_emails']) + len(cluster['ga_ids'])
+        + sum(len(ids) for ids in cluster['alternate_ids'].values())
+        for cluster in snapshot['clusters']
+    )
+
+
+def write_snapshot(snapshot, uri):
+    """Writes the snapshot as gzipped JSON to a local path or gs://bucket/path."""
+    data = gzip.compress(json.dumps(snapshot, separators=(',', ':')).encode())
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        bucket, path = uri[5:].split('/', 1)
+        blob = storage.Client().bucket(bucket).blob(path)
+        # read by snapshot_created_at without downloading the snapshot
+        blob.metadata = {'created_at': snapshot['created_at']}
+        blob.upload_from_string(data, content_type='application/gzip')
+    else:
+        with open(uri, 'wb') as f:
+            f.write(data)
+
+
+def read_snapshot(uri):
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        bucket, path = uri[5:].split('/', 1)
+        data = storage.Client().bucket(bucket).blob(path).download_as_bytes()
+    else:
+        with open(uri, 'rb') as f:
+            data = f.read()
+    return json.loads(gzip.decompress(data))
+
+
+def snapshot_created_at(uri):
+    """When the tables of the snapshot at uri were read, or None if there is no snapshot."""
+    if uri.startswith('gs://'):
+        from google.cloud import storage
+        bucket, path = uri[5:].split('/', 1)
+        blob = storage.Client().bucket(bucket).get_blob(path)
+        created_at = (blob.metadata or {}).get('created_at') if blob is not None else None
+    else:
+        created_at = read_snapshot(uri)['created_at'] if os.path.exists(uri) else None
+    return datetime.fromisoformat(created_at) if created_at else None
+
+
+class IdentityIndex:
+    """
+    Forward (cluster) and reverse (hashed_email, ga_id, alternate id to
+    cluster) indexes over a snapshot, with an LRU+TTL cache of responses.
+    """
+
+    def __init__(self, snapshot, cache=None, loaded_at=None):
+        self.created_at = snapshot['created_at']
+        self.loaded_at = loaded_at if loaded_at is not None else time.monotonic()
+        self.clusters = snapshot['clusters']
+        self.cache = cache or LRUCache()
+        self.keys = {}
+        for position, cluster in enumerate(self.clusters):
+            for hashed_email in cluster['hashed_emails']:
+                self.keys[('hashed_email', hashed_email)] = position
+            for ga_id in cluster['ga_ids']:
+                self.keys[('ga_id', ga_id)] = position
+            for id_type, ids in cluster['alternate_ids'].items():
+                for alternate_id in ids:
+                    self.keys[(id_type, alternate_id)] = position
+
+    def lookup(self, key_type, key):
+        """The cluster linked to a key, e.g. ('fb_id', 'FB_1'), or found=False."""
+        response = self.cache.get((key_type, key))
+        if response is None:
+            position = self.keys.get((key_type, key))
+            response = {'type': key_type, 'id': key, 'found': position is not None}
+            if position is not None:
+                response.update(self.clusters[position])
+            self.cache.set((key_type, key), response)
+        return response
+
+    def lookup_batch(self, keys):
+        return [self.lookup(key_type, key) for key_type, key in keys]
+
+
+def get_index():
+    """
+    The index of the snapshot at SNAPSHOT_URI, read again once it is
+    SNAPSHOT_TTL_SECONDS old so instances pick up new snapshots.
+
+    One thread reads the new snapshot, outside the lock, while the others
+    keep serving the index they have. Only requests on an instance without
+    an index wait for it.
+    """
+    global _index, _loading
+    ttl = int(os.environ.get('SNAPSHOT_TTL_SECONDS', '900'))
+    with _lock:
+        while _index is None and _loading:
+            _lock.wait()
+        if _index is not None and (_loading or time.monotonic() - _index.loaded_at <= ttl):
+            return _index
+        _loading = True
+
+    try:
+        cache = LRUCache(
+            max_size=int(os.environ.get('CACHE_SIZE', '10000')),
+            ttl=int(os.environ.get('CACHE_TTL_SECONDS', '300'))
+        )
+        index = IdentityIndex(read_snapshot(os.environ['SNAPSHOT_URI']), cache=cache)
+    except Exception:
+        with _lock:
+            _loading = False
+            _lock.notify_all()
+        raise
+
+    with _lock:
+        _index, _loading = index, False
+        _lock.notify_all()
+    print(f"Loaded snapshot created at {index.created_at}: {len(index.clusters)} clusters")
+    return index
+
+
+def parse_keys(request):
+    """[(type, id)] from ?type=&id= or a JSON body {"keys": [{"type": ..., "id": ...}]}."""
+    if request.method == 'GET':
+        keys = [{'type': request.args.get('type'), 'id': request.args.get('id')}]
+    else:
+        keys = (request.get_json(silent=True) or {}).get('keys')
+        if not isinstance(keys, list):
+            raise ValueError("Expected a JSON body with a list of keys")
+    if len(keys) > MAX_BATCH_SIZE:
+        raise ValueError(f"At most {MAX_BATCH_SIZE} keys per lookup")
+    parsed = []
+    for key in keys:
+        if not isinstance(key, dict) or not key.get('type') or not key.get('id'):
+            raise ValueError(f"Each key needs a type and an id, got {key}")
+        if key['type'] not in KEY_TYPES:
+            raise ValueError(f"Unknown key type {key['type']}, expected one of {', '.join(KEY_TYPES)}")
+        parsed.append((key['type'], key['id']))
+    return parsed
+
+
+@functions_framework.http
+def identity_lookup(request):
+    """Looks up the hashed emails and linked platform IDs of one key (GET) or a batch (POST)."""
+    try:
+        keys = parse_keys(request)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    index = get_index()
+    return {'snapshot_created_at': index.created_at, 'results': index.lookup_batch(keys)}
+
+
+def get_completed_job(cloud_event):
+    """
+    Returns (job_id, ended_at, failed, query) of the BigQueryAuditMetadata
+    jobChange entry in the job completion log sink message, or Nones.
+    """
+    message = (cloud_event.data or {}).get('message', {})
+    if not message.get('data'):
+        return None, None, None, None
+    job = (json.loads(base64.b64decode(message['data']))
+           .get('protoPayload', {}).get('metadata', {}).get('jobChange', {}).get('job', {}))
+    job_name = job.get('jobName', '')
+    if '/jobs/' not in job_name:
+        return None, None, None, None
+
+    end_time = job.get('jobStats', {}).get('endTime')
+    ended_at = datetime.fromisoformat(end_time.replace('Z', '+00:00')) if end_time else None
+    return (job_name.rsplit('/jobs/', 1)[1], ended_at, bool(job.get('jobStatus', {}).get('errorResult')),
+            job.get('jobConfig', {}).get('queryConfig', {}).get('query', ''))
+
+
+def changes_identities(job_id, dataset_id, query=''):
+    """
+    Whether the job is a daily or catch-up update_identity_match run, a
+    backfill chunk or the compact_identity_match scheduled query, which
+    deletes the archived links. Intraday runs are left out, their links are
+    in the snapshot written after the daily run of the day.
+    """
+    if not job_id:
+        return False
+    if job_id.startswith(f"backfill_{dataset_id}_"):
+        return True
+    if job_id.startswith('scheduled_query_'):
+        return f".{dataset_id}.compact_identity_match`" in query
+    prefix = f"identity_match_{dataset_id}_"
+    return job_id.startswith(prefix) and '_intraday_' not in job_id[len(prefix):]
+
+
+@functions_framework.cloud_event
+def identity_lookup_snapshot(cloud_event):
+    """
+    Triggered by Pub/Sub message from the identity_match job completion log
+    sink. Writes a new snapshot of the identity tables to SNAPSHOT_URI after
+    a successful daily run, backfill chunk or compaction, unless the current
+    snapshot was taken after the job finished and already reflects it.
+
+    A snapshot over SNAPSHOT_MAX_KEYS is not written, the lookup instances
+    keep serving the last one rather than running out of memory reading it.
+    """
+    project_id = os.environ.get('PROJECT_ID')
+    dataset_id = os.environ.get('DATASET_ID')
+    uri = os.environ['SNAPSHOT_URI']
+
+    job_id, ended_at, failed, job_query = get_completed_job(cloud_event)
+    if failed or not changes_identities(job_id, dataset_id, job_query):
+        return {'status': 'skipped', 'job_id': job_id}
+    created_at = snapshot_created_at(uri)
+    if created_at is not None and ended_at is not None and created_at >= ended_at:
+        return {'status': 'current', 'job_id': job_id, 'created_at': created_at.isoformat()}
+
+    # taken before the query, so a job that ended before it is in the snapshot
+    created_at = datetime.now(timezone.utc)
+    query = SNAPSHOT_QUERY.format(project_id=project_id, dataset_id=dataset_id)
+    rows = get_client().query(query).result(page_size=100000)
+    snapshot = build_snapshot(rows, created_at=created_at)
+    keys = snapshot_keys(snapshot)
+    max_keys = int(os.environ.get('SNAPSHOT_MAX_KEYS', SNAPSHOT_MAX_KEYS))
+    if keys > max_keys:
+        print(json.dumps({
+            'severity': 'ERROR',
+            'message': f"Snapshot of {keys} keys is over SNAPSHOT_MAX_KEYS ({max_keys}), not written to {uri}",
+        }))
+        return {'status': 'too_large', 'job_id': job_id, 'keys': keys}
+    write_snapshot(snapshot, uri)
+
+    print(f"Snapshot of {len(snapshot['clusters'])} clusters written to {uri}")
+    return {'status': 'written', 'uri': uri, 'clusters': len(snapshot['clusters'])}
@@ -0,0 +1,249 @@
+import os
+import json
+import base64
+import threading
+import importlib.util
+import pytest
+from datetime import datetime, timezone
+from flask import Flask
+from cloudevents.http import CloudEvent
+
+# loaded under its own name, cloud_functions/identity_match also has a main module
+spec = importlib.util.spec_from_file_location(
+    'identity_lookup_main', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'))
+main = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(main)
+
+EMAIL_A = 'a665a45920422f9d417e4867efdc4fb8a04a1f3fff1fa07e998e86f7f7a27ae3'
+EMAIL_B = 'b493d48364afe44d11c0165cf470a4164d1e2609911ef998be868d46ade3de4e'
+EMAIL_C = 'c6ba91b90d922ef159e69e70a15f7f367aea416f7a4befd396439fe24b3a5f5e'
+
+# two emails seen on the same device are one cluster
+ROWS = [
+    {'cluster_id': f'email:{EMAIL_A}', 'hashed_email': EMAIL_A, 'id_type': 'ga_id', 'id': '1234567890.0987654321'},
+    {'cluster_id': f'email:{EMAIL_A}', 'hashed_email': EMAIL_A, 'id_type': 'fb_id', 'id': 'FB_1234567890'},
+    {'cluster_id': f'email:{EMAIL_A}', 'hashed_email': EMAIL_B, 'id_type': 'ga_id', 'id': '1234567890.0987654321'},
+    {'cluster_id': f'email:{EMAIL_A}', 'hashed_email': EMAIL_B, 'id_type': 'ga_id', 'id': '2222222222.1111111111'},
+    {'cluster_id': f'email:{EMAIL_C}', 'hashed_email': EMAIL_C, 'id_type': 'rws_id', 'id': 'RWS_USER_456'},
+]
+
+app = Flask(__name__)
+
+
+def job_completed_event(job_id, end_time='2025-06-08T01:00:00.123Z', error=None,
+                        query='CALL `update_identity_match`()'):
+    """BigQueryAuditMetadata jobChange entry for a finished job, as sent by the job completion sink."""
+    job = {
+        'jobName': f'projects/nzaa-mkt-guid/jobs/{job_id}',
+        'jobConfig': {'type': 'QUERY', 'queryConfig': {'query': query}},
+        'jobStatus': {'jobState': 'DONE', **({'errorResult': {'message': error}} if error else {})},
+        'jobStats': {'endTime': end_time},
+    }
+    log_entry = {
+        'resource': {'type': 'bigquery_project', 'labels': {'project_id': 'nzaa-mkt-guid'}},
+        'protoPayload': {'metadata': {'jobChange': {'after': 'DONE', 'job': job}}}
+    }
+    return CloudEvent(
+        {'type': 'google.cloud.pubsub.topic.v1.messagePublished', 'source': 'test'},
+        {'message': {'data': base64.b64encode(json.dumps(log_entry).encode()).decode()}}
+    )
+
+
+class StubJob:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self, page_size=None):
+        return self.rows
+
+
+class StubClient:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def query(self, sql, **kwargs):
+        self.queries.append(sql)
+        return StubJob(self.rows)
+
+
+class TestIdentityLookup:
+
+    @pytest.fixture
+    def snapshot_uri(self, tmp_path, monkeypatch):
+        uri = str(tmp_path / 'snapshot.json.gz')
+        main.write_snapshot(main.build_snapshot(ROWS, created_at=datetime(2025, 6, 8, tzinfo=timezone.utc)), uri)
+        monkeypatch.setattr(main, '_index', None)
+        monkeypatch.setenv('SNAPSHOT_URI', uri)
+        return uri
+
+    def lookup(self, **kwargs):
+        with app.test_request_context('/', **kwargs) as context:
+            return main.identity_lookup(context.request)
+
+    def test_snapshot_round_trip(self, snapshot_uri):
+        snapshot = main.read_snapshot(snapshot_uri)
+
+        assert snapshot['created_at'] == '2025-06-08T00:00:00+00:00'
+        assert snapshot['clusters'] == [{
+            'cluster_id': f'email:{EMAIL_A}',
+            'hashed_emails': [EMAIL_A, EMAIL_B],
+            'ga_ids': ['1234567890.0987654321', '2222222222.1111111111'],
+            'alternate_ids': {'fb_id': ['FB_1234567890']},
+        }, {
+            'cluster_id': f'email:{EMAIL_C}',
+            'hashed_emails': [EMAIL_C],
+            'ga_ids': [],
+            'alternate_ids': {'rws_id': ['RWS_USER_456']},
+        }]
+
+    def test_lookup_by_ga_id(self, snapshot_uri):
+        response = self.lookup(query_string={'type': 'ga_id', 'id': '2222222222.1111111111'})
+
+        result = response['results'][0]
+        assert result['found']
+        assert result['hashed_emails'] == [EMAIL_A, EMAIL_B]
+        assert result['alternate_ids'] == {'fb_id': ['FB_1234567890']}
+
+    def test_batch_lookup(self, snapshot_uri):
+        response = self.lookup(method='POST', json={'keys': [
+            {'type': 'fb_id', 'id': 'FB_1234567890'},
+            {'type': 'hashed_email', 'id': EMAIL_C},
+            {'type': 'ga_id', 'id': 'unknown'},
+        ]})
+
+        assert response['snapshot_created_at'] == '2025-06-08T00:00:00+00:00'
+        assert [result['found'] for result in response['results']] == [True, True, False]
+        assert response['results'][0]['cluster_id'] == f'email:{EMAIL_A}'
+        assert response['results'][1]['alternate_ids'] == {'rws_id': ['RWS_USER_456']}
+
+    def test_invalid_lookup(self, snapshot_uri):
+        response, status = self.lookup(query_string={'type': 'phone', 'id': '021'})
+        assert status == 400
+
+        response, status = self.lookup(method='POST', json={'keys': [{'type': 'ga_id', 'id': 'x'}] * 1001})
+        assert status == 400
+
+    def test_snapshot_read_once_per_ttl(self, snapshot_uri, monkeypatch):
+        reads = []
+        read_snapshot = main.read_snapshot
+        monkeypatch.setattr(main, 'read_snapshot', lambda uri: reads.append(uri) or read_snapshot(uri))
+
+        self.lookup(query_string={'type': 'ga_id', 'id': '1234567890.0987654321'})
+        self.lookup(query_string={'type': 'ga_id', 'id': '1234567890.0987654321'})
+        assert len(reads) == 1
+        assert main._index.cache.hits == 1
+
+        monkeypatch.setenv('SNAPSHOT_TTL_SECONDS', '-1')
+        self.lookup(query_string={'type': 'ga_id', 'id': '1234567890.0987654321'})
+        assert len(reads) == 2
+
+    def test_lookups_served_while_snapshot_is_read(self, snapshot_uri, monkeypatch):
+        index = main.get_index()
+        reading, release = threading.Event(), threading.Event()
+        read_snapshot = main.read_snapshot
+
+        def slow_read(uri):
+            reading.set()
+            release.wait(5)
+            return read_snapshot(uri)
+
+        monkeypatch.setattr(main, 'read_snapshot', slow_read)
+        monkeypatch.setenv('SNAPSHOT_TTL_SECONDS', '-1')
+        reload = threading.Thread(target=main.get_index)
+        reload.start()
+        assert reading.wait(5)
+
+        # the lock is not held while the new snapshot is read
+        assert main.get_index() is index
+        release.set()
+        reload.join(5)
+        assert main._index is not index
+        assert not main._loading
+
+    def test_lru_cache_eviction_and_ttl(self):
+        now = [0]
+        cache = main.LRUCache(max_size=2, ttl=10, clock=lambda: now[0])
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        # b was the least recently used
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+
+        now[0] = 10
+        assert cache.get('a') is None
+        assert cache.get('c') is None
+
+    @pytest.fixture
+    def snapshot_function(self, tmp_path, monkeypatch):
+        client = StubClient(ROWS)
+        monkeypatch.setattr(main, '_client', client)
+        monkeypatch.setenv('PROJECT_ID', 'nzaa-mkt-guid')
+        monkeypatch.setenv('DATASET_ID', 'identity_resolution_test')
+        monkeypatch.setenv('SNAPSHOT_URI', str(tmp_path / 'snapshot.json.gz'))
+        return client
+
+    def test_snapshot_function_writes_snapshot(self, snapshot_function):
+        uri = os.environ['SNAPSHOT_URI']
+        event = job_completed_event('identity_match_identity_resolution_test_nzaa-datasets_analytics_1_20250607_0')
+        result = main.identity_lookup_snapshot(event)
+
+        assert result == {'status': 'written', 'uri': uri, 'clusters': 2}
+        assert '`nzaa-mkt-guid.identity_resolution_test.identity_cluster`' in snapshot_function.queries[0]
+        assert len(main.read_snapshot(uri)['clusters']) == 2
+        assert main.snapshot_created_at(uri) > datetime(2025, 6, 8, 1, tzinfo=timezone.utc)
+
+    def test_snapshot_function_skips_jobs_without_new_links(self, snapshot_function):
+        for event in [
+            job_completed_event('identity_match_identity_resolution_test_nzaa-datasets_analytics_1_intraday_42_0'),
+            job_completed_event('identity_match_identity_resolution_test_nzaa-datasets_analytics_1_20250607_0',
+                                error='Query exceeded limit for bytes billed'),
+            job_completed_event('identity_match_other_dataset_nzaa-datasets_analytics_1_20250607_0'),
+            job_completed_event('scheduled_query_6512f0a3-0000-2f1e-a6c8-14223bc3ac2e',
+                                query='SELECT COUNT(*) FROM `nzaa-mkt-guid.identity_resolution_test.identity_match`'),
+            CloudEvent({'type': 'google.cloud.pubsub.topic.v1.messagePublished', 'source': 'test'}, {}),
+        ]:
+            assert main.identity_lookup_snapshot(event)['status'] == 'skipped'
+        assert snapshot_function.queries == []
+        assert not os.path.exists(os.environ['SNAPSHOT_URI'])
+
+    def test_snapshot_function_skips_jobs_in_current_snapshot(self, snapshot_function):
+        uri = os.environ['SNAPSHOT_URI']
+        main.write_snapshot(main.build_snapshot(ROWS, created_at=datetime(2025, 6, 8, 2, tzinfo=timezone.utc)), uri)
+
+        # backfill chunks that ended before the snapshot was taken are in it
+        chunk = 'backfill_identity_resolution_test_nzaa-datasets_analytics_1_20250601_20250607_3f2a'
+        assert main.identity_lookup_snapshot(job_completed_event(chunk))['status'] == 'current'
+        assert snapshot_function.queries == []
+
+        result = main.identity_lookup_snapshot(job_completed_event(chunk, end_time='2025-06-08T03:00:00Z'))
+        assert result['status'] == 'written'
+        assert len(snapshot_function.queries) == 1
+
+    def test_snapshot_function_writes_snapshot_after_compaction(self, snapshot_function):
+        uri = os.environ['SNAPSHOT_URI']
+        main.write_snapshot(main.build_snapshot(ROWS, created_at=datetime(2025, 6, 8, tzinfo=timezone.utc)), uri)
+
+        # the compaction deleted archived links, a snapshot before it still serves them
+        event = job_completed_event(
+            'scheduled_query_6512f0a3-0000-2f1e-a6c8-14223bc3ac2e',
+            query='CALL `nzaa-mkt-guid.identity_resolution_test.compact_identity_match`(90)'
+        )
+        assert main.identity_lookup_snapshot(event)['status'] == 'written'
+        assert main.snapshot_created_at(uri) > datetime(2025, 6, 8, 1, tzinfo=timezone.utc)
+
+    def test_snapshot_function_refuses_snapshot_over_max_keys(self, snapshot_function, monkeypatch):
+        uri = os.environ['SNAPSHOT_URI']
+        main.write_snapshot(main.build_snapshot(ROWS, created_at=datetime(2025, 6, 8, tzinfo=timezone.utc)), uri)
+        event = job_completed_event('identity_match_identity_resolution_test_nzaa-datasets_analytics_1_20250607_0')
+
+        # 3 emails, 2 ga_ids, 1 fb_id and 1 rws_id
+        assert main.snapshot_keys(main.build_snapshot(ROWS)) == 7
+        monkeypatch.setenv('SNAPSHOT_MAX_KEYS', '6')
+        result = main.identity_lookup_snapshot(event)
+
+        assert result['status'] == 'too_large' and result['keys'] == 7
+        assert main.snapshot_created_at(uri) == datetime(2025, 6, 8, tzinfo=timezone.utc)
@@ -1,31 +1,482 @@
 import os
+import re
+import json
+import base64
+from concurrent import futures
+from google.api_core.exceptions import Conflict, NotFound
 from google.cloud import bigquery
 import functions_framework
 
+# daily GA4 export shards, e.g. events_20250607 (not events_intraday_*)
+EVENTS_TABLE_PATTERN = re.compile(r'^events_(\d{8})$')
+
+# table resource name in BigQueryAuditMetadata log entries
+RESOURCE_NAME_PATTERN = re.compile(r'^projects/([^/]+)/datasets/([^/]+)/tables/([^/]+)$')
+
+# suffix range of the events_intraday_* tables under events_*, read by
+# intraday runs from the Cloud Scheduler job
+INTRADAY_SUFFIXES = ('intraday_', 'intraday_99999999')
+
+# jobs whose stats are logged: the function's runs and backfill chunks
+STATS_JOB_PREFIXES = ('identity_match_', 'backfill_')
+
+# number of failed jobs for one shard before giving up on it
+MAX_ATTEMPTS = 5
+
+# BigQuery starts a queued BATCH job within 24 hours, a BATCH run holds its
+# lease for that long on top of lease_seconds
+BATCH_QUEUE_SECONDS = 24 * 60 * 60
+
+# Dry-run queries estimating the bytes of each stage of a run. The extraction
+# reads the same events_* columns and shards as the procedure. The write
+# stages are estimated as scans of the identity tables they join, which the
+# procedure prunes to the email_bucket partitions of the run's emails, so
+# their estimates are an upper bound.
+EXTRACT_ESTIMATE_QUERY = """
+SELECT event_params, user_pseudo_id, event_date, event_timestamp
+FROM `{source}.events_*`
+WHERE _TABLE_SUFFIX BETWEEN @start_suffix AND @end_suffix
+  AND _TABLE_SUFFIX > @high_water_mark
+"""
+WRITE_STAGE_TABLES = {
+    'merge_identity_match': 'identity_match',
+    'merge_alternate_identity_match': 'alternate_identity_match',
+    'update_identity_cluster': 'identity_cluster',
+}
+
+# created on first use and reused by later invocations on the same instance
+_client = None
+
+
+class LeaseUnavailable(Exception):
+    """Another update_identity_match job holds the lease, the message is retried."""
+
+
+def get_budget():
+    """
+    Returns (bytes_budget, action, maximum_bytes_billed) from RUN_BYTES_BUDGET,
+    OVER_BUDGET_ACTION and MAX_BYTES_BILLED. A budget of 0 disables it.
+    """
+    action = os.environ.get('OVER_BUDGET_ACTION', 'batch')
+    if action not in ('batch', 'refuse'):
+        raise ValueError(f"OVER_BUDGET_ACTION must be batch or refuse, got {action}")
+    return (int(os.environ.get('RUN_BYTES_BUDGET', '0')), action,
+            int(os.environ.get('MAX_BYTES_BILLED', '0')) or None)
+
+
+def get_client():
+    global _client
+    if _client is None:
+        # get_job only finds jobs in the client's location, the runs are in REGION
+        _client = bigquery.Client(location=os.environ.get('REGION'))
+    return _client
+
+
+def get_log_entry(cloud_event):
+    """Returns the log entry in the log sink message, or None."""
+    message = (cloud_event.data or {}).get('message', {})
+    if not message.get('data'):
+        return None
+    return json.loads(base64.b64decode(message['data']))
+
+
+def get_mode(cloud_event):
+    """Returns the mode attribute of the Pub/Sub message, 'intraday' from the scheduler, or None."""
+    message = (cloud_event.data or {}).get('message', {})
+    return (message.get('attributes') or {}).get('mode')
+
+
+def get_table_ref(cloud_event):
+    """Returns (dataset, table) of the BigQuery table named in the log sink message, or None."""
+    log_entry = get_log_entry(cloud_event)
+    if log_entry is None:
+        return None
+    payload = log_entry.get('protoPayload', {})
+
+    # legacy BigQuery audit log (jobservice.jobcompleted) for the export load job
+    load = (payload.get('serviceData', {})
+            .get('jobCompletedEvent', {})
+            .get('job', {})
+            .get('jobConfiguration', {})
+            .get('load', {}))
+    table = load.get('destinationTable', {})
+    if table.get('tableId'):
+        return f"{table.get('projectId')}.{table.get('datasetId')}", table['tableId']
+
+    # BigQueryAuditMetadata resource name, projects/{p}/datasets/{d}/tables/{t}
+    match = RESOURCE_NAME_PATTERN.match(payload.get('resourceName', ''))
+    if match:
+        return f"{match.group(1)}.{match.group(2)}", match.group(3)
+
+    return None
+
+
+def get_table_name(cloud_event):
+    """Returns the BigQuery table named in the log sink message, or None."""
+    table_ref = get_table_ref(cloud_event)
+    return table_ref[1] if table_ref else None
+
+
+def get_completed_job(cloud_event):
+    """Returns (job_id, location) of the job in the job completion log sink message, or (None, None)."""
+    log_entry = get_log_entry(cloud_event)
+    if log_entry is None:
+        return None, None
+    payload = log_entry.get('protoPayload', {})
+    location = log_entry.get('resource', {}).get('labels', {}).get('location')
+
+    # legacy BigQuery audit log (jobservice.jobcompleted)
+    job_name = (payload.get('serviceData', {})
+                .get('jobCompletedEvent', {})
+                .get('job', {})
+                .get('jobName', {}))
+    if job_name.get('jobId'):
+        return job_name['jobId'], job_name.get('location') or location
+
+    # BigQueryAuditMetadata job name, projects/{p}/jobs/{job_id}
+    job_name = payload.get('metadata', {}).get('jobChange', {}).get('job', {}).get('jobName', '')
+    if '/jobs/' in job_name:
+        return job_name.rsplit('/jobs/', 1)[1], location
+
+    return None, None
+
+
+def job_stats(job):
+    """Cost and timing of a finished query job, for the structured job stats log."""
+    elapsed_ms = None
+    if job.started and job.ended:
+        elapsed_ms = int((job.ended - job.started).total_seconds() * 1000)
+    return {
+        'job_id': job.job_id,
+        'statement_type': job.statement_type,
+        'error': (job.error_result or {}).get('message'),
+        'total_bytes_processed': job.total_bytes_processed,
+        'total_bytes_billed': job.total_bytes_billed,
+        'slot_millis': job.slot_millis,
+        'cache_hit': job.cache_hit,
+        'num_dml_affected_rows': job.num_dml_affected_rows,
+        'started': job.started.isoformat() if job.started else None,
+        'elapsed_ms': elapsed_ms,
+    }
+
+
+def get_job_id(dataset_id, dedupe_key, attempt):
+    """Job ID for a run, the same for every trigger of the same shard."""
+    return f"identity_match_{dataset_id}_{dedupe_key}_{attempt}"
+
+
+def find_job_id(client, dataset_id, dedupe_key):
+    """
+    Returns (job_id, existing_job) for a trigger.
+
+    existing_job is the running or successful job with the dedupe key, which
+    the trigger coalesces into. Failed jobs are skipped so the next attempt
+    gets a fresh job ID. job_id is None once MAX_ATTEMPTS jobs failed.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        job_id = get_job_id(dataset_id, dedupe_key, attempt)
+        try:
+            job = client.get_job(job_id)
+        except NotFound:
+            return job_id, None
+        if job.state != 'DONE' or job.error_result is None:
+            return job_id, job
+    return None, None
+
+
+def acquire_lease(client, project_id, dataset_id, source, holder, lease_seconds):
+    """
+    Takes the single-flight lease of a source for holder, returns False if it is held.
+
+    Only one update_identity_match job runs at a time per GA4 property. The
+    lease row is taken here before the job is submitted and released by the
+    procedure.
+    """
+    query = f"CALL `{project_id}.{dataset_id}.acquire_identity_match_lease`(@lease_name, @holder, @lease_seconds)"
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('lease_name', 'STRING', f"update_identity_match:{source}"),
+        bigquery.ScalarQueryParameter('holder', 'STRING', holder),
+        bigquery.ScalarQueryParameter('lease_seconds', 'INT64', lease_seconds)
+    ])
+    rows = list(client.query(query, job_config=job_config).result())
+    return bool(rows) and rows[0]['acquired']
+
+
+def release_finished_holder(client, project_id, dataset_id, source):
+    """
+    Releases the lease of a source if the job holding it has finished, returns True if it did.
+
+    The procedure releases the lease when it ends, but a job cancelled or
+    failing before its script starts, e.g. while a BATCH job is queued,
+    never does. The lease then follows the holder job's state rather than
+    its expiry. A holder that is not a job yet is left to the expiry, it is
+    a trigger about to submit it.
+    """
+    query = f"SELECT holder FROM `{project_id}.{dataset_id}.identity_match_lease` WHERE lease_name = @lease_name"
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('lease_name', 'STRING', f"update_identity_match:{source}")
+    ])
+    for row in client.query(query, job_config=job_config).result():
+        try:
+            job = client.get_job(row['holder'])
+        except NotFound:
+            return False
+        if job.state == 'DONE':
+            print(f"Releasing the lease of {source} held by the finished job {row['holder']}")
+            release_lease(client, project_id, dataset_id, row['holder'])
+            return True
+    return False
+
+
+def release_lease(client, project_id, dataset_id, holder):
+    """Releases the leases of holder, for a job that was not submitted and would not release them."""
+    query = f"CALL `{project_id}.{dataset_id}.release_identity_match_lease`(@holder)"
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('holder', 'STRING', holder)
+    ])
+    client.query(query, job_config=job_config).result()
+
+
+def get_sources():
+    """GA4 export datasets (project.dataset) processed by the deployment, from GA4_DATASETS."""
+    return [source.strip() for source in os.environ.get('GA4_DATASETS', '').split(',') if source.strip()]
+
+
+def source_key(source):
+    """The source in a form allowed in job IDs, e.g. nzaa-datasets_analytics_291449711."""
+    return source.replace('.', '_')
+
+
 @functions_framework.cloud_event
 def identity_match(cloud_event):
     """Triggered by Pub/Sub message from GA4 export log sink."""
-    
+
     # Get environment variables
     project_id = os.environ.get('PROJECT_ID')
     dataset_id = os.environ.get('DATASET_ID')
-    
+    lease_seconds = int(os.environ.get('LEASE_SECONDS', '900'))
+    sources = get_sources()
+
     print(f"Function triggered - Project: {project_id}, Dataset: {dataset_id}")
-    
-    client = bigquery.Client()
-    
-    query = f"CALL `{project_id}.{dataset_id}.update_identity_match`()"
-    
+
+    if get_mode(cloud_event) == 'intraday':
+        return fan_out(cloud_event, project_id, dataset_id, sources, lease_seconds, mode='intraday')
+
+    # only process the shard that finished loading, when the message names one
+    table_ref = get_table_ref(cloud_event)
+    if table_ref is None:
+        print("No table in message, processing all shards after the last update")
+        return fan_out(cloud_event, project_id, dataset_id, sources, lease_seconds, mode='catchup')
+
+    source, table_name = table_ref
+    match = EVENTS_TABLE_PATTERN.match(table_name)
+    if not match:
+        print(f"Skipping {table_name}: not a daily events table")
+        return {'status': 'skipped', 'table': table_name}
+    if source not in sources:
+        print(f"Skipping {source}.{table_name}: not one of the GA4 datasets {', '.join(sources)}")
+        return {'status': 'skipped', 'table': table_name, 'source': source}
+    table_suffix = match.group(1)
+
+    # triggers for the same shard share a job ID
+    return run_source(get_client(), project_id, dataset_id, source, lease_seconds,
+                      table_suffix, table_suffix, f"{source_key(source)}_{table_suffix}")
+
+
+def fan_out(cloud_event, project_id, dataset_id, sources, lease_seconds, mode):
+    """
+    Submits a run per source on a pool of MAX_CONCURRENT_RUNS workers.
+
+    Catch-up runs read every daily shard after the source's high-water mark,
+    intraday runs its events_intraday_* tables. Runs are deduped on the
+    Pub/Sub message so only redeliveries coalesce. A source whose lease is
+    held makes a catch-up message be redelivered, the sources already
+    submitted then coalesce. An intraday tick skips it instead, the next
+    scheduled run picks up where the running job stops.
+    """
+    client = get_client()
+    suffixes = INTRADAY_SUFFIXES if mode == 'intraday' else (None, None)
+    workers = max(1, min(int(os.environ.get('MAX_CONCURRENT_RUNS', '4')), len(sources)))
+
+    def run(source):
+        dedupe_key = f"{source_key(source)}_{mode}_{cloud_event['id']}"
+        try:
+            return run_source(client, project_id, dataset_id, source, lease_seconds, *suffixes, dedupe_key)
+        except LeaseUnavailable as e:
+            if mode != 'intraday':
+                raise
+            print(e)
+            return {'status': 'skipped', 'source': source}
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = [executor.submit(run, source) for source in sources]
+        futures.wait(pending)
+    # raised once every source was tried, so the redelivery only retries the leased ones
+    runs = [future.result() for future in pending]
+    statuses = {run['status'] for run in runs}
+    status = next((status for status in ('submitted', 'coalesced', 'refused', 'failed') if status in statuses),
+                  'skipped')
+    return {'status': status, 'mode': mode, 'runs': runs}
+
+
+def dry_run_bytes(client, query, query_parameters=()):
+    """Bytes a query would process, from a dry run, which is not billed."""
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False,
+                                         query_parameters=list(query_parameters))
+    try:
+        return client.query(query, job_config=job_config).total_bytes_processed or 0
+    except NotFound:
+        # no events_ table of the source matches the suffix range
+        return 0
+
+
+def estimate_run(client, project_id, dataset_id, source, start_suffix, end_suffix):
+    """
+    Estimated bytes per stage of an update_identity_match run, from dry runs.
+
+    Without a suffix range the run reads every daily shard after the
+    source's high-water mark, which is read from the run state like the
+    procedure does.
+    """
+    high_water_mark = ''
+    if start_suffix is None:
+        query = (f"SELECT MAX(high_water_mark) AS high_water_mark "
+                 f"FROM `{project_id}.{dataset_id}.identity_match_run_state` WHERE source_dataset = @source_dataset")
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('source_dataset', 'STRING', source)
+        ])
+        rows = list(client.query(query, job_config=job_config).result())
+        high_water_mark = (rows[0]['high_water_mark'] if rows else None) or ''
+        start_suffix, end_suffix = '', '99999999'
+
+    estimates = {'extract_identity_events': dry_run_bytes(client, EXTRACT_ESTIMATE_QUERY.format(source=source), [
+        bigquery.ScalarQueryParameter('start_suffix', 'STRING', start_suffix),
+        bigquery.ScalarQueryParameter('end_suffix', 'STRING', end_suffix),
+        bigquery.ScalarQueryParameter('high_water_mark', 'STRING', high_water_mark)
+    ])}
+    for stage, table in WRITE_STAGE_TABLES.items():
+        estimates[stage] = dry_run_bytes(client, f"SELECT * FROM `{project_id}.{dataset_id}.{table}`")
+    return estimates
+
+
+def run_source(client, project_id, dataset_id, source, lease_seconds, start_suffix, end_suffix, dedupe_key):
+    """
+    Submits the update_identity_match job of a source and suffix range, unless it is already running.
+
+    The run is dry-run first. One estimated above RUN_BYTES_BUDGET is either
+    refused, or submitted at BATCH priority capped at MAX_BYTES_BILLED, with
+    its lease extended by the time the job may queue.
+    """
+    job_id, existing_job = find_job_id(client, dataset_id, dedupe_key)
+    # acknowledged, as a redelivery would only find the same failed jobs
+    if job_id is None:
+        print(json.dumps({
+            'severity': 'ERROR',
+            'message': f"update_identity_match failed {MAX_ATTEMPTS} times for {dedupe_key}, not retrying",
+            'dedupe_key': dedupe_key,
+            'source': source,
+        }))
+        return {'status': 'failed', 'source': source, 'table_suffix': start_suffix}
+    if existing_job:
+        print(f"Job {job_id} is {existing_job.state}, not starting another")
+        return {'status': 'coalesced', 'job_id': job_id, 'source': source, 'table_suffix': start_suffix}
+
+    budget, action, maximum_bytes_billed = get_budget()
+    estimates = estimate_run(client, project_id, dataset_id, source, start_suffix, end_suffix)
+    estimated_bytes = sum(estimates.values())
+    over_budget = budget > 0 and estimated_bytes > budget
+    print(json.dumps({
+        'severity': 'WARNING' if over_budget else 'INFO',
+        'message': f"update_identity_match job {job_id} is estimated at {estimated_bytes} bytes"
+                   + (f", over the budget of {budget} bytes, action {action}" if over_budget else ""),
+        'job_id': job_id,
+        'source': source,
+        'estimated_bytes': estimated_bytes,
+        'stage_estimated_bytes': estimates,
+        'bytes_budget': budget or None,
+    }))
+    result = {'source': source, 'table_suffix': start_suffix, 'estimated_bytes': estimated_bytes}
+
+    # acknowledged, a redelivery would be refused again
+    if over_budget and action == 'refuse':
+        return {'status': 'refused', 'job_id': job_id} | result
+
+    # a BATCH job can queue for hours, another run must not take the lease over meanwhile
+    if over_budget:
+        lease_seconds += BATCH_QUEUE_SECONDS
+
+    acquired = acquire_lease(client, project_id, dataset_id, source, job_id, lease_seconds)
+    if not acquired and release_finished_holder(client, project_id, dataset_id, source):
+        acquired = acquire_lease(client, project_id, dataset_id, source, job_id, lease_seconds)
+    # raising makes Pub/Sub redeliver the message once the lease is free
+    if not acquired:
+        raise LeaseUnavailable(f"update_identity_match is already running for {source}, {job_id} will be retried")
+
+    try:
+        if over_budget:
+            submitted = submit_job(client, project_id, dataset_id, job_id, source, start_suffix, end_suffix,
+                                   priority=bigquery.QueryPriority.BATCH, maximum_bytes_billed=maximum_bytes_billed)
+        else:
+            submitted = submit_job(client, project_id, dataset_id, job_id, source, start_suffix, end_suffix)
+    except Exception:
+        # the job was not created, so the lease would otherwise block the source until it expires
+        release_lease(client, project_id, dataset_id, job_id)
+        raise
+    return submitted | result
+
+
+def submit_job(client, project_id, dataset_id, job_id, source, start_suffix, end_suffix,
+               priority=bigquery.QueryPriority.INTERACTIVE, maximum_bytes_billed=None):
+    """Submits the update_identity_match job for a source and suffix range, the lease is already held."""
+    query = f"CALL `{project_id}.{dataset_id}.update_identity_match`(@start_suffix, @end_suffix, @source_dataset)"
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('start_suffix', 'STRING', start_suffix),
+        bigquery.ScalarQueryParameter('end_suffix', 'STRING', end_suffix),
+        bigquery.ScalarQueryParameter('source_dataset', 'STRING', source)
+    ], priority=priority)
+    if maximum_bytes_billed:
+        job_config.maximum_bytes_billed = maximum_bytes_billed
+
     try:
-        print(f"Executing: {query}")
-        job = client.query(query)
-        job.result()
-        
-        print(f"Job {job.job_id} completed successfully")
-        return {'status': 'success', 'job_id': job.job_id}
-        
-    except Exception as e:
-        print(f"Error: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return {'error': str(e)}, 500
\ No newline at end of file
+        print(f"Executing: {query} with start_suffix={start_suffix}, end_suffix={end_suffix}, "
+              f"source_dataset={source} as {job_id} ({priority})")
+        job = client.query(query, job_config=job_config, job_id=job_id)
+
+    except Conflict:
+        print(f"Job {job_id} was started by a concurrent trigger")
+        return {'status': 'coalesced', 'job_id': job_id}
+
+    # the job runs on in BigQuery, the function does not wait for it
+    print(f"Job {job.job_id} submitted")
+    return {'status': 'submitted', 'job_id': job.job_id}
+
+
+@functions_framework.cloud_event
+def identity_match_job_stats(cloud_event):
+    """
+    Triggered by Pub/Sub message from the BigQuery job completion log sink.
+
+    Logs the stats of a finished update_identity_match job and of its child
+    jobs (one per statement) as a single structured JSON entry, which Cloud
+    Logging parses into jsonPayload.
+    """
+    job_id, location = get_completed_job(cloud_event)
+    if not job_id or not job_id.startswith(STATS_JOB_PREFIXES):
+        return {'status': 'skipped', 'job_id': job_id}
+
+    client = get_client()
+    job = client.get_job(job_id, location=location)
+    children = sorted(
+        client.list_jobs(parent_job=job_id),
+        key=lambda child: (child.started is None, child.started)
+    )
+
+    entry = {
+        'severity': 'ERROR' if job.error_result else 'INFO',
+        'message': f"update_identity_match job {job_id} {'failed' if job.error_result else 'succeeded'}",
+        'job': job_stats(job),
+        'child_jobs': [job_stats(child) for child in children],
+        'child_cache_hits': sum(1 for child in children if child.cache_hit),
+    }
+    print(json.dumps(entry))
+    return {'status': 'logged', 'job_id': job_id, 'child_jobs': len(children)}
@@ -0,0 +1,428 @@
+import os
+import json
+import base64
+import pytest
+from datetime import datetime, timedelta
+from cloudevents.http import CloudEvent
+from google.api_core.exceptions import Conflict, NotFound
+
+import main
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the recorded export's dataset, and a second property of the deployment
+PROPERTY = 'nzaa-datasets.analytics_291449711'
+OTHER_PROPERTY = 'nzaa-datasets.analytics_300000000'
+
+# location of the deployment's dataset and jobs
+REGION = 'australia-southeast1'
+
+
+class StubJob:
+    def __init__(self, job_id, state='RUNNING', error_result=None, rows=None, parent_job_id=None, **stats):
+        self.job_id = job_id
+        self.state = state
+        self.error_result = error_result
+        self.rows = rows or []
+        self.parent_job_id = parent_job_id
+        self.statement_type = stats.get('statement_type', 'SCRIPT')
+        self.total_bytes_processed = stats.get('total_bytes_processed')
+        self.total_bytes_billed = stats.get('total_bytes_billed')
+        self.slot_millis = stats.get('slot_millis')
+        self.cache_hit = stats.get('cache_hit', False)
+        self.num_dml_affected_rows = stats.get('num_dml_affected_rows')
+        self.started = stats.get('started')
+        self.ended = stats.get('ended')
+
+    def result(self):
+        return self.rows
+
+
+class StubClient:
+    """Records the queries the function issues instead of calling BigQuery."""
+
+    def __init__(self, location=None):
+        # jobs are only found in their location, as with bigquery.Client
+        self.location = location
+        self.queries = []
+        self.jobs = {}
+        self.lease_available = True
+        # lease names held by other runs
+        self.held_leases = set()
+        # bytes processed returned by dry runs, by the table read
+        self.estimates = {}
+        self.dry_runs = []
+        self.high_water_mark = None
+        # {lease name: holder} of leases left in the lease table
+        self.lease_holders = {}
+        # raised when the update_identity_match job is submitted
+        self.submit_error = None
+        self.released = []
+
+    def get_job(self, job_id, location=None):
+        if job_id not in self.jobs or (location or self.location) != REGION:
+            raise NotFound(job_id)
+        return self.jobs[job_id]
+
+    def list_jobs(self, parent_job=None):
+        return [job for job in self.jobs.values() if job.parent_job_id == parent_job]
+
+    def query(self, sql, job_config=None, job_id=None, **kwargs):
+        if job_config is not None and job_config.dry_run:
+            self.dry_runs.append((sql, job_config))
+            return StubJob(None, state='DONE', total_bytes_processed=sum(
+                estimate for table, estimate in self.estimates.items() if f'.{table}`' in sql
+            ))
+        self.queries.append((sql, job_config))
+        if 'identity_match_run_state' in sql:
+            return StubJob(f'run_state_{len(self.queries)}', state='DONE',
+                           rows=[{'high_water_mark': self.high_water_mark}])
+        if 'acquire_identity_match_lease' in sql:
+            lease_name, holder, lease_seconds = [parameter.value for parameter in job_config.query_parameters]
+            acquired = (self.lease_available and lease_name not in self.held_leases
+                        and self.lease_holders.get(lease_name, holder) == holder)
+            # the stub's jobs never end to release a lease, so it is not recorded
+            if acquired:
+                self.lease_seconds = lease_seconds
+            return StubJob(f'lease_{len(self.queries)}', state='DONE', rows=[{'acquired': acquired}])
+        if 'release_identity_match_lease' in sql:
+            holder = job_config.query_parameters[0].value
+            self.released.append(holder)
+            self.lease_holders = {name: held_by for name, held_by in self.lease_holders.items() if held_by != holder}
+            return StubJob(f'release_{len(self.queries)}', state='DONE')
+        if 'identity_match_lease' in sql:
+            lease_name = job_config.query_parameters[0].value
+            rows = [{'holder': self.lease_holders[lease_name]}] if lease_name in self.lease_holders else []
+            return StubJob(f'holder_{len(self.queries)}', state='DONE', rows=rows)
+        if self.submit_error is not None:
+            raise self.submit_error
+        if job_id in self.jobs:
+            raise Conflict(job_id)
+        self.jobs[job_id] = StubJob(job_id)
+        return self.jobs[job_id]
+
+    @property
+    def calls(self):
+        return [(sql, job_config) for sql, job_config in self.queries if 'update_identity_match' in sql]
+
+
+def load_event(table_id=None, drop_table=False):
+    """Loads the recorded export CloudEvent, optionally renaming the loaded table."""
+    with open(f'{ROOT_DIR}/test/fixtures/ga4_export_cloud_event.json', 'r') as f:
+        recorded = json.load(f)
+
+    message = recorded['data']['message']
+    log_entry = json.loads(base64.b64decode(message['data']))
+    load = log_entry['protoPayload']['serviceData']['jobCompletedEvent']['job']['jobConfiguration']['load']
+    if table_id:
+        load['destinationTable']['tableId'] = table_id
+    if drop_table:
+        del load['destinationTable']
+    message['data'] = base64.b64encode(json.dumps(log_entry).encode()).decode()
+
+    return CloudEvent(recorded['attributes'], recorded['data'])
+
+
+def intraday_event():
+    """Message published by the intraday Cloud Scheduler job, attributes only."""
+    return CloudEvent(
+        {'type': 'google.cloud.pubsub.topic.v1.messagePublished', 'source': 'test'},
+        {'message': {'attributes': {'mode': 'intraday'}}}
+    )
+
+
+def job_completed_event(job_id):
+    """BigQueryAuditMetadata jobChange entry for a finished job, as sent by the job completion sink."""
+    log_entry = {
+        'resource': {'type': 'bigquery_project', 'labels': {'project_id': 'nzaa-mkt-guid', 'location': REGION}},
+        'protoPayload': {'metadata': {'jobChange': {
+            'after': 'DONE',
+            'job': {'jobName': f'projects/nzaa-mkt-guid/jobs/{job_id}'}
+        }}}
+    }
+    return CloudEvent(
+        {'type': 'google.cloud.pubsub.topic.v1.messagePublished', 'source': 'test'},
+        {'message': {'data': base64.b64encode(json.dumps(log_entry).encode()).decode()}}
+    )
+
+
+class TestIdentityMatchFunction:
+
+    @pytest.fixture
+    def client(self, monkeypatch):
+        stub = StubClient()
+        self.clients_created = 0
+
+        def create_client(*args, location=None, **kwargs):
+            self.clients_created += 1
+            stub.location = location
+            return stub
+
+        monkeypatch.setattr(main, '_client', None)
+        monkeypatch.setattr(main.bigquery, 'Client', create_client)
+        monkeypatch.setenv('PROJECT_ID', 'nzaa-mkt-guid')
+        monkeypatch.setenv('DATASET_ID', 'identity_resolution_test')
+        monkeypatch.setenv('REGION', REGION)
+        monkeypatch.setenv('GA4_DATASETS', f'{PROPERTY},{OTHER_PROPERTY}')
+        return stub
+
+    def test_get_table_name(self):
+        assert main.get_table_name(load_event()) == 'events_20250607'
+
+    def test_get_table_name_from_resource_name(self):
+        log_entry = {'protoPayload': {
+            'resourceName': 'projects/nzaa-datasets/datasets/analytics_291449711/tables/events_20250608'
+        }}
+        event = CloudEvent(
+            {'type': 'google.cloud.pubsub.topic.v1.messagePublished', 'source': 'test'},
+            {'message': {'data': base64.b64encode(json.dumps(log_entry).encode()).decode()}}
+        )
+        assert main.get_table_name(event) == 'events_20250608'
+
+    def test_processes_loaded_shard(self, client):
+        result = main.identity_match(load_event())
+
+        assert result['status'] == 'submitted'
+        assert result['table_suffix'] == '20250607'
+        assert result['source'] == PROPERTY
+        assert result['job_id'] == 'identity_match_identity_resolution_test_nzaa-datasets_analytics_291449711_20250607_0'
+        assert len(client.calls) == 1
+
+        sql, job_config = client.calls[0]
+        assert sql == ("CALL `nzaa-mkt-guid.identity_resolution_test.update_identity_match`"
+                       "(@start_suffix, @end_suffix, @source_dataset)")
+        assert [(parameter.name, parameter.type_, parameter.value) for parameter in job_config.query_parameters] == [
+            ('start_suffix', 'STRING', '20250607'), ('end_suffix', 'STRING', '20250607'),
+            ('source_dataset', 'STRING', PROPERTY)
+        ]
+
+        # the property's lease is taken for the job before it is submitted
+        lease_sql, lease_config = client.queries[0]
+        assert 'acquire_identity_match_lease' in lease_sql
+        assert [parameter.value for parameter in lease_config.query_parameters[:2]] == [
+            f'update_identity_match:{PROPERTY}', result['job_id']
+        ]
+
+    def test_skips_non_daily_tables(self, client):
+        result = main.identity_match(load_event(table_id='events_intraday_20250608'))
+
+        assert result['status'] == 'skipped'
+        assert client.queries == []
+
+    def test_skips_other_properties(self, client, monkeypatch):
+        monkeypatch.setenv('GA4_DATASETS', OTHER_PROPERTY)
+        result = main.identity_match(load_event())
+
+        assert result == {'status': 'skipped', 'table': 'events_20250607', 'source': PROPERTY}
+        assert client.queries == []
+
+    def test_falls_back_to_watermark_without_table(self, client):
+        event = load_event(drop_table=True)
+        result = main.identity_match(event)
+
+        # one run per property, from its own high-water mark
+        assert result['status'] == 'submitted'
+        assert [run['job_id'] for run in result['runs']] == [
+            f"identity_match_identity_resolution_test_nzaa-datasets_analytics_291449711_catchup_{event['id']}_0",
+            f"identity_match_identity_resolution_test_nzaa-datasets_analytics_300000000_catchup_{event['id']}_0"
+        ]
+        assert sorted(
+            [parameter.value for parameter in job_config.query_parameters] for _, job_config in client.calls
+        ) == [[None, None, PROPERTY], [None, None, OTHER_PROPERTY]]
+
+    def test_catchup_redelivered_for_leased_property(self, client):
+        client.held_leases.add(f'update_identity_match:{OTHER_PROPERTY}')
+        event = load_event(drop_table=True)
+
+        with pytest.raises(main.LeaseUnavailable):
+            main.identity_match(event)
+        assert len(client.calls) == 1
+
+        # the redelivery only submits the property that was leased
+        client.held_leases.clear()
+        result = main.identity_match(event)
+        assert [run['status'] for run in result['runs']] == ['coalesced', 'submitted']
+        assert len(client.calls) == 2
+
+    def test_intraday_run_from_scheduler(self, client):
+        event = intraday_event()
+        result = main.identity_match(event)
+
+        assert result['status'] == 'submitted'
+        assert result['runs'][0]['job_id'] == (
+            f"identity_match_identity_resolution_test_nzaa-datasets_analytics_291449711_intraday_{event['id']}_0"
+        )
+        assert sorted(
+            [parameter.value for parameter in job_config.query_parameters] for _, job_config in client.calls
+        ) == [['intraday_', 'intraday_99999999', PROPERTY], ['intraday_', 'intraday_99999999', OTHER_PROPERTY]]
+
+        # a tick that finds a run in progress is dropped, not redelivered
+        client.lease_available = False
+        assert main.identity_match(intraday_event())['status'] == 'skipped'
+        assert len(client.calls) == 2
+
+    def test_duplicate_triggers_coalesce(self, client):
+        first = main.identity_match(load_event())
+        second = main.identity_match(load_event())
+
+        assert second['status'] == 'coalesced'
+        assert second['job_id'] == first['job_id']
+        assert len(client.calls) == 1
+
+    def test_failed_job_is_retried_with_new_job_id(self, client):
+        failed_job_id = 'identity_match_identity_resolution_test_nzaa-datasets_analytics_291449711_20250607_0'
+        client.jobs[failed_job_id] = StubJob(failed_job_id, state='DONE', error_result={'reason': 'backendError'})
+
+        result = main.identity_match(load_event())
+
+        assert result['status'] == 'submitted'
+        assert result['job_id'] == 'identity_match_identity_resolution_test_nzaa-datasets_analytics_291449711_20250607_1'
+
+    def test_shard_failing_every_attempt_is_acknowledged(self, client, capsys):
+        for attempt in range(main.MAX_ATTEMPTS):
+            job_id = f'identity_match_identity_resolution_test_nzaa-datasets_analytics_291449711_20250607_{attempt}'
+            client.jobs[job_id] = StubJob(job_id, state='DONE', error_result={'reason': 'invalidQuery'})
+
+        # returned rather than raised, so Pub/Sub does not redeliver it
+        result = main.identity_match(load_event())
+
+        assert result['status'] == 'failed'
+        assert client.calls == []
+        entry = next(json.loads(line) for line in capsys.readouterr().out.splitlines() if 'not retrying' in line)
+        assert entry['severity'] == 'ERROR'
+
+    def test_lease_released_when_submit_fails(self, client):
+        client.submit_error = RuntimeError('backendError')
+
+        with pytest.raises(RuntimeError):
+            main.identity_match(load_event())
+        assert client.released == [
+            'identity_match_identity_resolution_test_nzaa-datasets_analytics_291449711_20250607_0'
+        ]
+
+    def test_lease_held_by_another_run(self, client):
+        client.lease_available = False
+
+        with pytest.raises(main.LeaseUnavailable):
+            main.identity_match(load_event())
+        assert client.calls == []
+
+    def test_run_estimated_per_stage(self, client, capsys):
+        client.estimates = {'events_*': 5000, 'identity_match': 300, 'alternate_identity_match': 200}
+        result = main.identity_match(load_event())
+
+        assert result['estimated_bytes'] == 5500
+        entry = next(json.loads(line) for line in capsys.readouterr().out.splitlines()
+                     if 'stage_estimated_bytes' in line)
+        assert entry['severity'] == 'INFO'
+        assert entry['stage_estimated_bytes'] == {
+            'extract_identity_events': 5000, 'merge_identity_match': 300, 'merge_alternate_identity_match': 200,
+            'update_identity_cluster': 0
+        }
+
+        # the extraction reads the loaded shard of the property
+        sql, job_config = client.dry_runs[0]
+        assert f'`{PROPERTY}.events_*`' in sql
+        assert [parameter.value for parameter in job_config.query_parameters] == ['20250607', '20250607', '']
+
+        _, job_config = client.calls[0]
+        assert job_config.priority == 'INTERACTIVE'
+        assert job_config.maximum_bytes_billed is None
+
+    def test_catchup_estimated_from_high_water_mark(self, client):
+        client.high_water_mark = '20250606'
+        main.identity_match(load_event(drop_table=True))
+
+        extract_runs = [job_config for sql, job_config in client.dry_runs if 'events_*' in sql]
+        assert [[parameter.value for parameter in job_config.query_parameters] for job_config in extract_runs] == [
+            ['', '99999999', '20250606'], ['', '99999999', '20250606']
+        ]
+
+    def test_over_budget_run_is_refused(self, client, monkeypatch):
+        monkeypatch.setenv('RUN_BYTES_BUDGET', '1000')
+        monkeypatch.setenv('OVER_BUDGET_ACTION', 'refuse')
+        client.estimates = {'events_*': 5000}
+
+        result = main.identity_match(load_event())
+
+        assert result['status'] == 'refused'
+        assert result['estimated_bytes'] == 5000
+        # neither the lease nor the job is taken
+        assert client.queries == []
+
+    def test_over_budget_run_is_batched(self, client, monkeypatch):
+        monkeypatch.setenv('RUN_BYTES_BUDGET', '1000')
+        monkeypatch.setenv('MAX_BYTES_BILLED', '10000')
+        client.estimates = {'events_*': 5000}
+
+        assert main.identity_match(load_event())['status'] == 'submitted'
+
+        _, job_config = client.calls[0]
+        assert job_config.priority == 'BATCH'
+        assert job_config.maximum_bytes_billed == 10000
+
+    def test_over_budget_run_holds_lease_while_queued(self, client, monkeypatch):
+        monkeypatch.setenv('RUN_BYTES_BUDGET', '1000')
+        monkeypatch.setenv('LEASE_SECONDS', '900')
+        client.estimates = {'events_*': 5000}
+
+        main.identity_match(load_event())
+
+        assert client.lease_seconds == 900 + main.BATCH_QUEUE_SECONDS
+
+    def test_lease_of_finished_job_is_released(self, client):
+        lease_name = f'update_identity_match:{PROPERTY}'
+        # cancelled while queued, so the procedure never released its lease
+        client.jobs['identity_match_cancelled'] = StubJob('identity_match_cancelled', state='DONE',
+                                                          error_result={'reason': 'stopped'})
+        client.lease_holders[lease_name] = 'identity_match_cancelled'
+
+        assert main.identity_match(load_event())['status'] == 'submitted'
+        assert client.released == ['identity_match_cancelled']
+
+        # a queued or running holder keeps it
+        client.jobs['identity_match_queued'] = StubJob('identity_match_queued', state='PENDING')
+        client.lease_holders[lease_name] = 'identity_match_queued'
+        with pytest.raises(main.LeaseUnavailable):
+            main.identity_match(load_event(table_id='events_20250608'))
+        assert client.released == ['identity_match_cancelled']
+
+    def test_client_reused_across_invocations(self, client):
+        main.identity_match(load_event(table_id='events_20250607'))
+        main.identity_match(load_event(table_id='events_20250608'))
+
+        assert self.clients_created == 1
+        assert len(client.calls) == 2
+
+    def test_job_stats_logged_as_json(self, client, capsys):
+        job_id = 'identity_match_identity_resolution_test_20250607_0'
+        started = datetime(2025, 6, 8, 1, 0, 0)
+        client.jobs[job_id] = StubJob(job_id, state='DONE', total_bytes_processed=3000, total_bytes_billed=10485760,
+                                      slot_millis=900, started=started, ended=started + timedelta(seconds=12))
+        for index, (statement_type, bytes_processed, cache_hit) in enumerate([
+            ('CREATE_TABLE_AS_SELECT', 2000, False), ('MERGE', 1000, False), ('SELECT', 0, True)
+        ]):
+            client.jobs[f'script_job_{index}'] = StubJob(
+                f'script_job_{index}', state='DONE', parent_job_id=job_id, statement_type=statement_type,
+                total_bytes_processed=bytes_processed, slot_millis=300, cache_hit=cache_hit,
+                started=started + timedelta(seconds=index), ended=started + timedelta(seconds=index + 1)
+            )
+
+        result = main.identity_match_job_stats(job_completed_event(job_id))
+
+        assert result == {'status': 'logged', 'job_id': job_id, 'child_jobs': 3}
+        entry = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+        assert entry['severity'] == 'INFO'
+        assert entry['job']['total_bytes_processed'] == 3000
+        assert entry['job']['slot_millis'] == 900
+        assert entry['job']['elapsed_ms'] == 12000
+        assert [child['statement_type'] for child in entry['child_jobs']] == [
+            'CREATE_TABLE_AS_SELECT', 'MERGE', 'SELECT'
+        ]
+        assert [child['total_bytes_processed'] for child in entry['child_jobs']] == [2000, 1000, 0]
+        assert entry['child_cache_hits'] == 1
+
+    def test_job_stats_skips_other_jobs(self, client):
+        result = main.identity_match_job_stats(job_completed_event('bquxjob_12345'))
+
+        assert result['status'] == 'skipped'
@@ -1,3 +1,8 @@
+# Partitioning and clustering shared with the test helper
+locals {
+  table_options = jsondecode(file("${path.module}/../bigquery/schemas/table_options.json"))
+}
+
 # Create BigQuery dataset
 resource "google_bigquery_dataset" "identity_resolution" {
   dataset_id                  = "identity_resolution_${var.environment}"
@@ -21,6 +26,16 @@ resource "google_bigquery_table" "identity_match" {
   dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
   table_id            = "identity_match"
   deletion_protection = false
+
+  range_partitioning {
+    field = local.table_options.identity_match.range_partitioning.field
+    range {
+      start    = local.table_options.identity_match.range_partitioning.start
+      end      = local.table_options.identity_match.range_partitioning.end
+      interval = local.table_options.identity_match.range_partitioning.interval
+    }
+  }
+  clustering = local.table_options.identity_match.clustering
   
   schema = file("${path.module}/../bigquery/schemas/identity_match.json")
 }
@@ -30,22 +45,377 @@ resource "google_bigquery_table" "alternate_identity_match" {
   dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
   table_id            = "alternate_identity_match"
   deletion_protection = false
+
+  range_partitioning {
+    field = local.table_options.alternate_identity_match.range_partitioning.field
+    range {
+      start    = local.table_options.alternate_identity_match.range_partitioning.start
+      end      = local.table_options.alternate_identity_match.range_partitioning.end
+      interval = local.table_options.alternate_identity_match.range_partitioning.interval
+    }
+  }
+  clustering = local.table_options.alternate_identity_match.clustering
   
   schema = file("${path.module}/../bigquery/schemas/alternate_identity_match.json")
 }
 
+# Create identity_match_history table (append-only, one row per link per day)
+resource "google_bigquery_table" "identity_match_history" {
+  dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
+  table_id            = "identity_match_history"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = local.table_options.identity_match_history.time_partitioning.type
+    field = local.table_options.identity_match_history.time_partitioning.field
+  }
+  clustering = local.table_options.identity_match_history.clustering
+  
+  schema = file("${path.module}/../bigquery/schemas/identity_match_history.json")
+}
+
+# Create alternate_identity_match_history table (append-only, one row per id per day)
+resource "google_bigquery_table" "alternate_identity_match_history" {
+  dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
+  table_id            = "alternate_identity_match_history"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = local.table_options.alternate_identity_match_history.time_partitioning.type
+    field = local.table_options.alternate_identity_match_history.time_partitioning.field
+  }
+  clustering = local.table_options.alternate_identity_match_history.clustering
+  
+  schema = file("${path.module}/../bigquery/schemas/alternate_identity_match_history.json")
+}
+
+# Create identity_match_archive table (links archived by compact_identity_match)
+resource "google_bigquery_table" "identity_match_archive" {
+  dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
+  table_id            = "identity_match_archive"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = local.table_options.identity_match_archive.time_partitioning.type
+    field = local.table_options.identity_match_archive.time_partitioning.field
+  }
+  clustering = local.table_options.identity_match_archive.clustering
+
+  schema = file("${path.module}/../bigquery/schemas/identity_match_archive.json")
+}
+
+# Create alternate_identity_match_archive table (alternate ids archived by compact_identity_match)
+resource "google_bigquery_table" "alternate_identity_match_archive" {
+  dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
+  table_id            = "alternate_identity_match_archive"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = local.table_options.alternate_identity_match_archive.time_partitioning.type
+    field = local.table_options.alternate_identity_match_archive.time_partitioning.field
+  }
+  clustering = local.table_options.alternate_identity_match_archive.clustering
+
+  schema = file("${path.module}/../bigquery/schemas/alternate_identity_match_archive.json")
+}
+
+# Create identity_match_run_state table
+resource "google_bigquery_table" "identity_match_run_state" {
+  dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
+  table_id            = "identity_match_run_state"
+  deletion_protection = false
+  
+  schema = file("${path.module}/../bigquery/schemas/identity_match_run_state.json")
+}
+
+# Create identity_match_lease table (single-flight leases, one per GA4 property for update_identity_match)
+resource "google_bigquery_table" "identity_match_lease" {
+  dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
+  table_id            = "identity_match_lease"
+  deletion_protection = false
+  
+  schema = file("${path.module}/../bigquery/schemas/identity_match_lease.json")
+}
+
+# Create identity_match_run_log table (one row per stage of each run)
+resource "google_bigquery_table" "identity_match_run_log" {
+  dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
+  table_id            = "identity_match_run_log"
+  deletion_protection = false
+
+  time_partitioning {
+    type  = local.table_options.identity_match_run_log.time_partitioning.type
+    field = local.table_options.identity_match_run_log.time_partitioning.field
+  }
+  clustering = local.table_options.identity_match_run_log.clustering
+
+  schema = file("${path.module}/../bigquery/schemas/identity_match_run_log.json")
+}
+
+# Create identity_cluster table (connected component of each email, ga_id and alternate id)
+resource "google_bigquery_table" "identity_cluster" {
+  dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
+  table_id            = "identity_cluster"
+  deletion_protection = false
+
+  clustering = local.table_options.identity_cluster.clustering
+
+  schema = file("${path.module}/../bigquery/schemas/identity_cluster.json")
+}
+
+# Create identity_graph_manifest table (snapshot and delta exports of the identity graph)
+resource "google_bigquery_table" "identity_graph_manifest" {
+  dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
+  table_id            = "identity_graph_manifest"
+  deletion_protection = false
+
+  schema = file("${path.module}/../bigquery/schemas/identity_graph_manifest.json")
+}
+
+# Create identity_match_intraday_state table (event_timestamp watermark of intraday runs)
+resource "google_bigquery_table" "identity_match_intraday_state" {
+  dataset_id          = google_bigquery_dataset.identity_resolution.dataset_id
+  table_id            = "identity_match_intraday_state"
+  deletion_protection = false
+
+  schema = file("${path.module}/../bigquery/schemas/identity_match_intraday_state.json")
+}
+
+# Search indexes for point lookups by hashed_email, ga_id and alternate id.
+# The provider has no search index resource, so the DDL runs as a job. Job
+# IDs cannot be reused, the ID changes with the DDL and with the tables'
+# creation time, so the indexes are created again when either changes.
+locals {
+  identity_search_indexes_sql = templatefile("${path.module}/../bigquery/indexes/identity_search_indexes.sql", {
+    project_id = var.project_id
+    dataset_id = google_bigquery_dataset.identity_resolution.dataset_id
+  })
+}
+
+resource "google_bigquery_job" "identity_search_indexes" {
+  job_id = "identity_search_indexes_${var.environment}_${substr(sha256(join("/", [
+    local.identity_search_indexes_sql,
+    google_bigquery_table.identity_match.creation_time,
+    google_bigquery_table.alternate_identity_match.creation_time,
+    google_bigquery_table.alternate_identity_match_history.creation_time,
+  ])), 0, 16)}"
+  location = google_bigquery_dataset.identity_resolution.location
+
+  query {
+    query          = local.identity_search_indexes_sql
+    use_legacy_sql = false
+    # DDL scripts take no destination table
+    create_disposition = ""
+    write_disposition  = ""
+  }
+}
+
 # Create stored procedure
 resource "google_bigquery_routine" "update_identity_match" {
   dataset_id   = google_bigquery_dataset.identity_resolution.dataset_id
   routine_id   = "update_identity_match"
   routine_type = "PROCEDURE"
   language     = "SQL"
+
+  arguments {
+    name      = "start_suffix"
+    data_type = jsonencode({ typeKind = "STRING" })
+  }
+
+  arguments {
+    name      = "end_suffix"
+    data_type = jsonencode({ typeKind = "STRING" })
+  }
+
+  arguments {
+    name      = "source_dataset"
+    data_type = jsonencode({ typeKind = "STRING" })
+  }
   
   definition_body = templatefile("${path.module}/../bigquery/procedures/update_identity_match.sql", {
     project_id       = var.project_id
     dataset_id       = google_bigquery_dataset.identity_resolution.dataset_id
     ga4_project      = var.ga4_project_id
     ga4_dataset      = var.ga4_dataset
+    intraday_lookback_seconds = var.intraday_lookback_seconds
   })
 }
 
+# Create incremental identity clustering procedure, called by update_identity_match
+resource "google_bigquery_routine" "update_identity_cluster" {
+  dataset_id   = google_bigquery_dataset.identity_resolution.dataset_id
+  routine_id   = "update_identity_cluster"
+  routine_type = "PROCEDURE"
+  language     = "SQL"
+
+  arguments {
+    name      = "start_date"
+    data_type = jsonencode({ typeKind = "DATE" })
+  }
+
+  arguments {
+    name      = "end_date"
+    data_type = jsonencode({ typeKind = "DATE" })
+  }
+
+  arguments {
+    name      = "relabelled"
+    mode      = "OUT"
+    data_type = jsonencode({ typeKind = "INT64" })
+  }
+
+  definition_body = templatefile("${path.module}/../bigquery/procedures/update_identity_cluster.sql", {
+    project_id = var.project_id
+    dataset_id = google_bigquery_dataset.identity_resolution.dataset_id
+  })
+}
+
+# Create Parquet snapshot/delta export procedure, called by update_identity_match
+resource "google_bigquery_routine" "export_identity_graph" {
+  dataset_id   = google_bigquery_dataset.identity_resolution.dataset_id
+  routine_id   = "export_identity_graph"
+  routine_type = "PROCEDURE"
+  language     = "SQL"
+
+  arguments {
+    name      = "run_id"
+    data_type = jsonencode({ typeKind = "STRING" })
+  }
+
+  arguments {
+    name      = "force_snapshot"
+    data_type = jsonencode({ typeKind = "BOOL" })
+  }
+
+  arguments {
+    name      = "exported_rows"
+    mode      = "OUT"
+    data_type = jsonencode({ typeKind = "INT64" })
+  }
+
+  definition_body = templatefile("${path.module}/../bigquery/procedures/export_identity_graph.sql", {
+    project_id    = var.project_id
+    dataset_id    = google_bigquery_dataset.identity_resolution.dataset_id
+    export_uri    = "gs://${google_storage_bucket.identity_graph_export.name}/identity_graph"
+    snapshot_days = var.export_snapshot_days
+  })
+}
+
+# Bucket for the Parquet exports, in the dataset's location as EXPORT DATA requires
+resource "google_storage_bucket" "identity_graph_export" {
+  name          = "${var.project_id}-identity-graph-${var.environment}"
+  location      = google_bigquery_dataset.identity_resolution.location
+  force_destroy = true
+
+  uniform_bucket_level_access = true
+}
+
+# the procedure runs as the function's service account
+resource "google_storage_bucket_iam_member" "identity_graph_export_writer" {
+  bucket = google_storage_bucket.identity_graph_export.name
+  role   = "roles/storage.objectAdmin"
+  member = "serviceAccount:${var.service_account_email}"
+}
+
+# Create cluster split procedure, called by compact_identity_match
+resource "google_bigquery_routine" "split_identity_cluster" {
+  dataset_id   = google_bigquery_dataset.identity_resolution.dataset_id
+  routine_id   = "split_identity_cluster"
+  routine_type = "PROCEDURE"
+  language     = "SQL"
+
+  arguments {
+    name      = "cluster_ids"
+    data_type = jsonencode({ typeKind = "ARRAY", arrayElementType = { typeKind = "STRING" } })
+  }
+
+  arguments {
+    name      = "relabelled"
+    mode      = "OUT"
+    data_type = jsonencode({ typeKind = "INT64" })
+  }
+
+  definition_body = templatefile("${path.module}/../bigquery/procedures/split_identity_cluster.sql", {
+    project_id = var.project_id
+    dataset_id = google_bigquery_dataset.identity_resolution.dataset_id
+  })
+}
+
+# Create TTL compaction procedure, moves stale links to the archive tables
+resource "google_bigquery_routine" "compact_identity_match" {
+  dataset_id   = google_bigquery_dataset.identity_resolution.dataset_id
+  routine_id   = "compact_identity_match"
+  routine_type = "PROCEDURE"
+  language     = "SQL"
+
+  arguments {
+    name      = "ttl_days"
+    data_type = jsonencode({ typeKind = "INT64" })
+  }
+
+  definition_body = templatefile("${path.module}/../bigquery/procedures/compact_identity_match.sql", {
+    project_id    = var.project_id
+    dataset_id    = google_bigquery_dataset.identity_resolution.dataset_id
+    lease_seconds = var.lease_seconds
+  })
+}
+
+# Run the compaction as a scheduled query
+resource "google_bigquery_data_transfer_config" "compact_identity_match" {
+  display_name         = "compact-identity-match-${var.environment}"
+  location             = google_bigquery_dataset.identity_resolution.location
+  data_source_id       = "scheduled_query"
+  schedule             = var.compaction_schedule
+  service_account_name = var.service_account_email
+
+  params = {
+    query = "CALL `${var.project_id}.${google_bigquery_dataset.identity_resolution.dataset_id}.compact_identity_match`(${var.link_ttl_days})"
+  }
+
+  depends_on = [google_bigquery_routine.compact_identity_match]
+}
+
+# Create single-flight lease procedures
+resource "google_bigquery_routine" "acquire_identity_match_lease" {
+  dataset_id   = google_bigquery_dataset.identity_resolution.dataset_id
+  routine_id   = "acquire_identity_match_lease"
+  routine_type = "PROCEDURE"
+  language     = "SQL"
+
+  arguments {
+    name      = "name"
+    data_type = jsonencode({ typeKind = "STRING" })
+  }
+
+  arguments {
+    name      = "lease_holder"
+    data_type = jsonencode({ typeKind = "STRING" })
+  }
+
+  arguments {
+    name      = "lease_seconds"
+    data_type = jsonencode({ typeKind = "INT64" })
+  }
+  
+  definition_body = templatefile("${path.module}/../bigquery/procedures/acquire_identity_match_lease.sql", {
+    project_id       = var.project_id
+    dataset_id       = google_bigquery_dataset.identity_resolution.dataset_id
+  })
+}
+
+resource "google_bigquery_routine" "release_identity_match_lease" {
+  dataset_id   = google_bigquery_dataset.identity_resolution.dataset_id
+  routine_id   = "release_identity_match_lease"
+  routine_type = "PROCEDURE"
+  language     = "SQL"
+
+  arguments {
+    name      = "lease_holder"
+    data_type = jsonencode({ typeKind = "STRING" })
+  }
+  
+  definition_body = templatefile("${path.module}/../bigquery/procedures/release_identity_match_lease.sql", {
+    project_id       = var.project_id
+    dataset_id       = google_bigquery_dataset.identity_resolution.dataset_id
+  })
+}
\ No newline at end of file
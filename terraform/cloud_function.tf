@@ -58,13 +58,23 @@ resource "google_cloudfunctions2_function" "identity_match" {
     max_instance_count    = 100
     min_instance_count    = 0
     available_memory      = "512M"
-    timeout_seconds       = 540
+    # the function submits the job and returns, it does not wait for it
+    timeout_seconds       = 60
     service_account_email = var.service_account_email
     
     environment_variables = {
       PROJECT_ID = var.project_id
       DATASET_ID = google_bigquery_dataset.identity_resolution.dataset_id
       REGION     = var.region
+      # how long a run holds the single-flight lease if it never releases it
+      LEASE_SECONDS = var.lease_seconds
+      # properties processed, and how many of their runs are submitted at once
+      GA4_DATASETS        = join(",", local.ga4_datasets)
+      MAX_CONCURRENT_RUNS = var.max_concurrent_runs
+      # runs are dry-run first, those estimated over the budget are refused or run as capped BATCH jobs
+      RUN_BYTES_BUDGET   = var.run_bytes_budget
+      OVER_BUDGET_ACTION = var.over_budget_action
+      MAX_BYTES_BILLED   = var.max_bytes_billed
     }
   }
 
@@ -76,6 +86,57 @@ resource "google_cloudfunctions2_function" "identity_match" {
   }
 }
 
+# Publishes an intraday run request to the function's topic on the
+# environment's schedule, the message has no log entry, only the mode
+resource "google_cloud_scheduler_job" "identity_match_intraday" {
+  count     = var.intraday_enabled ? 1 : 0
+  name      = "identity-match-intraday-${var.environment}"
+  region    = var.region
+  schedule  = var.intraday_schedule
+  time_zone = var.intraday_time_zone
+
+  pubsub_target {
+    topic_name = google_pubsub_topic.ga4_export.id
+    attributes = {
+      mode = "intraday"
+    }
+  }
+}
+
+# Logs the bytes processed, slot time and cache hits of each finished
+# update_identity_match job and its child jobs as structured JSON
+resource "google_cloudfunctions2_function" "identity_match_job_stats" {
+  name        = "identity-match-job-stats-${var.environment}"
+  location    = var.region
+  description = "Log BigQuery job stats of identity resolution runs"
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "identity_match_job_stats"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.function_bucket.name
+        object = google_storage_bucket_object.function_zip.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count    = 10
+    min_instance_count    = 0
+    available_memory      = "256M"
+    timeout_seconds       = 60
+    service_account_email = var.service_account_email
+  }
+
+  event_trigger {
+    event_type            = "google.cloud.pubsub.topic.v1.messagePublished"
+    pubsub_topic          = google_pubsub_topic.identity_match_jobs.id
+    service_account_email = var.service_account_email
+    retry_policy          = "RETRY_POLICY_DO_NOT_RETRY"
+  }
+}
+
 # Output the function URI
 output "function_uri" {
   value = google_cloudfunctions2_function.identity_match.service_config[0].uri
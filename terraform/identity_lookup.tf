@@ -0,0 +1,117 @@
+# Bucket for the identity lookup snapshot
+resource "google_storage_bucket" "identity_lookup" {
+  name          = "${var.project_id}-identity-lookup-${var.environment}"
+  location      = var.region
+  force_destroy = true
+
+  uniform_bucket_level_access = true
+}
+
+locals {
+  identity_lookup_snapshot_uri = "gs://${google_storage_bucket.identity_lookup.name}/snapshot/identity_lookup.json.gz"
+}
+
+# Zip the lookup function source code
+data "archive_file" "identity_lookup_source" {
+  type        = "zip"
+  output_path = "/tmp/identity-lookup-source.zip"
+
+  source {
+    content  = file("${path.module}/../cloud_functions/identity_lookup/main.py")
+    filename = "main.py"
+  }
+
+  source {
+    content  = file("${path.module}/../cloud_functions/identity_lookup/requirements.txt")
+    filename = "requirements.txt"
+  }
+}
+
+resource "google_storage_bucket_object" "identity_lookup_zip" {
+  name   = "identity-lookup-${var.environment}-${data.archive_file.identity_lookup_source.output_base64sha256}.zip"
+  bucket = google_storage_bucket.function_bucket.name
+  source = data.archive_file.identity_lookup_source.output_path
+}
+
+# Serves lookups by hashed_email, ga_id or alternate id from the snapshot
+resource "google_cloudfunctions2_function" "identity_lookup" {
+  name        = "identity-lookup-${var.environment}"
+  location    = var.region
+  description = "Look up linked identities from the identity snapshot"
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "identity_lookup"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.function_bucket.name
+        object = google_storage_bucket_object.identity_lookup_zip.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count    = 20
+    # a warm instance keeps the snapshot and cache in memory
+    min_instance_count    = 1
+    available_memory      = "2G"
+    timeout_seconds       = 30
+    service_account_email = var.service_account_email
+
+    environment_variables = {
+      SNAPSHOT_URI         = local.identity_lookup_snapshot_uri
+      SNAPSHOT_TTL_SECONDS = 900
+      CACHE_SIZE           = 10000
+      CACHE_TTL_SECONDS    = 300
+    }
+  }
+}
+
+# Writes a new snapshot when a daily update_identity_match run, a backfill
+# chunk or the compaction succeeds, the function skips intraday runs and
+# failed jobs
+resource "google_cloudfunctions2_function" "identity_lookup_snapshot" {
+  name        = "identity-lookup-snapshot-${var.environment}"
+  location    = var.region
+  description = "Snapshot the identity tables for the identity lookup"
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "identity_lookup_snapshot"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.function_bucket.name
+        object = google_storage_bucket_object.identity_lookup_zip.name
+      }
+    }
+  }
+
+  service_config {
+    # one snapshot at a time. An event delivered while the instance is busy
+    # is refused and retried, and skipped once a snapshot taken after its
+    # job ended has been written
+    max_instance_count    = 1
+    min_instance_count    = 0
+    available_memory      = "4G"
+    timeout_seconds       = 540
+    service_account_email = var.service_account_email
+
+    environment_variables = {
+      PROJECT_ID        = var.project_id
+      DATASET_ID        = google_bigquery_dataset.identity_resolution.dataset_id
+      SNAPSHOT_URI      = local.identity_lookup_snapshot_uri
+      SNAPSHOT_MAX_KEYS = 1500000
+    }
+  }
+
+  event_trigger {
+    event_type            = "google.cloud.pubsub.topic.v1.messagePublished"
+    pubsub_topic          = google_pubsub_topic.identity_match_jobs.id
+    service_account_email = var.service_account_email
+    retry_policy          = "RETRY_POLICY_RETRY"
+  }
+}
+
+output "identity_lookup_uri" {
+  value = google_cloudfunctions2_function.identity_lookup.service_config[0].uri
+}
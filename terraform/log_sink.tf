@@ -1,4 +1,33 @@
 # Create Pub/Sub topic
 resource "google_pubsub_topic" "ga4_export" {
   name = "ga4-export-identity-resolution-${var.environment}"
-}
\ No newline at end of file
+}
+
+# Pub/Sub topic for finished update_identity_match jobs
+resource "google_pubsub_topic" "identity_match_jobs" {
+  name = "identity-match-jobs-${var.environment}"
+}
+
+# Route the completion of the function's jobs, backfill chunks and the
+# compaction scheduled query to the job stats and lookup snapshot functions.
+# Child jobs of the script are read by the function itself.
+resource "google_logging_project_sink" "identity_match_jobs" {
+  name        = "identity-match-jobs-sink-${var.environment}"
+  destination = "pubsub.googleapis.com/${google_pubsub_topic.identity_match_jobs.id}"
+  filter      = <<-EOT
+    resource.type="bigquery_project"
+    protoPayload.metadata.jobChange.after="DONE"
+    (protoPayload.metadata.jobChange.job.jobName:"/jobs/identity_match_${local.dataset_id}_"
+      OR protoPayload.metadata.jobChange.job.jobName:"/jobs/backfill_${local.dataset_id}_"
+      OR (protoPayload.metadata.jobChange.job.jobName:"/jobs/scheduled_query_"
+        AND protoPayload.metadata.jobChange.job.jobConfig.queryConfig.query:".${local.dataset_id}.compact_identity_match`"))
+  EOT
+
+  unique_writer_identity = true
+}
+
+resource "google_pubsub_topic_iam_member" "identity_match_jobs_publisher" {
+  topic  = google_pubsub_topic.identity_match_jobs.name
+  role   = "roles/pubsub.publisher"
+  member = google_logging_project_sink.identity_match_jobs.writer_identity
+}
@@ -47,4 +47,7 @@ locals {
   function_name = "identity-match-${var.environment}"
   topic_name    = "ga4-export-identity-resolution-${var.environment}"
   log_sink_name = "ga4-identity-resolution-sink-${var.environment}"
+
+  # GA4 export datasets (project.dataset) merged into the identity tables
+  ga4_datasets = length(var.ga4_datasets) > 0 ? var.ga4_datasets : ["${var.ga4_project_id}.${var.ga4_dataset}"]
 }
\ No newline at end of file
@@ -30,7 +30,90 @@ variable "ga4_dataset" {
   type        = string
 }
 
+variable "ga4_datasets" {
+  description = "GA4 export datasets (project.dataset) of every property to process, defaults to ga4_project_id.ga4_dataset"
+  type        = list(string)
+  default     = []
+}
+
+variable "max_concurrent_runs" {
+  description = "Most per-property update_identity_match jobs a catch-up or intraday run submits at the same time"
+  type        = number
+  default     = 4
+}
+
+variable "run_bytes_budget" {
+  description = "Estimated bytes above which an update_identity_match run is over budget, 0 for no budget"
+  type        = number
+  default     = 0
+}
+
+variable "over_budget_action" {
+  description = "What the function does with a run over run_bytes_budget: refuse it, or submit it at BATCH priority"
+  type        = string
+  default     = "batch"
+
+  validation {
+    condition     = contains(["batch", "refuse"], var.over_budget_action)
+    error_message = "over_budget_action must be batch or refuse."
+  }
+}
+
+variable "max_bytes_billed" {
+  description = "maximum_bytes_billed of the BATCH runs over budget, 0 for no cap"
+  type        = number
+  default     = 0
+}
+
 variable "service_account_email" {
   description = "Service account email"
   type        = string
-}
\ No newline at end of file
+}
+
+variable "lease_seconds" {
+  description = "Seconds an update_identity_match run holds the single-flight lease before it can be taken over"
+  type        = number
+  default     = 900
+}
+
+variable "export_snapshot_days" {
+  description = "Days between full Parquet snapshots of the identity graph, runs in between export deltas"
+  type        = number
+  default     = 7
+}
+
+variable "intraday_enabled" {
+  description = "Process the events_intraday_* tables on intraday_schedule, between the daily exports"
+  type        = bool
+  default     = false
+}
+
+variable "intraday_schedule" {
+  description = "Cron schedule of the intraday runs (Cloud Scheduler, in intraday_time_zone)"
+  type        = string
+  default     = "*/30 * * * *"
+}
+
+variable "intraday_time_zone" {
+  description = "tz database time zone intraday_schedule is evaluated in"
+  type        = string
+  default     = "Pacific/Auckland"
+}
+
+variable "intraday_lookback_seconds" {
+  description = "Seconds before the intraday watermark re-read by each intraday run, for late streamed events"
+  type        = number
+  default     = 600
+}
+
+variable "link_ttl_days" {
+  description = "Days since last_seen after which compact_identity_match archives a link"
+  type        = number
+  default     = 395
+}
+
+variable "compaction_schedule" {
+  description = "Schedule of the compact_identity_match scheduled query (BigQuery Data Transfer syntax)"
+  type        = string
+  default     = "every sunday 15:00"
+}
@@ -0,0 +1,166 @@
+"""
+Benchmarks update_identity_match on generated GA4 events across data sizes.
+
+For each size the identity tables are created empty, the generated shards
+are loaded and the procedure is called once. Each statement of the
+procedure is a child job of the CALL, and their wall time, rows and bytes
+processed are reported per stage. Bytes processed are only known on
+BigQuery, the local backend reports rows and wall time.
+
+    python -m test.benchmark_identity_match --backend local --sizes 10000,100000 --shards 7
+"""
+import re
+import json
+import time
+import argparse
+import tempfile
+from datetime import date
+from google.cloud import bigquery
+from test.bq_test_helper import BiqQueryTest
+from test.ga4_event_generator import add_generator_arguments, generator_from_arguments
+
+IDENTITY_TABLES = [
+    'identity_match', 'alternate_identity_match', 'identity_match_history',
+    'alternate_identity_match_history', 'identity_match_run_state', 'identity_match_lease',
+    'identity_match_run_log', 'identity_cluster', 'identity_graph_manifest', 'identity_match_intraday_state'
+]
+
+STAGE_PATTERNS = [
+    (re.compile(r'^CREATE\s+(?:OR\s+REPLACE\s+)?TEMP(?:ORARY)?\s+TABLE\s+[`"]?([\w.-]+)', re.I), 'create {}'),
+    (re.compile(r'^INSERT\s+(?:INTO\s+)?[`"]?([\w.*"-]+)', re.I), 'insert {}'),
+    (re.compile(r'^MERGE\s+(?:INTO\s+)?[`"]?([\w.*"-]+)', re.I), 'merge {}'),
+    (re.compile(r'^DELETE\s+(?:FROM\s+)?[`"]?([\w.*"-]+)', re.I), 'delete {}'),
+    (re.compile(r'^UPDATE\s+[`"]?([\w.*"-]+)', re.I), 'update {}'),
+    (re.compile(r'^SET\s*\(?\s*(\w+)', re.I), 'set {}'),
+]
+
+
+def stage_name(query):
+    """Short name for a statement of the procedure, e.g. merge identity_match."""
+    query = query.strip()
+    for pattern, name in STAGE_PATTERNS:
+        match = pattern.match(query)
+        if match:
+            return name.format(match.group(1).replace('"', '').split('.')[-1])
+    return query.split(None, 1)[0].lower() if query else ''
+
+
+def create_tables(helper, suffixes):
+    """Creates the identity tables and an events_ shard per suffix."""
+    helper.create_table('', 'events', key='events_*', path='bigquery/schemas', use_root_path=True)
+    events_schema = helper.tables['events']['table'].schema
+    for suffix in suffixes:
+        name = f'events_{suffix}'
+        table_ref = f'{helper.project}.{helper.dataset}.{name}'
+        table = bigquery.Table(table_ref, events_schema)
+        helper.client.create_table(table)
+        helper.tables[name] = {'table': table, 'key': name, 'table_name': name, 'table_ref': table_ref}
+    for name in IDENTITY_TABLES:
+        helper.create_table('', name, path='bigquery/schemas', use_root_path=True)
+
+    helper.client.query(helper.load_template(
+        '', 'bigquery/procedures/update_identity_cluster.sql', use_root_path=True)).result()
+    # the Parquet export is left out of the benchmark
+    helper.client.query(helper.load_template('', 'bigquery/procedures/export_identity_graph.sql', overrides={
+        'export_uri': '',
+        'snapshot_days': 7
+    }, use_root_path=True)).result()
+    helper.client.query(helper.load_template('', 'bigquery/procedures/update_identity_match.sql', overrides={
+        'ga4_project': helper.project,
+        'ga4_dataset': helper.dataset,
+        'intraday_lookback_seconds': 600
+    }, use_root_path=True)).result()
+
+
+def run_size(helper, paths):
+    """Loads the shards, calls the procedure and returns its per-stage stats."""
+    create_tables(helper, paths)
+    load_started = time.perf_counter()
+    for suffix, path in paths.items():
+        helper.load_table_from_ndjson(f'events_{suffix}', path)
+    load_seconds = time.perf_counter() - load_started
+
+    started = time.perf_counter()
+    job = helper.client.query(
+        f"CALL `{helper.project}.{helper.dataset}.update_identity_match`(NULL, NULL, NULL)",
+        location=helper.location
+    )
+    job.result()
+    wall_seconds = time.perf_counter() - started
+
+    stages = []
+    children = sorted(helper.client.list_jobs(parent_job=job.job_id), key=lambda child: child.started)
+    for child in children:
+        stages.append({
+            'stage': stage_name(child.query or ''),
+            'statement_type': child.statement_type,
+            'wall_ms': round((child.ended - child.started).total_seconds() * 1000, 1),
+            'rows': child.num_dml_affected_rows,
+            'bytes_processed': child.total_bytes_processed,
+        })
+    stages.append({
+        'stage': 'total',
+        'statement_type': 'SCRIPT',
+        'wall_ms': round(wall_seconds * 1000, 1),
+        'rows': None,
+        'bytes_processed': job.total_bytes_processed,
+    })
+    return load_seconds, stages
+
+
+def run_benchmark(generator, sizes, shards, backend='local', project='nzaa-mkt-guid',
+                  dataset='benchmark_identity_resolution', start_date=date(2025, 6, 1)):
+    """Runs the procedure once per size (total events over all shards), returns a row per stage."""
+    results = []
+    for size in sizes:
+        events_per_shard = max(size // shards, 1)
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generator.write_ndjson(directory, start_date, shards, events_per_shard)
+            helper = BiqQueryTest(project, dataset, backend=backend)
+            try:
+                load_seconds, stages = run_size(helper, paths)
+            finally:
+                if backend != 'local':
+                    for name in helper.tables:
+                        helper.client.delete_table(helper.tables[name]['table_ref'], not_found_ok=True)
+        print(f"{events_per_shard * shards} events loaded in {load_seconds:.1f}s")
+        for stage in stages:
+            results.append({'events': events_per_shard * shards, 'backend': backend} | stage)
+    return results
+
+
+def print_results(results):
+    columns = ['events', 'stage', 'statement_type', 'wall_ms', 'rows', 'bytes_processed']
+    widths = {column: max(len(column), *(len(str(row[column])) for row in results)) for column in columns}
+    print('  '.join(column.ljust(widths[column]) for column in columns))
+    for row in results:
+        print('  '.join(str(row[column]).ljust(widths[column]) for column in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark update_identity_match across data sizes.")
+    parser.add_argument('--backend', choices=['local', 'bigquery'], default='local')
+    parser.add_argument('--project', default='nzaa-mkt-guid')
+    parser.add_argument('--dataset', default='benchmark_identity_resolution')
+    parser.add_argument('--sizes', default='10000,100000', help="total events per run, comma separated")
+    parser.add_argument('--shards', type=int, default=7, help="daily events_ shards the events are spread over")
+    parser.add_argument('--output', help="JSON file for the results")
+    add_generator_arguments(parser)
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(
+        generator_from_arguments(args),
+        [int(size) for size in args.sizes.split(',')],
+        args.shards,
+        backend=args.backend,
+        project=args.project,
+        dataset=args.dataset
+    )
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import os
+import copy
 import json
 import uuid
+import hashlib
 import re
 from string import Template
 from google.cloud import bigquery
@@ -10,15 +12,46 @@ load_dotenv()
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+TEMPLATE_VARIABLE = re.compile(r'\$\{(\w+)\}')
+
+# fixture values wrapped in _ are SQL expressions for initialise_table, the
+# ones a load job can take are converted by to_load_value
+SQL_NULL = re.compile(r'^_(NULL|CAST\(NULL AS \w+\))_$')
+SQL_LITERAL = re.compile(r'^_(DATE|DATETIME|TIME|TIMESTAMP|NUMERIC|BIGNUMERIC)\("(.*)"\)_$', re.DOTALL)
+
+# tables left in an isolated dataset by an interrupted run expire after a day
+ISOLATED_TABLE_EXPIRATION_MS = 24 * 60 * 60 * 1000
+
+
+def worker_dataset(dataset):
+    """A dataset name unique to the pytest-xdist worker and run, e.g. test_identity_resolution_gw1_3f2a9c1e."""
+    worker = os.getenv('PYTEST_XDIST_WORKER', 'main')
+    return f"{dataset}_{worker}_{uuid.uuid4().hex[:8]}"
+
 
 class BiqQueryTest:
 
-    def __init__(self, project=None, dataset=None):
+    def __init__(self, project=None, dataset=None, backend=None, isolated=False):
         self.project = os.getenv('TEST_PROJECT_ID') or project
         self.dataset = os.getenv('TEST_DATASET') or dataset
+        # an isolated helper gets a new dataset of its own, so pytest-xdist
+        # workers and concurrent runs of the suite do not share tables. It is
+        # dropped with delete_dataset.
+        self.isolated = isolated
+        if isolated:
+            self.dataset = worker_dataset(self.dataset)
         self.location = "australia-southeast1"  # Set default location
-        self.client = bigquery.Client(project=self.project)
+        # 'bigquery' runs against the test project, 'local' against an embedded
+        # DuckDB database with no GCP access (see test/local_bigquery.py)
+        self.backend = os.getenv('TEST_BACKEND') or backend or 'bigquery'
+        if self.backend == 'local':
+            from test.local_bigquery import LocalClient
+            self.client = LocalClient(project=self.project, location=self.location)
+        else:
+            self.client = bigquery.Client(project=self.project)
         self.tables = {}  # dictionary to keep track of tables created for this test
+        # golden table and rows of each fixture loaded, see initialise_table_from_fixture
+        self.fixture_cache = {}
 
         # create the test dataset if doesn't exist with specific location
         dataset_id = f"{self.project}.{self.dataset}"
@@ -27,14 +60,23 @@ class BiqQueryTest:
         # Use australia-southeast1 to match production location
         dataset.location = self.location
         dataset.description = "Test dataset for identity resolution testing"
+        if isolated:
+            dataset.default_table_expiration_ms = ISOLATED_TABLE_EXPIRATION_MS
 
         # create the test dataset if doesn't exist
         self.client.create_dataset(dataset, exists_ok=True)
 
-        # clean up old test tables
-        old_tables = self.client.list_tables(self.dataset)
-        for table in old_tables:
-            self.client.delete_table(table)
+        # clean up old test tables, a new isolated dataset has none
+        if not isolated:
+            old_tables = self.client.list_tables(self.dataset)
+            for table in old_tables:
+                self.client.delete_table(table)
+
+    # drops the test dataset and its tables, for isolated helpers once their tests are done
+    def delete_dataset(self):
+        self.client.delete_dataset(f"{self.project}.{self.dataset}", delete_contents=True, not_found_ok=True)
+        self.tables = {}
+        self.fixture_cache = {}
 
     def create_table(self, module, name, key=None, path="bigquery_schemas", use_root_path=False):
         """
@@ -66,10 +108,36 @@ class BiqQueryTest:
         schema = self.client.schema_from_json(schema_path)
         table_ref = f'{self.project}.{self.dataset}.{name}'
         table = bigquery.Table(table_ref, schema)
+        self.__apply_table_options(table, os.path.dirname(schema_path), name)
         self.client.create_table(table)
         self.tables[name] = {'table': table, 'key': key or name, 'table_name': table_name, 'table_ref': table_ref}
         return self.tables[name]
 
+    # private method to support create_table, applies the partitioning and
+    # clustering in table_options.json (shared with terraform) when present
+    def __apply_table_options(self, table, schema_dir, name):
+        options_path = f'{schema_dir}/table_options.json'
+        if not os.path.exists(options_path):
+            return
+        with open(options_path, 'r') as f:
+            options = json.load(f).get(name, {})
+        if 'time_partitioning' in options:
+            table.time_partitioning = bigquery.TimePartitioning(
+                type_=options['time_partitioning']['type'],
+                field=options['time_partitioning']['field']
+            )
+        if 'range_partitioning' in options:
+            table.range_partitioning = bigquery.RangePartitioning(
+                field=options['range_partitioning']['field'],
+                range_=bigquery.PartitionRange(
+                    start=options['range_partitioning']['start'],
+                    end=options['range_partitioning']['end'],
+                    interval=options['range_partitioning']['interval']
+                )
+            )
+        if 'clustering' in options:
+            table.clustering_fields = options['clustering']
+
     # initialise table with json structured data
     def initialise_table(self, name, data=[]):
         if self.tables[name]:
@@ -88,6 +156,54 @@ class BiqQueryTest:
         else:
             return False
 
+    # bulk load json structured data with a load job, unlike initialise_table
+    # there is no query length limit so large fixtures can be loaded
+    def load_table(self, name, data, table_ref=None):
+        rows = [self.to_load_value(row) for row in data]
+        job = self.client.load_table_from_json(
+            rows,
+            table_ref or self.tables[name]['table_ref'],
+            location=self.location,
+            job_config=self.__load_job_config(name)
+        )
+        return job.result()
+
+    # bulk load a newline delimited json file, streamed from disk as is so
+    # values must already be in load job format (no _..._ expressions)
+    def load_table_from_ndjson(self, name, path):
+        with open(path, 'rb') as f:
+            job = self.client.load_table_from_file(
+                f,
+                self.tables[name]['table_ref'],
+                location=self.location,
+                job_config=self.__load_job_config(name)
+            )
+        return job.result()
+
+    # private method to support the load methods, appends with the table schema
+    def __load_job_config(self, name):
+        return bigquery.LoadJobConfig(
+            schema=self.tables[name]['table'].schema,
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+        )
+
+    # converts the _..._ SQL expressions in fixture data to load job values
+    def to_load_value(self, value):
+        if isinstance(value, dict):
+            return {key: self.to_load_value(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.to_load_value(item) for item in value]
+        if isinstance(value, str) and value.startswith('_') and value.endswith('_'):
+            if SQL_NULL.match(value):
+                return None
+            literal = SQL_LITERAL.match(value)
+            if literal:
+                return literal.group(2)
+            if '(' in value:
+                raise ValueError(f"Cannot load SQL expression {value}, use initialise_table instead")
+        return value
+
     # private method to support json_to_insert_values
     def __handle_value_type(self, value):
         if isinstance(value, dict):
@@ -126,7 +242,7 @@ class BiqQueryTest:
             # Debug: Check if template substitution worked
             if '${' in result:
                 print(f"WARNING: Unsubstituted template variables found in {filename}")
-                print(f"Template variables: {[match for match in re.findall(r'\$\{(\w+)\}', result)]}")
+                print(f"Template variables: {re.findall(TEMPLATE_VARIABLE, result)}")
             
             return result
 
@@ -233,8 +349,42 @@ class BiqQueryTest:
 
             return fixture
 
-    # initialise table from a fixture
+    # initialise table from a fixture. Each (fixture, params, overrides, add)
+    # is loaded once into a golden table next to the test tables, later calls
+    # append it to the table with a copy job, which takes the same time
+    # whatever the size of the fixture (in memory on the local backend)
     def initialise_table_from_fixture(self, name, fixture=None, params=None, overrides=None, add=None):
-        fixture_data = self.load_fixture(fixture or name, params, overrides, add)
-        self.initialise_table(name, fixture_data)
-        return fixture_data
\ No newline at end of file
+        key = json.dumps([name, fixture or name, params, overrides, add], sort_keys=True, default=str)
+        if key not in self.fixture_cache:
+            fixture_data = self.load_fixture(fixture or name, params, overrides, add)
+            golden_ref = self.__create_golden_table(name, hashlib.sha1(key.encode()).hexdigest()[:12])
+            self.load_table(name, fixture_data, table_ref=golden_ref)
+            self.fixture_cache[key] = (golden_ref, fixture_data)
+
+        golden_ref, fixture_data = self.fixture_cache[key]
+        self.restore_table(name, golden_ref)
+        # tests are free to change the rows they get back
+        return copy.deepcopy(fixture_data)
+
+    # appends the rows of a table (e.g. a golden fixture table) to a test table
+    def restore_table(self, name, source_ref):
+        job = self.client.copy_table(
+            source_ref,
+            self.tables[name]['table_ref'],
+            location=self.location,
+            job_config=bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        )
+        return job.result()
+
+    # private method to support initialise_table_from_fixture, a table with the
+    # schema, partitioning and clustering of the test table. It is not in
+    # self.tables so start_test leaves it alone, and its name does not match
+    # the events_* wildcard.
+    def __create_golden_table(self, name, digest):
+        table = self.tables[name]['table']
+        golden_ref = f'{self.project}.{self.dataset}.golden_{name}_{digest}'
+        golden = bigquery.Table(golden_ref, table.schema)
+        golden.time_partitioning = table.time_partitioning
+        golden.clustering_fields = table.clustering_fields
+        self.client.create_table(golden)
+        return golden_ref
\ No newline at end of file
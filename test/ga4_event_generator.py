@@ -0,0 +1,200 @@
+"""
+Generates synthetic GA4 export events (bigquery/schemas/events_schema.json)
+for scale testing update_identity_match.
+
+Events come from a fixed population of identified users and anonymous
+devices. Identified events carry guid_email and the user's alternate ids
+as event_params, next to standard GA4 params to reach params_per_event.
+
+    python -m test.ga4_event_generator --output-dir /tmp/ga4 --shards 7 --events-per-shard 1000000
+"""
+import os
+import json
+import random
+import hashlib
+import argparse
+from datetime import date, datetime, timedelta, timezone
+
+# alternate id types as stored in alternate_identity_match, sent as guid_{type}
+ALTERNATE_ID_TYPES = [
+    'floodlight_id', 'gads_id', 'floodlight_gads_id', 'fb_id', 'tiktok_id', 'reddit_id', 'rws_id'
+]
+
+# share of identified users that have each alternate id
+DEFAULT_ALTERNATE_ID_MIX = {
+    'floodlight_id': 0.2,
+    'gads_id': 0.3,
+    'floodlight_gads_id': 0.1,
+    'fb_id': 0.4,
+    'tiktok_id': 0.15,
+    'reddit_id': 0.05,
+    'rws_id': 0.1,
+}
+
+EVENT_NAMES = ['page_view', 'session_start', 'user_engagement', 'scroll', 'click', 'form_submit']
+
+# standard GA4 params used to pad events to params_per_event
+STANDARD_PARAMS = [
+    ('ga_session_id', 'int'), ('ga_session_number', 'int'), ('page_location', 'string'),
+    ('page_title', 'string'), ('page_referrer', 'string'), ('engagement_time_msec', 'int'),
+    ('engaged_session_event', 'int'), ('session_engaged', 'string'), ('entrances', 'int'),
+    ('percent_scrolled', 'int'), ('source', 'string'), ('medium', 'string'), ('campaign', 'string'),
+    ('batch_ordering_id', 'int'), ('batch_page_id', 'int'), ('ignore_referrer', 'string'),
+]
+
+
+def hash_email(index):
+    return hashlib.sha256(f'user{index}@example.com'.encode()).hexdigest()
+
+
+def device_id(rng):
+    return f'{rng.randrange(10 ** 9, 10 ** 10)}.{rng.randrange(10 ** 9, 10 ** 10)}'
+
+
+def param(key, string_value=None, int_value=None):
+    return {'key': key, 'value': {
+        'string_value': string_value,
+        'int_value': int_value,
+        'float_value': None,
+        'double_value': None,
+        'set_timestamp_micros': None
+    }}
+
+
+class GA4EventGenerator:
+    """
+    Args:
+        emails: number of identified users (identity cardinality)
+        anonymous_devices: number of devices that never send guid_email
+        identified_ratio: share of events from identified users
+        cross_device_ratio: share of identified users seen on more than one device
+        max_devices: most devices a cross-device user has
+        alternate_id_mix: {alternate_id_type: share of users with that id}
+        alternate_id_churn: chance per event that an alternate id has a new value
+        params_per_event: number of non guid_* event_params per event
+        seed: random seed, the same options and seed generate the same events
+    """
+
+    def __init__(self, emails=1000, anonymous_devices=1000, identified_ratio=0.5, cross_device_ratio=0.2,
+                 max_devices=3, alternate_id_mix=None, alternate_id_churn=0.01, params_per_event=10, seed=0):
+        unknown = set(alternate_id_mix or {}) - set(ALTERNATE_ID_TYPES)
+        if unknown:
+            raise ValueError(f"Unknown alternate id types {sorted(unknown)}")
+        self.identified_ratio = identified_ratio
+        self.alternate_id_churn = alternate_id_churn
+        self.params_per_event = params_per_event
+        self.seed = seed
+
+        rng = random.Random(seed)
+        mix = DEFAULT_ALTERNATE_ID_MIX if alternate_id_mix is None else alternate_id_mix
+        self.users = []
+        for index in range(emails):
+            devices = 1
+            if max_devices > 1 and rng.random() < cross_device_ratio:
+                devices = rng.randint(2, max_devices)
+            self.users.append({
+                'hashed_email': hash_email(index),
+                'devices': [device_id(rng) for _ in range(devices)],
+                'alternate_ids': {
+                    alternate_id_type: f'{alternate_id_type.upper()}_{index}'
+                    for alternate_id_type in ALTERNATE_ID_TYPES if rng.random() < mix.get(alternate_id_type, 0)
+                }
+            })
+        self.anonymous_devices = [device_id(rng) for _ in range(anonymous_devices)]
+
+    def standard_params(self, rng):
+        params = []
+        for index in range(self.params_per_event):
+            name, kind = STANDARD_PARAMS[index % len(STANDARD_PARAMS)]
+            key = name if index < len(STANDARD_PARAMS) else f'{name}_{index // len(STANDARD_PARAMS)}'
+            if kind == 'int':
+                params.append(param(key, int_value=rng.randrange(10 ** 6)))
+            else:
+                params.append(param(key, string_value=f'{name}_{rng.randrange(100)}'))
+        return params
+
+    def events(self, event_date, count):
+        """Yields count events for the event_date daily shard."""
+        # seeded per shard so shards can be generated independently
+        rng = random.Random(f'{self.seed}_{event_date.isoformat()}')
+        day_start = int(datetime.combine(event_date, datetime.min.time(), timezone.utc).timestamp()) * 10 ** 6
+        for _ in range(count):
+            params = self.standard_params(rng)
+            if self.users and rng.random() < self.identified_ratio:
+                user = rng.choice(self.users)
+                ga_id = rng.choice(user['devices'])
+                params.append(param('guid_email', user['hashed_email']))
+                for alternate_id_type, alternate_id in user['alternate_ids'].items():
+                    if rng.random() < self.alternate_id_churn:
+                        alternate_id = f'{alternate_id}_{rng.randrange(10 ** 6)}'
+                    params.append(param(f'guid_{alternate_id_type}', alternate_id))
+                rng.shuffle(params)
+            else:
+                ga_id = rng.choice(self.anonymous_devices)
+            yield {
+                'event_date': event_date.strftime('%Y%m%d'),
+                'event_timestamp': day_start + rng.randrange(86400 * 10 ** 6),
+                'event_name': rng.choice(EVENT_NAMES),
+                'user_pseudo_id': ga_id,
+                'event_params': params,
+                'user_properties': []
+            }
+
+    def write_ndjson(self, directory, start_date, shards, events_per_shard):
+        """Writes one events_YYYYMMDD.ndjson file per daily shard, returns {suffix: path}."""
+        os.makedirs(directory, exist_ok=True)
+        paths = {}
+        for day in range(shards):
+            event_date = start_date + timedelta(days=day)
+            suffix = event_date.strftime('%Y%m%d')
+            paths[suffix] = os.path.join(directory, f'events_{suffix}.ndjson')
+            with open(paths[suffix], 'w') as f:
+                for event in self.events(event_date, events_per_shard):
+                    f.write(json.dumps(event) + '\n')
+        return paths
+
+
+def parse_mix(value):
+    """Parses fb_id=0.4,gads_id=0.3 into an alternate_id_mix."""
+    return {key: float(share) for key, share in (item.split('=') for item in value.split(',') if item)}
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--emails', type=int, default=1000, help="identified users")
+    parser.add_argument('--anonymous-devices', type=int, default=1000, help="devices without an email")
+    parser.add_argument('--identified-ratio', type=float, default=0.5, help="share of identified events")
+    parser.add_argument('--cross-device-ratio', type=float, default=0.2, help="share of users on several devices")
+    parser.add_argument('--alternate-id-mix', type=parse_mix, help="e.g. fb_id=0.4,gads_id=0.3")
+    parser.add_argument('--params-per-event', type=int, default=10, help="standard params per event")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def generator_from_arguments(args):
+    return GA4EventGenerator(
+        emails=args.emails,
+        anonymous_devices=args.anonymous_devices,
+        identified_ratio=args.identified_ratio,
+        cross_device_ratio=args.cross_device_ratio,
+        alternate_id_mix=args.alternate_id_mix,
+        params_per_event=args.params_per_event,
+        seed=args.seed
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic GA4 export events as NDJSON.")
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--start-date', type=date.fromisoformat, default=date(2025, 6, 1))
+    parser.add_argument('--shards', type=int, default=7, help="daily events_ shards")
+    parser.add_argument('--events-per-shard', type=int, default=10000)
+    add_generator_arguments(parser)
+    args = parser.parse_args(argv)
+
+    paths = generator_from_arguments(args).write_ndjson(
+        args.output_dir, args.start_date, args.shards, args.events_per_shard)
+    for suffix, path in paths.items():
+        print(f"events_{suffix}: {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+Burst load test of the Pub/Sub -> identity_match trigger path, run locally.
+
+identity_match is served by functions_framework in-process and receives
+CloudEvents built from the recorded GA4 export event, for several properties
+and days, with a share of them delivered again as Pub/Sub redeliveries. The
+BigQuery client is a fake that takes latency_ms per API call and keeps each
+submitted job running for job_seconds, holding its property's lease like
+the procedure. Deliveries that fail (e.g. the lease is held) are redelivered
+after retry_seconds, up to max_redeliveries times.
+
+Each delivery is one request on one instance (Cloud Functions 2nd gen
+handles one request per instance at a time), so the report gives the
+throughput and latency percentiles of the deliveries, the update_identity_match
+CALLs issued for a (property, shard) that already had one, and the
+instance-seconds billed (request time rounded up to 100 ms).
+
+    python -m test.load_test_identity_match --events 5000 --properties 3 --days 7 \\
+        --concurrency 100 --latency-ms 80 --job-seconds 30
+"""
+import os
+import io
+import sys
+import copy
+import json
+import math
+import time
+import base64
+import random
+import argparse
+import threading
+import contextlib
+from collections import Counter
+from concurrent import futures
+import functions_framework
+from google.api_core.exceptions import Conflict, NotFound
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTION_SOURCE = f'{ROOT_DIR}/cloud_functions/identity_match/main.py'
+RECORDED_EVENT = f'{ROOT_DIR}/test/fixtures/ga4_export_cloud_event.json'
+
+# Cloud Run bills instance time in 100 ms increments
+BILLING_INCREMENT_SECONDS = 0.1
+
+
+class FakeJob:
+    def __init__(self, job_id, rows=None, total_bytes_processed=0, done_at=0, clock=time.monotonic):
+        self.job_id = job_id
+        self.rows = rows or []
+        self.total_bytes_processed = total_bytes_processed
+        self.error_result = None
+        self.done_at = done_at
+        self.clock = clock
+
+    @property
+    def state(self):
+        return 'DONE' if self.clock() >= self.done_at else 'RUNNING'
+
+    def result(self):
+        return self.rows
+
+
+class FakeBigQueryClient:
+    """
+    The parts of bigquery.Client identity_match uses. Every call takes
+    latency seconds, CALL jobs run for job_seconds and hold the lease they
+    took until then, as update_identity_match releases it when it ends.
+    """
+
+    def __init__(self, latency=0.05, job_seconds=5.0, clock=time.monotonic):
+        self.latency = latency
+        self.job_seconds = job_seconds
+        self.clock = clock
+        self.jobs = {}
+        self.leases = {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get_job(self, job_id, location=None):
+        time.sleep(self.latency)
+        with self.lock:
+            if job_id not in self.jobs:
+                raise NotFound(job_id)
+            return self.jobs[job_id]
+
+    def query(self, sql, job_config=None, job_id=None, **kwargs):
+        time.sleep(self.latency)
+        parameters = [parameter.value for parameter in getattr(job_config, 'query_parameters', None) or []]
+        with self.lock:
+            if job_config is not None and job_config.dry_run:
+                return FakeJob(None, clock=self.clock)
+            if 'identity_match_run_state' in sql:
+                return FakeJob(None, rows=[{'high_water_mark': None}], clock=self.clock)
+            if 'acquire_identity_match_lease' in sql:
+                return FakeJob(None, rows=[{'acquired': self.acquire(*parameters)}], clock=self.clock)
+            if 'release_identity_match_lease' in sql:
+                self.leases = {name: lease for name, lease in self.leases.items() if lease[0] != parameters[0]}
+                return FakeJob(None, clock=self.clock)
+            if 'identity_match_lease' in sql:
+                lease = self.leases.get(parameters[0])
+                return FakeJob(None, rows=[{'holder': lease[0]}] if lease else [], clock=self.clock)
+
+            if job_id in self.jobs:
+                raise Conflict(job_id)
+            start_suffix, end_suffix, source = parameters
+            self.jobs[job_id] = FakeJob(job_id, done_at=self.clock() + self.job_seconds, clock=self.clock)
+            self.calls.append((source, start_suffix, end_suffix, job_id))
+            return self.jobs[job_id]
+
+    def acquire(self, name, holder, lease_seconds):
+        lease = self.leases.get(name)
+        if lease is not None and lease[0] != holder:
+            held_by, expires_at = lease
+            running = held_by in self.jobs and self.jobs[held_by].state != 'DONE'
+            # a lease taken for a job that was never submitted is only held until it expires
+            if running or (held_by not in self.jobs and expires_at > self.clock()):
+                return False
+        self.leases[name] = (holder, self.clock() + lease_seconds)
+        return True
+
+
+def load_recorded_event():
+    with open(RECORDED_EVENT, 'r') as f:
+        return json.load(f)
+
+
+def build_events(count, properties=3, days=7, redelivery_ratio=0.1, seed=1):
+    """
+    count CloudEvents (attributes, data) of daily exports, one per message.
+    The exports cycle over properties x days, and redelivery_ratio of the
+    events are redeliveries of an earlier message.
+    """
+    recorded = load_recorded_event()
+    log_entry = json.loads(base64.b64decode(recorded['data']['message']['data']))
+    rng = random.Random(seed)
+    events = []
+    for position in range(count):
+        if events and rng.random() < redelivery_ratio:
+            events.append(rng.choice(events))
+            continue
+        export = position % (properties * days)
+        entry = copy.deepcopy(log_entry)
+        table = (entry['protoPayload']['serviceData']['jobCompletedEvent']['job']
+                 ['jobConfiguration']['load']['destinationTable'])
+        table['datasetId'] = f"analytics_{291449711 + export % properties}"
+        table['tableId'] = f"events_202506{1 + export // properties:02d}"
+
+        message_id = str(11672954012345678 + position)
+        attributes = recorded['attributes'] | {'id': message_id}
+        data = copy.deepcopy(recorded['data'])
+        data['message'] |= {
+            'data': base64.b64encode(json.dumps(entry).encode()).decode(),
+            'messageId': message_id,
+            'message_id': message_id
+        }
+        events.append((attributes, data))
+    return events
+
+
+def property_datasets(properties):
+    return [f"nzaa-datasets.analytics_{291449711 + offset}" for offset in range(properties)]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+@contextlib.contextmanager
+def function_app(client, environment):
+    """
+    The identity_match function served by functions_framework, with client
+    as its BigQuery client. The environment and the main module are
+    restored afterwards.
+    """
+    saved = {name: os.environ.get(name) for name in environment}
+    saved_module = sys.modules.get('main')
+    os.environ.update(environment)
+    try:
+        app = functions_framework.create_app(target='identity_match', source=FUNCTION_SOURCE,
+                                             signature_type='cloudevent')
+        # the module functions_framework loaded the function from
+        sys.modules['main']._client = client
+        yield app
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        if saved_module is not None:
+            sys.modules['main'] = saved_module
+
+
+def run_load_test(events, properties=3, concurrency=50, latency=0.05, job_seconds=5.0,
+                  max_redeliveries=3, retry_seconds=0.5, verbose=False):
+    """Delivers the events to identity_match, concurrency at a time, and returns the report."""
+    client = FakeBigQueryClient(latency=latency, job_seconds=job_seconds)
+    environment = {
+        'PROJECT_ID': 'nzaa-mkt-guid',
+        'DATASET_ID': 'identity_resolution_load_test',
+        'GA4_DATASETS': ','.join(property_datasets(properties)),
+        'MAX_CONCURRENT_RUNS': '4',
+    }
+    lock = threading.Lock()
+    deliveries = []
+    in_flight = [0, 0]  # current, peak
+
+    def deliver(app, event):
+        attributes, data = event
+        http = app.test_client()
+        for attempt in range(max_redeliveries + 1):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight[1], in_flight[0])
+            started = time.perf_counter()
+            response = http.post('/', json=attributes | {'data': data},
+                                 headers={'Content-Type': 'application/cloudevents+json'})
+            elapsed = time.perf_counter() - started
+            with lock:
+                in_flight[0] -= 1
+                deliveries.append((elapsed, response.status_code))
+            if response.status_code < 300:
+                return True
+            if attempt < max_redeliveries:
+                time.sleep(retry_seconds)
+        return False
+
+    output = sys.stdout if verbose else io.StringIO()
+    with function_app(client, environment) as app:
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output), \
+                futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            delivered = list(executor.map(lambda event: deliver(app, event), events))
+    wall_seconds = time.perf_counter() - started
+
+    latencies = [elapsed for elapsed, _ in deliveries]
+    calls = Counter((source, start_suffix, end_suffix) for source, start_suffix, end_suffix, _ in client.calls)
+    return {
+        'events': len(events),
+        'deliveries': len(deliveries),
+        'failed_deliveries': sum(1 for _, status in deliveries if status >= 300),
+        'undelivered_events': delivered.count(False),
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_per_second': round(len(deliveries) / wall_seconds, 1),
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'latency_p90_ms': round(percentile(latencies, 0.9) * 1000, 1),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'latency_max_ms': round(max(latencies) * 1000, 1),
+        'calls': len(client.calls),
+        'duplicate_calls': sum(count - 1 for count in calls.values()),
+        'peak_instances': in_flight[1],
+        'instance_seconds': round(sum(
+            math.ceil(elapsed / BILLING_INCREMENT_SECONDS) * BILLING_INCREMENT_SECONDS for elapsed in latencies
+        ), 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Burst load test of the identity_match trigger path.")
+    parser.add_argument('--events', type=int, default=2000, help="CloudEvents delivered, redeliveries included")
+    parser.add_argument('--properties', type=int, default=3, help="GA4 properties exporting")
+    parser.add_argument('--days', type=int, default=7, help="daily shards per property")
+    parser.add_argument('--redelivery-ratio', type=float, default=0.1, help="share of events delivered again")
+    parser.add_argument('--concurrency', type=int, default=50, help="deliveries in flight at the same time")
+    parser.add_argument('--latency-ms', type=float, default=50, help="latency of each BigQuery API call")
+    parser.add_argument('--job-seconds', type=float, default=5, help="run time of each update_identity_match job")
+    parser.add_argument('--max-redeliveries', type=int, default=3, help="redeliveries of a failed delivery")
+    parser.add_argument('--retry-seconds', type=float, default=0.5, help="delay before a redelivery")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="show the function's logs and errors")
+    args = parser.parse_args(argv)
+
+    events = build_events(args.events, args.properties, args.days, args.redelivery_ratio, args.seed)
+    report = run_load_test(
+        events, properties=args.properties, concurrency=args.concurrency, latency=args.latency_ms / 1000,
+        job_seconds=args.job_seconds, max_redeliveries=args.max_redeliveries, retry_seconds=args.retry_seconds,
+        verbose=args.verbose
+    )
+    width = max(len(name) for name in report)
+    for name, value in report.items():
+        print(f"{name.ljust(width)}  {value}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
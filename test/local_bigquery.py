@@ -0,0 +1,1205 @@
+"""
+Local stand-in for google.cloud.bigquery.Client on an embedded DuckDB database.
+
+BiqQueryTest uses it when TEST_BACKEND=local, so the procedure tests run
+without GCP credentials or network. It covers the BigQuery features the
+procedures and tests use rather than the whole dialect:
+
+- datasets as DuckDB schemas, tables created from BigQuery schemas with
+  RECORD and REPEATED columns as STRUCT and LIST types
+- `project.dataset.events_*` wildcard tables with _TABLE_SUFFIX
+- UNNEST of arrays in FROM/JOIN and IN UNNEST(...)
+- scripting: DECLARE, SET, IF, WHILE, BEGIN ... EXCEPTION WHEN ERROR, RAISE,
+  transactions, @@row_count/@@error.message/@@script.job_id
+- CREATE PROCEDURE and CALL (with OUT arguments), query parameters, load jobs (NDJSON)
+  and copy jobs, which copy the rows in memory
+- EXECUTE IMMEDIATE (with USING), and EXPORT DATA to local paths as Parquet/JSON/CSV
+
+BigQuery TIMESTAMP values are kept as UTC DATETIMEs (naive datetimes).
+"""
+import os
+import re
+import glob
+import json
+import uuid
+import tempfile
+import threading
+from collections import ChainMap
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+import duckdb
+from google.api_core.exceptions import BadRequest, Conflict, GoogleAPICallError, NotFound
+from google.cloud import bigquery
+from google.cloud.bigquery.table import Row
+
+TYPES = {
+    'STRING': 'VARCHAR',
+    'BYTES': 'BLOB',
+    'INT64': 'BIGINT',
+    'INTEGER': 'BIGINT',
+    'FLOAT64': 'DOUBLE',
+    'FLOAT': 'DOUBLE',
+    'NUMERIC': 'DECIMAL(38, 9)',
+    'BIGNUMERIC': 'DECIMAL(38, 9)',
+    'BOOL': 'BOOLEAN',
+    'BOOLEAN': 'BOOLEAN',
+    'DATE': 'DATE',
+    'DATETIME': 'TIMESTAMP',
+    'TIMESTAMP': 'TIMESTAMP',
+    'TIME': 'TIME',
+    'JSON': 'JSON',
+}
+
+TOKEN = re.compile(r'''
+    (?P<ws>\s+)
+  | (?P<comment>--[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<str>[rR]?(?:"""(?:\\.|[^\\])*?"""|\'\'\'(?:\\.|[^\\])*?\'\'\'|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'))
+  | (?P<ident>`[^`]*`)
+  | (?P<sysvar>@@[\w.]+)
+  | (?P<param>@\w+)
+  | (?P<num>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_]\w*)
+  | (?P<op><>|!=|<=|>=|\|\||.)
+''', re.VERBOSE | re.DOTALL)
+
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r'}
+
+# words that end a FROM item, so they are never read as an alias
+CLAUSE_WORDS = {
+    'WHERE', 'LEFT', 'RIGHT', 'INNER', 'FULL', 'CROSS', 'JOIN', 'ON', 'USING', 'GROUP',
+    'ORDER', 'HAVING', 'LIMIT', 'WITH', 'UNION', 'EXCEPT', 'INTERSECT', 'QUALIFY',
+    'WINDOW', 'WHEN', 'SET', 'SELECT', 'FROM'
+}
+
+
+class Token:
+    __slots__ = ('kind', 'text')
+
+    def __init__(self, kind, text):
+        self.kind = kind
+        self.text = text
+
+    def is_word(self, *words):
+        return self.kind == 'word' and (not words or self.text.upper() in words)
+
+    def is_op(self, *ops):
+        return self.kind == 'op' and self.text in ops
+
+    def sql(self):
+        if self.kind == 'str':
+            return "'" + self.text.replace("'", "''") + "'"
+        if self.kind == 'ident':
+            return '.'.join(f'"{part}"' for part in self.text.split('.'))
+        return self.text
+
+    def __repr__(self):
+        return f'{self.kind}:{self.text}'
+
+
+def raw(text):
+    return Token('raw', text)
+
+
+def tokenize(sql):
+    tokens = []
+    for match in TOKEN.finditer(sql):
+        kind, text = match.lastgroup, match.group()
+        if kind in ('ws', 'comment'):
+            continue
+        if kind == 'str':
+            is_raw = text[0] in 'rR'
+            text = text[1:] if is_raw else text
+            quote = 3 if text[:3] in ('"""', "'''") else 1
+            text = text[quote:-quote]
+            if not is_raw:
+                text = re.sub(r'\\(.)', lambda m: ESCAPES.get(m.group(1), m.group(1)), text)
+        elif kind == 'ident':
+            text = text[1:-1]
+        tokens.append(Token(kind, text))
+    return tokens
+
+
+def render(tokens):
+    sql = ''
+    previous = None
+    for token in tokens:
+        text = token.sql()
+        if previous is not None and not (
+                text in ('.', ')', ',', ']') or previous.sql() in ('.', '(', '[')
+                or (text == '(' and previous.kind in ('word', 'ident'))):
+            sql += ' '
+        sql += text
+        previous = token
+    return sql
+
+
+def closing(tokens, i):
+    """Index of the bracket closing the one at tokens[i]."""
+    pairs = {'(': ')', '[': ']'}
+    opener, depth = tokens[i].text, 0
+    for j in range(i, len(tokens)):
+        if tokens[j].is_op(opener):
+            depth += 1
+        elif tokens[j].is_op(pairs[opener]):
+            depth -= 1
+            if depth == 0:
+                return j
+    raise BadRequest(f"Unbalanced {opener} in query")
+
+
+def split_top_level(tokens, separator=','):
+    """Splits tokens on separator outside of brackets."""
+    parts, current, depth = [], [], 0
+    for token in tokens:
+        if token.is_op('(', '['):
+            depth += 1
+        elif token.is_op(')', ']'):
+            depth -= 1
+        if depth == 0 and token.is_op(separator):
+            parts.append(current)
+            current = []
+        else:
+            current.append(token)
+    if current:
+        parts.append(current)
+    return parts
+
+
+def duck_type(tokens):
+    """DuckDB type for BigQuery type tokens, e.g. ARRAY<STRUCT<a STRING>>."""
+    result, i = _parse_type(tokens, 0)
+    return result
+
+
+def _parse_type(tokens, i):
+    name = tokens[i].text.upper()
+    i += 1
+    if name in ('ARRAY', 'STRUCT') and i < len(tokens) and tokens[i].is_op('<'):
+        depth, j = 0, i
+        for j in range(i, len(tokens)):
+            if tokens[j].is_op('<'):
+                depth += 1
+            elif tokens[j].is_op('>'):
+                depth -= 1
+                if depth == 0:
+                    break
+        # split on the commas outside nested ARRAY<...>/STRUCT<...> and (...)
+        members, depth = [[]], 0
+        for token in tokens[i + 1:j]:
+            if token.is_op('<', '('):
+                depth += 1
+            elif token.is_op('>', ')'):
+                depth -= 1
+            if depth == 0 and token.is_op(','):
+                members.append([])
+            else:
+                members[-1].append(token)
+        if name == 'ARRAY':
+            return f'{_parse_type(members[0], 0)[0]}[]', j + 1
+        fields = ', '.join(f'"{member[0].text}" {_parse_type(member, 1)[0]}' for member in members)
+        return f'STRUCT({fields})', j + 1
+    # parameterised types, e.g. STRING(10) or NUMERIC(10, 2)
+    if i < len(tokens) and tokens[i].is_op('('):
+        i = closing(tokens, i) + 1
+    if name not in TYPES:
+        raise BadRequest(f"Unsupported type {name}")
+    return TYPES[name], i
+
+
+def field_type(field):
+    """DuckDB column type for a bigquery.SchemaField."""
+    if field.field_type in ('RECORD', 'STRUCT'):
+        members = ', '.join(f'"{sub.name}" {field_type(sub)}' for sub in field.fields)
+        column_type = f'STRUCT({members})'
+    else:
+        column_type = TYPES[field.field_type]
+    return f'{column_type}[]' if field.mode == 'REPEATED' else column_type
+
+
+def literal(value, column_type=None):
+    """SQL literal for a Python value, cast to column_type when given."""
+    if value is None:
+        sql = 'NULL'
+    elif isinstance(value, bool):
+        sql = 'TRUE' if value else 'FALSE'
+    elif isinstance(value, (int, float, Decimal)):
+        sql = str(value)
+    elif isinstance(value, datetime):
+        if value.tzinfo:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        sql = f"TIMESTAMP '{value.isoformat(sep=' ')}'"
+    elif isinstance(value, date):
+        sql = f"DATE '{value.isoformat()}'"
+    elif isinstance(value, time):
+        sql = f"TIME '{value.isoformat()}'"
+    elif isinstance(value, (list, tuple)):
+        sql = '[' + ', '.join(literal(item) for item in value) + ']'
+    elif isinstance(value, dict):
+        sql = '{' + ', '.join(f"'{key}': {literal(item)}" for key, item in value.items()) + '}'
+    else:
+        sql = "'" + str(value).replace("'", "''") + "'"
+    return f'CAST({sql} AS {column_type})' if column_type else sql
+
+
+class LocalQueryJob:
+    """Finished query job, errors are raised from result() like a BigQuery job."""
+
+    def __init__(self, job_id, query, rows=None, columns=None, error=None, num_dml_affected_rows=None):
+        self.job_id = job_id
+        self.query = query
+        self.state = 'DONE'
+        self.error = error
+        self.error_result = {'reason': 'invalidQuery', 'message': error.message} if error else None
+        self.num_dml_affected_rows = num_dml_affected_rows
+        # not measured locally
+        self.total_bytes_processed = None
+        self.total_bytes_billed = None
+        self.slot_millis = None
+        self.cache_hit = False
+        self.statement_type = None
+        self.parent_job_id = None
+        self.started = None
+        self.ended = None
+        self.columns = columns or []
+        self.rows = [
+            Row(values, {name: index for index, name in enumerate(self.columns)}) for values in rows or []
+        ]
+
+    def done(self):
+        return True
+
+    def result(self, *args, **kwargs):
+        if self.error:
+            raise self.error
+        return self.rows
+
+    def to_dataframe(self, *args, **kwargs):
+        import pandas
+        return pandas.DataFrame([list(row.values()) for row in self.result()], columns=self.columns)
+
+
+class LocalClient:
+    """The parts of bigquery.Client the tests use, on an in-memory DuckDB database."""
+
+    def __init__(self, project=None, location=None, database=':memory:'):
+        self.project = project
+        self.location = location
+        self.connection = duckdb.connect(database)
+        self.schemas = {}
+        self.procedures = {}
+        self.jobs = {}
+        self.lock = threading.RLock()
+
+    # table and dataset references are project.dataset.table, the project is
+    # not part of the local catalog
+    def table_path(self, reference):
+        if isinstance(reference, (bigquery.Table, bigquery.TableReference)):
+            return reference.dataset_id, reference.table_id
+        if hasattr(reference, 'reference'):
+            return reference.reference.dataset_id, reference.reference.table_id
+        parts = str(reference).split('.')
+        if len(parts) < 2:
+            raise BadRequest(f"Table {reference} must be qualified with a dataset")
+        return parts[-2], parts[-1]
+
+    def table_columns(self, dataset_id, table_id):
+        rows = self.connection.execute(
+            "SELECT column_name FROM duckdb_columns() WHERE schema_name = ? AND table_name = ?",
+            [dataset_id, table_id]
+        ).fetchall()
+        return [row[0].lower() for row in rows]
+
+    def temp_table_columns(self, table_id):
+        rows = self.connection.execute(
+            "SELECT column_name FROM duckdb_columns() WHERE database_name = 'temp' AND table_name = ?", [table_id]
+        ).fetchall()
+        return [row[0].lower() for row in rows]
+
+    def wildcard_tables(self, dataset_id, prefix):
+        rows = self.connection.execute(
+            "SELECT table_name FROM duckdb_tables() WHERE schema_name = ? ORDER BY table_name", [dataset_id]
+        ).fetchall()
+        return [row[0] for row in rows if row[0].startswith(prefix)]
+
+    def create_dataset(self, dataset, exists_ok=False, **kwargs):
+        dataset_id = getattr(dataset, 'dataset_id', None) or str(dataset).split('.')[-1]
+        with self.lock:
+            exists = self.connection.execute(
+                "SELECT COUNT(*) FROM duckdb_schemas() WHERE schema_name = ?", [dataset_id]
+            ).fetchone()[0]
+            if exists and not exists_ok:
+                raise Conflict(f"Already Exists: Dataset {self.project}:{dataset_id}")
+            self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{dataset_id}"')
+        return dataset
+
+    def delete_dataset(self, dataset, delete_contents=False, not_found_ok=False, **kwargs):
+        dataset_id = getattr(dataset, 'dataset_id', None) or str(dataset).split('.')[-1]
+        with self.lock:
+            self.connection.execute(
+                f'DROP SCHEMA {"IF EXISTS " if not_found_ok else ""}"{dataset_id}"'
+                f'{" CASCADE" if delete_contents else ""}'
+            )
+
+    def list_tables(self, dataset, **kwargs):
+        dataset_id = getattr(dataset, 'dataset_id', None) or str(dataset).split('.')[-1]
+        with self.lock:
+            return [bigquery.Table(f'{self.project}.{dataset_id}.{name}')
+                    for name in self.wildcard_tables(dataset_id, '')]
+
+    def schema_from_json(self, file_or_path):
+        if isinstance(file_or_path, str):
+            with open(file_or_path, 'r') as f:
+                return [bigquery.SchemaField.from_api_repr(field) for field in json.load(f)]
+        return [bigquery.SchemaField.from_api_repr(field) for field in json.load(file_or_path)]
+
+    def create_table(self, table, exists_ok=False, **kwargs):
+        if isinstance(table, str):
+            table = bigquery.Table(table)
+        dataset_id, table_id = self.table_path(table)
+        columns = ', '.join(f'"{field.name}" {field_type(field)}' for field in table.schema)
+        with self.lock:
+            if self.table_columns(dataset_id, table_id):
+                if exists_ok:
+                    return table
+                raise Conflict(f"Already Exists: Table {self.project}:{dataset_id}.{table_id}")
+            self.connection.execute(f'CREATE TABLE "{dataset_id}"."{table_id}" ({columns})')
+            self.schemas[(dataset_id, table_id)] = list(table.schema)
+        return table
+
+    def get_table(self, reference):
+        dataset_id, table_id = self.table_path(reference)
+        with self.lock:
+            if not self.table_columns(dataset_id, table_id):
+                raise NotFound(f"Not found: Table {self.project}:{dataset_id}.{table_id}")
+        return bigquery.Table(f'{self.project}.{dataset_id}.{table_id}',
+                              self.schemas.get((dataset_id, table_id)))
+
+    def delete_table(self, table, not_found_ok=False, **kwargs):
+        dataset_id, table_id = self.table_path(table)
+        with self.lock:
+            if not self.table_columns(dataset_id, table_id):
+                if not_found_ok:
+                    return
+                raise NotFound(f"Not found: Table {self.project}:{dataset_id}.{table_id}")
+            self.connection.execute(f'DROP TABLE "{dataset_id}"."{table_id}"')
+            self.schemas.pop((dataset_id, table_id), None)
+
+    def get_job(self, job_id, **kwargs):
+        if job_id not in self.jobs:
+            raise NotFound(f"Not found: Job {self.project}:{job_id}")
+        return self.jobs[job_id]
+
+    def query(self, query, job_config=None, location=None, job_id=None, job_id_prefix=None, **kwargs):
+        if job_id in self.jobs:
+            raise Conflict(f"Already Exists: Job {self.project}:{job_id}")
+        job_id = job_id or f'{job_id_prefix or "job_"}{uuid.uuid4().hex}'
+        parameters = {}
+        for parameter in getattr(job_config, 'query_parameters', None) or []:
+            if isinstance(parameter, bigquery.ArrayQueryParameter):
+                parameters[parameter.name.lower()] = literal(
+                    parameter.values, f'{TYPES[parameter.array_type]}[]')
+            else:
+                parameters[parameter.name.lower()] = literal(parameter.value, TYPES[parameter.type_])
+
+        with self.lock:
+            started = datetime.now(timezone.utc)
+            script = Script(self, job_id, parameters)
+            try:
+                script.run(tokenize(query))
+                job = LocalQueryJob(job_id, query, script.rows, script.columns,
+                                    num_dml_affected_rows=script.dml_rows)
+            except (GoogleAPICallError, duckdb.Error) as error:
+                if not isinstance(error, GoogleAPICallError):
+                    error = BadRequest(str(error))
+                job = LocalQueryJob(job_id, query, error=error)
+            finally:
+                script.drop_temp_tables()
+        job.started, job.ended = started, datetime.now(timezone.utc)
+        if len(script.children) == 1:
+            job.statement_type = script.children[0].statement_type
+        else:
+            job.statement_type = 'SCRIPT'
+            for child in script.children:
+                self.jobs[child.job_id] = child
+        self.jobs[job_id] = job
+        return job
+
+    def list_jobs(self, parent_job=None, **kwargs):
+        """Jobs newest first like BigQuery, the statements of a script with parent_job."""
+        parent_job_id = getattr(parent_job, 'job_id', parent_job)
+        jobs = [job for job in self.jobs.values() if parent_job is None or job.parent_job_id == parent_job_id]
+        return list(reversed(jobs))
+
+    def load_table_from_json(self, json_rows, destination, job_config=None, **kwargs):
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as f:
+            for row in json_rows:
+                f.write(json.dumps(row, default=str) + '\n')
+        try:
+            return self.load_ndjson(f.name, destination, job_config)
+        finally:
+            os.remove(f.name)
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, **kwargs):
+        source_format = getattr(job_config, 'source_format', None)
+        if source_format not in (None, bigquery.SourceFormat.NEWLINE_DELIMITED_JSON):
+            raise BadRequest(f"Only NEWLINE_DELIMITED_JSON loads are supported locally, not {source_format}")
+        with tempfile.NamedTemporaryFile('wb', suffix='.ndjson', delete=False) as f:
+            f.write(file_obj.read())
+        try:
+            return self.load_ndjson(f.name, destination, job_config)
+        finally:
+            os.remove(f.name)
+
+    def load_ndjson(self, path, destination, job_config=None):
+        dataset_id, table_id = self.table_path(destination)
+        schema = getattr(job_config, 'schema', None) or self.schemas.get((dataset_id, table_id))
+        job_id = f'load_{uuid.uuid4().hex}'
+        with self.lock:
+            if not self.table_columns(dataset_id, table_id):
+                raise NotFound(f"Not found: Table {self.project}:{dataset_id}.{table_id}")
+            if getattr(job_config, 'write_disposition', None) == bigquery.WriteDisposition.WRITE_TRUNCATE:
+                self.connection.execute(f'DELETE FROM "{dataset_id}"."{table_id}"')
+            if os.path.getsize(path):
+                columns = '{' + ', '.join(f"'{field.name}': '{field_type(field)}'" for field in schema) + '}'
+                self.connection.execute(
+                    f'INSERT INTO "{dataset_id}"."{table_id}" BY NAME '
+                    f"SELECT * FROM read_json(?, format = 'newline_delimited', columns = {columns})",
+                    [path]
+                )
+        job = LocalQueryJob(job_id, None)
+        self.jobs[job_id] = job
+        return job
+
+    def copy_table(self, sources, destination, job_config=None, **kwargs):
+        """Copies the rows of the source tables, appending unless WRITE_TRUNCATE, creating the destination if needed."""
+        if not isinstance(sources, (list, tuple)):
+            sources = [sources]
+        dataset_id, table_id = self.table_path(destination)
+        source_paths = [self.table_path(source) for source in sources]
+        job_id = f'copy_{uuid.uuid4().hex}'
+        with self.lock:
+            for source_dataset_id, source_table_id in source_paths:
+                if not self.table_columns(source_dataset_id, source_table_id):
+                    raise NotFound(f"Not found: Table {self.project}:{source_dataset_id}.{source_table_id}")
+            if not self.table_columns(dataset_id, table_id):
+                source_dataset_id, source_table_id = source_paths[0]
+                self.connection.execute(
+                    f'CREATE TABLE "{dataset_id}"."{table_id}" AS '
+                    f'SELECT * FROM "{source_dataset_id}"."{source_table_id}" LIMIT 0'
+                )
+                self.schemas[(dataset_id, table_id)] = self.schemas.get((source_dataset_id, source_table_id))
+            elif getattr(job_config, 'write_disposition', None) == bigquery.WriteDisposition.WRITE_TRUNCATE:
+                self.connection.execute(f'DELETE FROM "{dataset_id}"."{table_id}"')
+            for source_dataset_id, source_table_id in source_paths:
+                self.connection.execute(
+                    f'INSERT INTO "{dataset_id}"."{table_id}" BY NAME '
+                    f'SELECT * FROM "{source_dataset_id}"."{source_table_id}"'
+                )
+        job = LocalQueryJob(job_id, None)
+        self.jobs[job_id] = job
+        return job
+
+    def close(self):
+        self.connection.close()
+
+
+class Script:
+    """Runs a BigQuery script or query against the local client's database."""
+
+    def __init__(self, client, job_id, parameters):
+        self.client = client
+        self.connection = client.connection
+        self.job_id = job_id
+        self.parameters = parameters
+        self.rows = []
+        self.columns = []
+        self.dml_rows = None
+        self.row_count = 0
+        self.error_message = None
+        self.temp_tables = set()
+        self.children = []
+
+    def run(self, tokens):
+        statements, i = parse_block(tokens, 0, set())
+        if i < len(tokens):
+            raise BadRequest(f"Syntax error: unexpected {tokens[i].text}")
+        self.run_block(statements, ChainMap())
+
+    def drop_temp_tables(self):
+        for name in self.temp_tables:
+            self.connection.execute(f'DROP TABLE IF EXISTS temp.main."{name}"')
+
+    def run_block(self, statements, scope):
+        for statement in statements:
+            kind = statement[0]
+            if kind == 'sql':
+                self.run_statement(statement[1], scope)
+            elif kind == 'block':
+                self.run_begin(statement, scope.new_child())
+            elif kind == 'if':
+                self.run_if(statement, scope)
+            elif kind == 'while':
+                _, condition, body = statement
+                while self.evaluate(condition, scope, 'BOOLEAN'):
+                    self.run_block(body, scope.new_child())
+            elif kind == 'procedure':
+                _, name, parameters, body = statement
+                self.client.procedures[self.client.table_path(name)] = (parameters, body)
+
+    def run_begin(self, statement, scope):
+        _, body, handler = statement
+        try:
+            self.run_block(body, scope)
+        except (GoogleAPICallError, duckdb.Error) as error:
+            if handler is None:
+                raise
+            self.error_message = error.message if isinstance(error, GoogleAPICallError) else str(error)
+            self.run_block(handler, scope.new_child())
+
+    def run_if(self, statement, scope):
+        _, branches, otherwise = statement
+        for condition, body in branches:
+            if self.evaluate(condition, scope, 'BOOLEAN'):
+                self.run_block(body, scope.new_child())
+                return
+        if otherwise is not None:
+            self.run_block(otherwise, scope.new_child())
+
+    def evaluate(self, tokens, scope, column_type=None):
+        expression = render(self.translate(tokens, scope))
+        if column_type:
+            expression = f'CAST(({expression}) AS {column_type})'
+        return self.connection.execute(f'SELECT {expression}').fetchone()[0]
+
+    def assign(self, scope, name, value):
+        for variables in scope.maps:
+            if name in variables:
+                variables[name] = (variables[name][0], value)
+                return
+        raise BadRequest(f"Unrecognized name: {name}")
+
+    def variable_type(self, scope, name):
+        if name not in scope:
+            raise BadRequest(f"Unrecognized name: {name}")
+        return scope[name][0]
+
+    def run_statement(self, tokens, scope):
+        first = tokens[0].text.upper()
+        second = tokens[1].text.upper() if len(tokens) > 1 else ''
+
+        if first == 'DECLARE':
+            self.declare(tokens[1:], scope)
+        elif first == 'SET':
+            started = datetime.now(timezone.utc)
+            self.set(tokens[1:], scope)
+            self.record(tokens, 'SELECT', started)
+        elif first == 'CALL':
+            self.call(tokens[1:], scope)
+        elif first == 'EXECUTE' and second == 'IMMEDIATE':
+            self.execute_immediate(tokens[2:], scope)
+        elif first == 'EXPORT' and second == 'DATA':
+            self.export_data(tokens, scope)
+        elif first == 'RAISE':
+            message = self.error_message
+            if len(tokens) > 1:
+                # RAISE USING MESSAGE = expression
+                message = self.evaluate(tokens[4:], scope, 'VARCHAR')
+            raise BadRequest(message)
+        elif first == 'BEGIN' or (first in ('COMMIT', 'ROLLBACK') and second in ('', 'TRANSACTION')):
+            self.connection.execute({'BEGIN': 'BEGIN TRANSACTION'}.get(first, first))
+        else:
+            if first == 'CREATE' and any(token.is_word('TEMP', 'TEMPORARY') for token in tokens[1:4]):
+                name = next(token for token in tokens if token.kind in ('word', 'ident')
+                            and not token.is_word('CREATE', 'OR', 'REPLACE', 'TEMP', 'TEMPORARY', 'TABLE'))
+                self.temp_tables.add(name.text)
+            sql = render(self.translate(tokens, scope))
+            started = datetime.now(timezone.utc)
+            result = self.connection.execute(sql)
+            rows = None
+            if first in ('SELECT', 'WITH', '('):
+                self.columns = [column[0] for column in result.description]
+                self.rows = result.fetchall()
+                statement_type = 'SELECT'
+            elif first in ('INSERT', 'UPDATE', 'DELETE', 'MERGE'):
+                self.row_count = rows = result.fetchone()[0]
+                self.dml_rows = (self.dml_rows or 0) + self.row_count
+                statement_type = first
+            elif first == 'CREATE' and any(token.is_word('AS') for token in tokens):
+                # BigQuery has no row count for CREATE TABLE AS SELECT, it is
+                # kept here for the benchmark
+                rows = result.fetchone()[0]
+                statement_type = 'CREATE_TABLE_AS_SELECT'
+            else:
+                statement_type = '_'.join(token.text.upper() for token in tokens[:2])
+            self.record(tokens, statement_type, started, rows)
+
+    def record(self, tokens, statement_type, started, rows=None):
+        """Keeps a finished statement as a child job, like the statements of a BigQuery script."""
+        child = LocalQueryJob(f'{self.job_id}_{len(self.children)}', render(tokens), num_dml_affected_rows=rows)
+        child.parent_job_id = self.job_id
+        child.statement_type = statement_type
+        child.started, child.ended = started, datetime.now(timezone.utc)
+        self.children.append(child)
+
+    def declare(self, tokens, scope):
+        names, i = [], 0
+        while True:
+            names.append(tokens[i].text.lower())
+            i += 1
+            if not (i < len(tokens) and tokens[i].is_op(',')):
+                break
+            i += 1
+        default = next((j for j in range(i, len(tokens)) if tokens[j].is_word('DEFAULT')), len(tokens))
+        column_type = duck_type(tokens[i:default]) if default > i else None
+        value = None
+        if default < len(tokens):
+            if column_type is None:
+                expression = render(self.translate(tokens[default + 1:], scope))
+                column_type, value = self.connection.execute(
+                    f'SELECT typeof(value), value FROM (SELECT ({expression}) AS value)').fetchone()
+            else:
+                value = self.evaluate(tokens[default + 1:], scope, column_type)
+        for name in names:
+            scope.maps[0][name] = (column_type, value)
+
+    def set(self, tokens, scope):
+        if tokens[0].is_op('('):
+            end = closing(tokens, 0)
+            names = [part[0].text.lower() for part in split_top_level(tokens[1:end])]
+            expression = tokens[end + 2:]
+            if expression[0].is_op('('):
+                expression = expression[1:closing(expression, 0)]
+            if expression[0].is_word('SELECT'):
+                if len(expression) > 2 and expression[1].is_word('AS') and expression[2].is_word('STRUCT'):
+                    expression = expression[:1] + expression[3:]
+                casts = [self.variable_type(scope, name) for name in names]
+                select = render(self.translate(expression, scope))
+                row = self.connection.execute(select).fetchone() or (None,) * len(names)
+                values = [self.connection.execute(f'SELECT CAST(? AS {column_type})', [value]).fetchone()[0]
+                          if value is not None else None for value, column_type in zip(row, casts)]
+            else:
+                values = [self.evaluate(part, scope, self.variable_type(scope, name))
+                          for part, name in zip(split_top_level(expression), names)]
+            for name, value in zip(names, values):
+                self.assign(scope, name, value)
+        else:
+            name = tokens[0].text.lower()
+            self.assign(scope, name, self.evaluate(tokens[2:], scope, self.variable_type(scope, name)))
+
+    def execute_immediate(self, tokens, scope):
+        """EXECUTE IMMEDIATE sql [USING expression AS name, ...], the USING values bound as query parameters."""
+        using = next((i for i, token in enumerate(tokens) if token.is_word('USING') and
+                      sum(1 if t.is_op('(', '[') else -1 if t.is_op(')', ']') else 0 for t in tokens[:i]) == 0),
+                     len(tokens))
+        bound = {}
+        for item in split_top_level(tokens[using + 1:]):
+            bound[item[-1].text.lower()] = '(' + render(self.translate(item[:-2], scope)) + ')'
+        statements, _ = parse_block(tokenize(self.evaluate(tokens[:using], scope, 'VARCHAR')), 0, set())
+        parameters = self.parameters
+        self.parameters = parameters | bound
+        try:
+            # the dynamic statement does not see the script's variables
+            self.run_block(statements, ChainMap())
+        finally:
+            self.parameters = parameters
+
+    def export_data(self, tokens, scope):
+        """EXPORT DATA OPTIONS (uri = ..., format = ...) AS query, written to a local path with COPY."""
+        start = next(i for i, token in enumerate(tokens) if token.is_op('('))
+        end = closing(tokens, start)
+        options = {
+            option[0].text.lower(): self.evaluate(option[2:], scope)
+            for option in split_top_level(tokens[start + 1:end])
+        }
+        uri, export_format = options['uri'], options.get('format', 'CSV').upper()
+        if uri.startswith('gs://'):
+            raise BadRequest(f"Cannot export to {uri} with the local backend, use a local path")
+        if options.get('overwrite'):
+            for path in glob.glob(uri):
+                os.remove(path)
+        os.makedirs(os.path.dirname(uri), exist_ok=True)
+
+        started = datetime.now(timezone.utc)
+        query = render(self.translate(tokens[end + 2:], scope))
+        # the single file the local export writes stands for BigQuery's sharded files
+        path = uri.replace('*', '000000000000')
+        self.connection.execute(f"COPY ({query}) TO {literal(path)} (FORMAT {export_format})")
+        self.record(tokens, 'EXPORT_DATA', started)
+
+    def call(self, tokens, scope):
+        start = next(i for i, token in enumerate(tokens) if token.is_op('('))
+        name = ''.join(token.text for token in tokens[:start])
+        arguments = split_top_level(tokens[start + 1:closing(tokens, start)])
+        key = self.client.table_path(name)
+        if key not in self.client.procedures:
+            raise NotFound(f"Not found: Procedure {name}")
+        parameters, body = self.client.procedures[key]
+        if len(arguments) != len(parameters):
+            raise BadRequest(f"Procedure {name} expects {len(parameters)} arguments, got {len(arguments)}")
+        variables = {
+            parameter: (column_type, None if mode == 'OUT' else self.evaluate(argument, scope, column_type))
+            for (parameter, column_type, mode), argument in zip(parameters, arguments)
+        }
+        self.run_begin(body, ChainMap(variables).new_child())
+        # OUT and INOUT arguments are variables of the caller
+        for (parameter, column_type, mode), argument in zip(parameters, arguments):
+            if mode != 'IN':
+                self.assign(scope, argument[0].text.lower(), variables[parameter][1])
+
+    # -- translation of a BigQuery statement to DuckDB SQL --
+
+    def translate(self, tokens, scope):
+        return self.rewrite(self.substitute(tokens, scope), tokens)
+
+    def substitute(self, tokens, scope):
+        """Replaces variables, query parameters and system variables with literals."""
+        shadowed = self.shadowed_names(tokens)
+        result = []
+        for i, token in enumerate(tokens):
+            if token.kind == 'param':
+                name = token.text[1:].lower()
+                if name not in self.parameters:
+                    raise BadRequest(f"Query parameter '{name}' not found")
+                result.append(raw(self.parameters[name]))
+            elif token.kind == 'sysvar':
+                result.append(raw(self.system_variable(token.text.lower())))
+            elif (token.kind == 'word' and token.text.lower() in scope
+                  and token.text.lower() not in shadowed[i] and self.is_reference(tokens, i)):
+                column_type, value = scope[token.text.lower()]
+                result.append(raw(literal(value, column_type)))
+                # a variable selected on its own keeps its name as the column name
+                if self.is_select_item(tokens, i):
+                    result.append(raw(f'AS "{token.text}"'))
+            else:
+                result.append(token)
+        return result
+
+    def system_variable(self, name):
+        if name == '@@script.job_id':
+            return literal(self.job_id)
+        if name == '@@error.message':
+            return literal(self.error_message, 'VARCHAR')
+        if name == '@@row_count':
+            return literal(self.row_count, 'BIGINT')
+        if name == '@@project_id':
+            return literal(self.client.project)
+        raise BadRequest(f"Unsupported system variable {name}")
+
+    @staticmethod
+    def is_reference(tokens, i):
+        """Whether the word at i can be a value, not a field, alias, function or column list."""
+        if i > 0 and (tokens[i - 1].is_op('.') or tokens[i - 1].is_word('AS')):
+            return False
+        if i + 1 < len(tokens) and tokens[i + 1].is_op('.', '('):
+            return False
+        # INSERT [INTO] table (columns) and WHEN NOT MATCHED THEN INSERT (columns)
+        depth, j = 0, i
+        while j >= 0:
+            if tokens[j].is_op(')'):
+                depth += 1
+            elif tokens[j].is_op('('):
+                if depth == 0:
+                    before = tokens[j - 2:j]
+                    return not (any(token.is_word('INSERT', 'INTO') for token in before)
+                                and not any(token.is_word('VALUES', 'SELECT') for token in before))
+                depth -= 1
+            j -= 1
+        return True
+
+    @staticmethod
+    def is_select_item(tokens, i):
+        if i + 1 < len(tokens) and not tokens[i + 1].is_op(',', ';') and not tokens[i + 1].is_word('FROM'):
+            return False
+        if not (tokens[i - 1].is_op(',') or tokens[i - 1].is_word('SELECT', 'DISTINCT')):
+            return False
+        depth = 0
+        for token in reversed(tokens[:i]):
+            if token.is_op(')'):
+                depth += 1
+            elif token.is_op('('):
+                if depth == 0:
+                    return False
+                depth -= 1
+            elif depth == 0 and token.is_word('SELECT'):
+                return True
+            elif depth == 0 and token.is_word('FROM', 'WHERE', 'GROUP', 'ORDER', 'BY', 'SET', 'VALUES', 'ON'):
+                return False
+        return False
+
+    def shadowed_names(self, tokens):
+        """
+        Columns in scope for each token. Like BigQuery, a column of a table in
+        the query (or an enclosing query) takes precedence over a variable.
+        """
+        groups = [{'query': True, 'tables': set()}]
+        stack = [0]
+        owner = []
+        for i, token in enumerate(tokens):
+            if token.is_op('('):
+                is_query = i + 1 < len(tokens) and tokens[i + 1].is_word('SELECT', 'WITH')
+                groups.append({'query': is_query, 'tables': set()})
+                stack.append(len(groups) - 1)
+            elif token.is_op(')') and len(stack) > 1:
+                stack.pop()
+            owner.append(list(stack))
+            # tables read by the query, INSERT INTO targets are not in scope
+            if i > 0 and (tokens[i - 1].is_word('FROM', 'JOIN', 'MERGE', 'USING', 'UPDATE')
+                          or (tokens[i - 1].is_word('INTO') and tokens[i - 2].is_word('MERGE'))):
+                query = next(index for index in reversed(stack) if groups[index]['query'])
+                groups[query]['tables'].update(self.columns_of(tokens, i))
+
+        shadowed = []
+        for stack in owner:
+            names = set()
+            for index in stack:
+                if groups[index]['query']:
+                    names |= groups[index]['tables']
+            shadowed.append(names)
+        return shadowed
+
+    def columns_of(self, tokens, i):
+        token = tokens[i]
+        if token.kind == 'ident' and '.' in token.text:
+            dataset_id, table_id = self.client.table_path(token.text)
+            if table_id.endswith('*'):
+                columns = {'_table_suffix'}
+                for name in self.client.wildcard_tables(dataset_id, table_id[:-1]):
+                    columns.update(self.client.table_columns(dataset_id, name))
+                return columns
+            return set(self.client.table_columns(dataset_id, table_id))
+        if token.kind in ('word', 'ident') and not (i + 1 < len(tokens) and tokens[i + 1].is_op('(')):
+            return set(self.client.temp_table_columns(token.text))
+        return set()
+
+    def rewrite(self, tokens, context):
+        """Rewrites BigQuery functions and syntax to their DuckDB equivalents."""
+        result = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            following = tokens[i + 1] if i + 1 < len(tokens) else None
+            previous = tokens[i - 1] if i > 0 else None
+
+            if token.kind == 'ident' and '.' in token.text:
+                result.extend(self.table_reference(token))
+            elif token.kind == 'word' and following is not None and following.is_op('('):
+                end = closing(tokens, i + 1)
+                rewritten = self.function(token.text.upper(), tokens[i + 2:end], tokens, i, context)
+                if rewritten is None:
+                    result.append(token)
+                    i += 1
+                    continue
+                consumed, replacement = rewritten
+                result.extend(replacement)
+                i = end + 1 + consumed
+                continue
+            elif token.is_op('[') and following is not None \
+                    and following.is_word('OFFSET', 'SAFE_OFFSET', 'ORDINAL', 'SAFE_ORDINAL'):
+                end = closing(tokens, i + 2)
+                index = self.rewrite(tokens[i + 3:end], context)
+                if following.text.upper() in ('OFFSET', 'SAFE_OFFSET'):
+                    result.extend([raw('[('), *index, raw(') + 1]')])
+                else:
+                    result.extend([raw('['), *index, raw(']')])
+                i = end + 2
+                continue
+            elif token.is_word('EXCEPT') and previous is not None and previous.is_op('*') \
+                    and following is not None and following.is_op('('):
+                result.append(raw('EXCLUDE'))
+            elif token.is_word('DISTINCT') and previous is not None \
+                    and previous.is_word('UNION', 'EXCEPT', 'INTERSECT'):
+                pass
+            elif token.is_word('MERGE', 'INSERT') and following is not None \
+                    and following.kind == 'ident':
+                result.extend([token, raw('INTO')])
+            else:
+                result.append(token)
+            i += 1
+        return result
+
+    def table_reference(self, token):
+        dataset_id, table_id = self.client.table_path(token.text)
+        if not table_id.endswith('*'):
+            return [raw(f'"{dataset_id}"."{table_id}"')]
+        prefix = table_id[:-1]
+        tables = self.client.wildcard_tables(dataset_id, prefix)
+        if not tables:
+            raise NotFound(f"Not found: Table {token.text} does not match any table")
+        union = ' UNION ALL BY NAME '.join(
+            f"SELECT *, '{name[len(prefix):]}' AS _TABLE_SUFFIX FROM \"{dataset_id}\".\"{name}\""
+            for name in tables
+        )
+        return [raw(f'({union})')]
+
+    def function(self, name, arguments, tokens, i, context):
+        """
+        Rewrites the call of name at tokens[i], returns (tokens consumed after
+        the closing bracket, replacement) or None to leave it as is.
+        """
+        args = [self.rewrite(argument, context) for argument in split_top_level(arguments)]
+        previous = tokens[i - 1] if i > 0 else None
+
+        def call(function, *parts):
+            sql = [raw(f'{function}(')]
+            for index, part in enumerate(parts):
+                if index:
+                    sql.append(raw(','))
+                sql.extend(part)
+            return sql + [raw(')')]
+
+        if name == 'UNNEST':
+            if previous is not None and previous.is_word('IN'):
+                return 0, [raw('(SELECT UNNEST('), *args[0], raw('))')]
+            if previous is not None and (previous.is_word('FROM', 'JOIN') or
+                                         (previous.is_op(',') and self.in_from_clause(tokens, i))):
+                return self.unnest_from(tokens, i, args[0], context)
+            return None
+        if name in ('FORMAT_DATE', 'FORMAT_DATETIME', 'FORMAT_TIMESTAMP'):
+            return 0, call('strftime', args[1], args[0])
+        if name == 'PARSE_DATE':
+            return 0, [raw('CAST('), *call('strptime', args[1], args[0]), raw('AS DATE)')]
+        if name in ('PARSE_DATETIME', 'PARSE_TIMESTAMP'):
+            return 0, call('strptime', args[1], args[0])
+        if name == 'FORMAT':
+            return 0, call('printf', *args)
+        if name == 'GENERATE_UUID':
+            return 0, [raw('CAST(uuid() AS VARCHAR)')]
+        if name in ('CURRENT_TIMESTAMP', 'CURRENT_DATETIME'):
+            return 0, [raw("(now() AT TIME ZONE 'UTC')")]
+        if name == 'CURRENT_DATE':
+            return 0, [raw("CAST((now() AT TIME ZONE 'UTC') AS DATE)")]
+        if name == 'ARRAY_LENGTH':
+            return 0, call('len', *args)
+        if name == 'BYTE_LENGTH':
+            return 0, call('strlen', *args)
+        if name == 'REGEXP_CONTAINS':
+            return 0, call('regexp_matches', *args)
+        if name == 'ARRAY_CONCAT':
+            concatenated = args[0]
+            for argument in args[1:]:
+                concatenated = call('list_concat', concatenated, argument)
+            return 0, concatenated
+        if name in ('DATE', 'DATETIME', 'TIMESTAMP') and len(args) == 1:
+            return 0, [raw('CAST('), *args[0], raw(f'AS {TYPES[name]})')]
+        if name in ('DATE_ADD', 'DATE_SUB', 'DATETIME_ADD', 'DATETIME_SUB', 'TIMESTAMP_ADD', 'TIMESTAMP_SUB'):
+            # args[1] is INTERVAL n UNIT
+            interval = args[1]
+            operator = '-' if name.endswith('_SUB') else '+'
+            sql = [raw('('), *args[0], raw(f'{operator} INTERVAL ('), *interval[1:-1], raw(')'),
+                   interval[-1], raw(')')]
+            return 0, [raw('CAST('), *sql, raw('AS DATE)')] if name.startswith('DATE_') else sql
+        if name in ('DATE_DIFF', 'DATETIME_DIFF', 'TIMESTAMP_DIFF'):
+            return 0, call('date_diff', [raw(literal(args[2][0].text.lower()))], args[1], args[0])
+        if name in ('CAST', 'SAFE_CAST'):
+            position = max(index for index, token in enumerate(arguments) if token.is_word('AS'))
+            value = self.rewrite(arguments[:position], context)
+            function = 'TRY_CAST' if name == 'SAFE_CAST' else 'CAST'
+            return 0, [raw(f'{function}('), *value, raw(f'AS {duck_type(arguments[position + 1:])})')]
+        if name == 'ARRAY_AGG':
+            limit = next((index for index, token in enumerate(arguments) if token.is_word('LIMIT')), None)
+            if limit is None:
+                return None
+            aggregate = self.rewrite(arguments[:limit], context)
+            return 0, [raw('list_slice(array_agg('), *aggregate, raw('), 1,'),
+                       *self.rewrite(arguments[limit + 1:], context), raw(')')]
+        if name == 'ARRAY' and arguments and arguments[0].is_word('SELECT'):
+            if len(arguments) > 2 and arguments[1].is_word('AS') and arguments[2].is_word('STRUCT'):
+                return 0, [raw('ARRAY('), *self.select_as_struct(arguments, context), raw(')')]
+            return None
+        if name == 'STRUCT':
+            return 0, self.struct(split_top_level(arguments), context)
+        if name == 'COUNTIF':
+            return 0, call('count_if', *args)
+        if name == 'LOGICAL_OR':
+            return 0, call('bool_or', *args)
+        if name == 'LOGICAL_AND':
+            return 0, call('bool_and', *args)
+        return None
+
+    def struct(self, items, context):
+        """DuckDB struct literal for `expression [AS name]` items."""
+        fields = []
+        for index, item in enumerate(items):
+            if len(item) > 2 and item[-2].is_word('AS'):
+                field, expression = item[-1].text, item[:-2]
+            elif item[-1].kind in ('word', 'ident'):
+                field, expression = item[-1].text, item
+            else:
+                field, expression = f'_field_{index + 1}', item
+            fields.append([raw(f"'{field}':"), *self.rewrite(expression, context)])
+        sql = [raw('{')]
+        for index, field in enumerate(fields):
+            if index:
+                sql.append(raw(','))
+            sql.extend(field)
+        return sql + [raw('}')]
+
+    def select_as_struct(self, tokens, context):
+        """SELECT AS STRUCT a AS x, b AS y FROM ... as SELECT {'x': a, 'y': b} FROM ..."""
+        depth, end = 0, len(tokens)
+        for index, token in enumerate(tokens):
+            if token.is_op('(', '['):
+                depth += 1
+            elif token.is_op(')', ']'):
+                depth -= 1
+            elif depth == 0 and token.is_word('FROM'):
+                end = index
+                break
+        items = split_top_level(tokens[3:end])
+        return [raw('SELECT'), *self.struct(items, context), *self.rewrite(tokens[end:], context)]
+
+    @staticmethod
+    def in_from_clause(tokens, i):
+        depth = 0
+        for token in reversed(tokens[:i]):
+            if token.is_op(')'):
+                depth += 1
+            elif token.is_op('('):
+                if depth == 0:
+                    return False
+                depth -= 1
+            elif depth == 0 and token.is_word('FROM', 'JOIN'):
+                return True
+            elif depth == 0 and token.is_word('SELECT', 'WHERE', 'GROUP', 'ORDER', 'HAVING', 'ON', 'SET'):
+                return False
+        return False
+
+    def unnest_from(self, tokens, i, array, context):
+        """FROM/JOIN UNNEST(array) [AS] alias as a (lateral) subquery."""
+        end = closing(tokens, i + 1)
+        j = end + 1
+        if j < len(tokens) and tokens[j].is_word('AS'):
+            j += 1
+        alias = None
+        if j < len(tokens) and tokens[j].kind in ('word', 'ident') and tokens[j].text.upper() not in CLAUSE_WORDS:
+            alias = tokens[j].text
+            j += 1
+
+        # an alias used on its own names the array element, otherwise the
+        # elements are structs whose fields become columns
+        scalar = alias is not None and any(
+            token.kind in ('word', 'ident') and token.text.lower() == alias.lower()
+            and not (index + 1 < len(context) and context[index + 1].is_op('.'))
+            and not (index > 0 and context[index - 1].is_word('AS'))
+            for index, token in enumerate(context)
+            if index != self.position_in(context, tokens, j - 1)
+        )
+        if scalar:
+            sql = [raw('(SELECT UNNEST('), *array, raw(f') AS "{alias}") AS "_unnest_{alias}"')]
+        else:
+            sql = [raw('(SELECT UNNEST(_element) FROM (SELECT UNNEST('), *array, raw(') AS _element))')]
+            if alias:
+                sql.append(raw(f'AS "{alias}"'))
+
+        previous = tokens[i - 1]
+        if previous.is_word('JOIN') or previous.is_op(','):
+            sql.insert(0, raw('LATERAL'))
+        needs_on = (previous.is_word('JOIN') and not tokens[i - 2].is_word('CROSS')
+                    and not (j < len(tokens) and tokens[j].is_word('ON', 'USING')))
+        if needs_on:
+            sql.append(raw('ON TRUE'))
+        return j - end - 1, sql
+
+    @staticmethod
+    def position_in(context, tokens, index):
+        """Index in the original statement of an alias token, matched by identity."""
+        target = tokens[index]
+        for position, token in enumerate(context):
+            if token is target:
+                return position
+        return -1
+
+
+def parse_block(tokens, i, stops):
+    """Parses statements up to one starting with a word in stops."""
+    statements = []
+    while i < len(tokens):
+        if tokens[i].is_op(';'):
+            i += 1
+            continue
+        if tokens[i].is_word(*stops) and stops:
+            break
+        statement, i = parse_statement(tokens, i)
+        statements.append(statement)
+    return statements, i
+
+
+def expect(tokens, i, *words):
+    for word in words:
+        if i >= len(tokens) or not tokens[i].is_word(word):
+            found = tokens[i].text if i < len(tokens) else 'end of script'
+            raise BadRequest(f"Syntax error: expected {word} but got {found}")
+        i += 1
+    return i
+
+
+def parse_statement(tokens, i):
+    token = tokens[i]
+    following = tokens[i + 1] if i + 1 < len(tokens) else None
+
+    if token.is_word('BEGIN') and not (following and following.is_word('TRANSACTION', 'TRAN')):
+        body, i = parse_block(tokens, i + 1, {'END', 'EXCEPTION'})
+        handler = None
+        if tokens[i].is_word('EXCEPTION'):
+            i = expect(tokens, i, 'EXCEPTION', 'WHEN', 'ERROR', 'THEN')
+            handler, i = parse_block(tokens, i, {'END'})
+        return ('block', body, handler), expect(tokens, i, 'END')
+
+    if token.is_word('IF'):
+        branches, otherwise = [], None
+        while tokens[i].is_word('IF', 'ELSEIF'):
+            condition = _condition(tokens, i + 1)
+            body, i = parse_block(tokens, i + len(condition) + 2, {'ELSEIF', 'ELSE', 'END'})
+            branches.append((condition, body))
+        if tokens[i].is_word('ELSE'):
+            otherwise, i = parse_block(tokens, i + 1, {'END'})
+        return ('if', branches, otherwise), expect(tokens, i, 'END', 'IF')
+
+    if token.is_word('WHILE'):
+        condition = _condition(tokens, i + 1, 'DO')
+        body, i = parse_block(tokens, i + len(condition) + 2, {'END'})
+        return ('while', condition, body), expect(tokens, i, 'END', 'WHILE')
+
+    if token.is_word('CREATE'):
+        j = i + 1
+        while j < len(tokens) and tokens[j].is_word('OR', 'REPLACE', 'TEMP', 'TEMPORARY'):
+            j += 1
+        if j < len(tokens) and tokens[j].is_word('PROCEDURE'):
+            name = tokens[j + 1].text
+            start = j + 2
+            end = closing(tokens, start)
+            parameters = []
+            for parameter in split_top_level(tokens[start + 1:end]):
+                mode = 'IN'
+                if parameter[0].is_word('IN', 'OUT', 'INOUT'):
+                    mode, parameter = parameter[0].text.upper(), parameter[1:]
+                parameters.append((parameter[0].text.lower(), duck_type(parameter[1:]), mode))
+            j = end + 1
+            if tokens[j].is_word('OPTIONS'):
+                j = closing(tokens, j + 1) + 1
+            body, i = parse_statement(tokens, j)
+            return ('procedure', name, parameters, body), i
+
+    depth, j = 0, i
+    while j < len(tokens):
+        if tokens[j].is_op('(', '['):
+            depth += 1
+        elif tokens[j].is_op(')', ']'):
+            depth -= 1
+        elif depth == 0 and tokens[j].is_op(';'):
+            break
+        j += 1
+    return ('sql', tokens[i:j]), j
+
+
+def _condition(tokens, start, stop='THEN'):
+    """Tokens of an IF/ELSEIF/WHILE condition starting at start, up to its THEN or DO."""
+    depth = 0
+    for i in range(start, len(tokens)):
+        if tokens[i].is_word('CASE'):
+            depth += 1
+        elif tokens[i].is_word('END') and depth:
+            depth -= 1
+        elif tokens[i].is_word(stop) and depth == 0:
+            return tokens[start:i]
+    raise BadRequest(f"Syntax error: condition without {stop}")
@@ -0,0 +1,188 @@
+"""
+Bytes-processed regression gate for update_identity_match.
+
+Generated shards are loaded into the benchmark dataset, all but the last
+are processed, and the procedure is then called for the new shard alone,
+as the function does. Each statement of that CALL is a child job, and per
+stage the gate records the dataset tables it read and its scan estimate:
+
+- on BigQuery the bytes processed of the child jobs, and their referenced
+  tables, so a shard filter that stops pruning shows up as more events_
+  shards read and more bytes;
+- on the local backend, which neither prices nor prunes scans, the rows of
+  the tables the statements reference, counted before the CALL.
+
+The statements are not dry-run on their own, as most of them read the
+script's variables and temp tables. The stages are compared with the
+checked-in baseline of the backend, and the gate fails when a stage reads a
+table it did not read before, or its estimate grew by more than the
+tolerance. After an intended change the baseline is written again with
+--update-baseline.
+
+    python -m test.scan_baseline_identity_match --backend bigquery
+    python -m test.scan_baseline_identity_match --backend local --update-baseline
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import tempfile
+from datetime import date
+from test.bq_test_helper import BiqQueryTest
+from test.ga4_event_generator import GA4EventGenerator
+from test.benchmark_identity_match import create_tables, stage_name
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = f'{ROOT_DIR}/test/fixtures/scan_baseline_identity_match.json'
+
+# the baseline holds for these generated events only
+SHARDS = 7
+EVENTS_PER_SHARD = 100
+START_DATE = date(2025, 6, 1)
+
+# `project.dataset.table` as written, "project"."dataset"."table" as the local backend renders it
+TABLE_PATTERNS = [
+    re.compile(r'`([\w-]+)\.(\w+)\.([\w*]+)`'),
+    re.compile(r'"([\w-]+)"\."(\w+)"\."([\w*]+)"'),
+]
+
+
+def generator():
+    return GA4EventGenerator(emails=100, anonymous_devices=100, seed=1)
+
+
+def referenced_tables(child, dataset):
+    """The tables of dataset a child job read, by table id."""
+    if getattr(child, 'referenced_tables', None) is not None:
+        return {table.table_id for table in child.referenced_tables if table.dataset_id == dataset}
+    query = child.query or ''
+    tables = sorted(
+        (match.start(), match.group(3)) for pattern in TABLE_PATTERNS
+        for match in pattern.finditer(query) if match.group(2) == dataset
+    )
+    # the table an INSERT writes to is not read, as in BigQuery's referenced tables
+    if child.statement_type == 'INSERT':
+        tables = tables[1:]
+    return {table for _, table in tables}
+
+
+def count_rows(helper):
+    """Rows of each table of the dataset, and of the events_* wildcard."""
+    counts = {}
+    for name, table in helper.tables.items():
+        job = helper.client.query(f"SELECT COUNT(*) FROM `{table['table_ref']}`", location=helper.location)
+        counts[table['table_name']] = list(job.result())[0][0]
+    counts['events_*'] = sum(rows for name, rows in counts.items() if re.fullmatch(r'events_\d+', name))
+    return counts
+
+
+def measure_scans(helper, paths):
+    """
+    Processes all but the last shard, calls the procedure for the new shard
+    and returns {stage: {'tables': [...], 'estimate': bytes or rows}} for the
+    stages that read a table of the dataset.
+    """
+    create_tables(helper, paths)
+    for suffix, path in paths.items():
+        helper.load_table_from_ndjson(f'events_{suffix}', path)
+    procedure = f"`{helper.project}.{helper.dataset}.update_identity_match`"
+    suffixes = sorted(paths)
+    helper.client.query(
+        f"CALL {procedure}('{suffixes[0]}', '{suffixes[-2]}', NULL)", location=helper.location
+    ).result()
+
+    local = helper.backend == 'local'
+    row_counts = count_rows(helper) if local else None
+    job = helper.client.query(f"CALL {procedure}(NULL, NULL, NULL)", location=helper.location)
+    job.result()
+
+    scans = {}
+    for child in helper.client.list_jobs(parent_job=job.job_id):
+        tables = referenced_tables(child, helper.dataset)
+        if not tables:
+            continue
+        if local:
+            estimate = sum(row_counts.get(table, 0) for table in tables)
+        else:
+            estimate = child.total_bytes_processed or 0
+        scan = scans.setdefault(stage_name(child.query or ''), {'tables': set(), 'estimate': 0})
+        scan['tables'] |= tables
+        scan['estimate'] += estimate
+    return {
+        stage: {'tables': sorted(scan['tables']), 'estimate': scan['estimate']}
+        for stage, scan in sorted(scans.items())
+    }
+
+
+def run_gate(backend='local', project='nzaa-mkt-guid', dataset='benchmark_identity_resolution'):
+    """Measures the scans of the procedure on the gate's generated events."""
+    with tempfile.TemporaryDirectory() as directory:
+        paths = generator().write_ndjson(directory, START_DATE, SHARDS, EVENTS_PER_SHARD)
+        helper = BiqQueryTest(project, dataset, backend=backend)
+        try:
+            return measure_scans(helper, paths)
+        finally:
+            if backend != 'local':
+                for name in helper.tables:
+                    helper.client.delete_table(helper.tables[name]['table_ref'], not_found_ok=True)
+
+
+def compare_scans(scans, baseline, tolerance=0.1):
+    """Returns a message per stage that reads more than its baseline."""
+    regressions = []
+    for stage, scan in scans.items():
+        expected = baseline.get(stage)
+        if expected is None:
+            regressions.append(f"{stage}: new stage reading {', '.join(scan['tables'])}")
+            continue
+        new_tables = sorted(set(scan['tables']) - set(expected['tables']))
+        if new_tables:
+            regressions.append(f"{stage}: now reads {', '.join(new_tables)}")
+        if scan['estimate'] > expected['estimate'] * (1 + tolerance):
+            regressions.append(
+                f"{stage}: estimate {scan['estimate']} exceeds baseline {expected['estimate']} by more than "
+                f"{tolerance:.0%}"
+            )
+    return regressions
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bytes-processed regression gate for update_identity_match.")
+    parser.add_argument('--backend', choices=['local', 'bigquery'], default='local')
+    parser.add_argument('--project', default='nzaa-mkt-guid')
+    parser.add_argument('--dataset', default='benchmark_identity_resolution')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="JSON baseline, per backend and stage")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="growth allowed over the baseline estimate")
+    parser.add_argument('--update-baseline', action='store_true', help="write the measured scans as the baseline")
+    args = parser.parse_args(argv)
+
+    scans = run_gate(backend=args.backend, project=args.project, dataset=args.dataset)
+    baseline = load_baseline(args.baseline)
+    if args.update_baseline:
+        baseline[args.backend] = scans
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline of {len(scans)} stages written for {args.backend} to {args.baseline}")
+        return 0
+
+    if args.backend not in baseline:
+        print(f"No {args.backend} baseline in {args.baseline}, write it with --update-baseline")
+        return 1
+    regressions = compare_scans(scans, baseline[args.backend], args.tolerance)
+    for regression in regressions:
+        print(regression)
+    print(f"{len(scans)} stages checked, {len(regressions)} regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+from datetime import date
+from unittest import TestCase
+from test.benchmark_identity_match import run_benchmark, stage_name
+from test.ga4_event_generator import GA4EventGenerator
+
+
+class TestGA4EventGenerator(TestCase):
+    def test_events_match_export_shape(self):
+        events = list(GA4EventGenerator(emails=10, params_per_event=12).events(date(2025, 6, 6), 50))
+
+        self.assertEqual(len(events), 50)
+        for event in events:
+            self.assertEqual(event['event_date'], '20250606')
+            self.assertEqual(set(event), {
+                'event_date', 'event_timestamp', 'event_name', 'user_pseudo_id', 'event_params', 'user_properties'
+            })
+            standard = [p for p in event['event_params'] if not p['key'].startswith('guid_')]
+            self.assertEqual(len(standard), 12)
+            self.assertEqual(set(event['event_params'][0]['value']), {
+                'string_value', 'int_value', 'float_value', 'double_value', 'set_timestamp_micros'
+            })
+
+    def test_same_seed_same_events(self):
+        first = list(GA4EventGenerator(seed=7).events(date(2025, 6, 6), 20))
+        second = list(GA4EventGenerator(seed=7).events(date(2025, 6, 6), 20))
+        self.assertEqual(first, second)
+
+    def test_identity_options(self):
+        generator = GA4EventGenerator(
+            emails=200, identified_ratio=1.0, cross_device_ratio=1.0, max_devices=2,
+            alternate_id_mix={'fb_id': 1.0}, alternate_id_churn=0
+        )
+        events = list(generator.events(date(2025, 6, 6), 2000))
+
+        devices = {}
+        for event in events:
+            params = {p['key']: p['value']['string_value'] for p in event['event_params']}
+            self.assertIn('guid_email', params)
+            self.assertEqual(sorted(key for key in params if key.startswith('guid_')), ['guid_email', 'guid_fb_id'])
+            devices.setdefault(params['guid_email'], set()).add(event['user_pseudo_id'])
+        self.assertLessEqual(len(devices), 200)
+        self.assertTrue(all(len(ga_ids) <= 2 for ga_ids in devices.values()))
+        self.assertTrue(any(len(ga_ids) == 2 for ga_ids in devices.values()))
+
+    def test_unknown_alternate_id_type(self):
+        with self.assertRaises(ValueError):
+            GA4EventGenerator(alternate_id_mix={'myspace_id': 0.5})
+
+
+class TestBenchmarkIdentityMatch(TestCase):
+    def test_stage_name(self):
+        self.assertEqual(stage_name('MERGE `p.d.identity_match` identity_match USING ...'), 'merge identity_match')
+        self.assertEqual(stage_name('CREATE TEMP TABLE identity_events AS SELECT'), 'create identity_events')
+        self.assertEqual(stage_name('CREATE OR REPLACE TEMP TABLE new_identity_days AS'), 'create new_identity_days')
+        self.assertEqual(stage_name('UPDATE cluster_labels SET label = jump.label'), 'update cluster_labels')
+        self.assertEqual(stage_name('SET (first_shard, last_shard) = (...)'), 'set first_shard')
+
+    def test_local_benchmark(self):
+        results = run_benchmark(GA4EventGenerator(emails=50, seed=1), [300], shards=3)
+
+        stages = [row['stage'] for row in results]
+        self.assertIn('create identity_events', stages)
+        self.assertIn('merge identity_match', stages)
+        self.assertEqual(stages[-1], 'total')
+        merge = next(row for row in results if row['stage'] == 'merge identity_match')
+        self.assertGreater(merge['rows'], 0)
+        self.assertTrue(all(row['events'] == 300 and row['wall_ms'] >= 0 for row in results))
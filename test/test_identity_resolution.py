@@ -63,7 +63,8 @@ class TestIdentityResolution:
         
         # Check required fields
         field_names = {field.name for field in table.schema}
-        required_fields = {'id', 'hashed_email', 'ga_id', 'created_date', 'updated_date'}
+        required_fields = {'id', 'hashed_email', 'email_bucket', 'ga_id', 'created_date', 'first_seen', 'last_seen',
+                           'seen_count'}
         missing_fields = required_fields - field_names
         assert not missing_fields, f"Missing required fields: {missing_fields}"
         
@@ -71,9 +72,12 @@ class TestIdentityResolution:
         field_types = {field.name: field.field_type for field in table.schema}
         assert field_types['id'] == 'STRING'
         assert field_types['hashed_email'] == 'STRING'
+        assert field_types['email_bucket'] == 'INTEGER'
         assert field_types['ga_id'] == 'STRING'
         assert field_types['created_date'] == 'DATETIME'
-        assert field_types['updated_date'] == 'DATETIME'
+        assert field_types['first_seen'] == 'DATE'
+        assert field_types['last_seen'] == 'DATE'
+        assert field_types['seen_count'] == 'INTEGER'
         
         # Check field modes
         field_modes = {field.name: field.mode for field in table.schema}
@@ -81,7 +85,8 @@ class TestIdentityResolution:
         assert field_modes['hashed_email'] == 'REQUIRED'
         assert field_modes['ga_id'] == 'REQUIRED'
         assert field_modes['created_date'] == 'REQUIRED'
-        assert field_modes['updated_date'] == 'REPEATED'
+        assert field_modes['last_seen'] == 'REQUIRED'
+        assert field_modes['seen_count'] == 'REQUIRED'
     
     def test_alternate_identity_match_table_schema(self, bq_client, test_config):
         """Test alternate_identity_match table schema is correct."""
@@ -90,16 +95,36 @@ class TestIdentityResolution:
         
         # Check required fields
         field_names = {field.name for field in table.schema}
-        required_fields = {'hashed_email', 'alternate_id', 'alternate_id_type', 'updated_date'}
+        required_fields = {'hashed_email', 'email_bucket', 'alternate_id_type', 'current_alternate_id', 'first_seen',
+                           'last_seen', 'seen_count'}
         missing_fields = required_fields - field_names
         assert not missing_fields, f"Missing required fields: {missing_fields}"
         
         # Check field modes
         field_modes = {field.name: field.mode for field in table.schema}
         assert field_modes['hashed_email'] == 'REQUIRED'
-        assert field_modes['alternate_id'] == 'REPEATED'
         assert field_modes['alternate_id_type'] == 'REQUIRED'
-        assert field_modes['updated_date'] == 'REPEATED'
+        assert field_modes['current_alternate_id'] == 'REQUIRED'
+        assert field_modes['last_seen'] == 'REQUIRED'
+
+    def test_identity_tables_clustered(self, bq_client, test_config):
+        """Test identity tables are partitioned by email_bucket and clustered on their join keys."""
+        expected = {
+            'identity_match': ['hashed_email', 'ga_id'],
+            'alternate_identity_match': ['hashed_email', 'alternate_id_type'],
+        }
+        for table_name, clustering_fields in expected.items():
+            table = bq_client.get_table(f"{test_config['project_id']}.{test_config['dataset_id']}.{table_name}")
+            assert table.clustering_fields == clustering_fields
+            assert table.range_partitioning.field == 'email_bucket'
+            assert table.range_partitioning.range_.end == 4096
+
+    def test_history_tables_partitioned(self, bq_client, test_config):
+        """Test the append-only history tables are partitioned by seen_date."""
+        for table_name in ('identity_match_history', 'alternate_identity_match_history'):
+            table = bq_client.get_table(f"{test_config['project_id']}.{test_config['dataset_id']}.{table_name}")
+            assert table.time_partitioning is not None
+            assert table.time_partitioning.field == 'seen_date'
     
     def test_stored_procedure_exists(self, bq_client, test_config):
         """Test that stored procedure exists and has correct signature."""
@@ -122,10 +147,10 @@ class TestIdentityResolution:
         """Test inserting a record into identity_match table."""
         query = f"""
         INSERT INTO `{test_config['project_id']}.{test_config['dataset_id']}.identity_match`
-        (id, hashed_email, ga_id, created_date, updated_date)
+        (id, hashed_email, email_bucket, ga_id, created_date, first_seen, last_seen, seen_count)
         VALUES
-        (GENERATE_UUID(), '{test_data['hashed_email']}', '{test_data['ga_id']}', 
-         CURRENT_DATETIME(), [CURRENT_DATETIME()])
+        (GENERATE_UUID(), '{test_data['hashed_email']}', 0, '{test_data['ga_id']}', 
+         CURRENT_DATETIME(), CURRENT_DATE(), CURRENT_DATE(), 1)
         """
         
         job = bq_client.query(query)
@@ -152,12 +177,12 @@ class TestIdentityResolution:
         """Test inserting a record into alternate_identity_match table."""
         query = f"""
         INSERT INTO `{test_config['project_id']}.{test_config['dataset_id']}.alternate_identity_match`
-        (hashed_email, alternate_id, alternate_id_type, updated_date)
+        (hashed_email, email_bucket, alternate_id_type, current_alternate_id, first_seen, last_seen, seen_count)
         VALUES
-        ('{test_data['hashed_email']}', 
-         ['{test_data['fb_id']}', '{test_data['fb_id']}_2'], 
+        ('{test_data['hashed_email']}', 0,
          'fb_id', 
-         [CURRENT_DATETIME()])
+         '{test_data['fb_id']}_2', 
+         CURRENT_DATE(), CURRENT_DATE(), 2)
         """
         
         job = bq_client.query(query)
@@ -167,7 +192,8 @@ class TestIdentityResolution:
         verify_query = f"""
         SELECT 
             hashed_email,
-            ARRAY_LENGTH(alternate_id) as id_count,
+            current_alternate_id,
+            seen_count,
             alternate_id_type
         FROM `{test_config['project_id']}.{test_config['dataset_id']}.alternate_identity_match`
         WHERE hashed_email = '{test_data['hashed_email']}'
@@ -175,7 +201,8 @@ class TestIdentityResolution:
         
         results = list(bq_client.query(verify_query))
         assert len(results) == 1
-        assert results[0].id_count == 2
+        assert results[0].current_alternate_id == f"{test_data['fb_id']}_2"
+        assert results[0].seen_count == 2
         assert results[0].alternate_id_type == 'fb_id'
         
         # Cleanup
@@ -189,7 +216,7 @@ class TestIdentityResolution:
         """Test executing the stored procedure."""
         # Execute with NULL parameter
         query = f"""
-        CALL `{test_config['project_id']}.{test_config['dataset_id']}.update_identity_match`(NULL)
+        CALL `{test_config['project_id']}.{test_config['dataset_id']}.update_identity_match`(NULL, NULL, NULL)
         """
         
         job = bq_client.query(query)
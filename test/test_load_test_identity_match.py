@@ -0,0 +1,32 @@
+from unittest import TestCase
+from test.load_test_identity_match import build_events, percentile, run_load_test
+
+
+class TestLoadTestIdentityMatch(TestCase):
+    def test_build_events(self):
+        events = build_events(40, properties=2, days=3, redelivery_ratio=0.25, seed=3)
+
+        # redeliveries carry the message they repeat
+        self.assertEqual(len(events), 40)
+        messages = {}
+        for attributes, data in events:
+            self.assertEqual(messages.setdefault(attributes['id'], data), data)
+        self.assertLess(len(messages), 40)
+
+    def test_percentile(self):
+        self.assertEqual(percentile([4, 1, 3, 2], 0.5), 2)
+        self.assertEqual(percentile([4, 1, 3, 2], 0.99), 4)
+
+    def test_burst_issues_one_call_per_shard(self):
+        events = build_events(120, properties=2, days=3, redelivery_ratio=0.3)
+        report = run_load_test(events, properties=2, concurrency=16, latency=0.001, job_seconds=0,
+                               max_redeliveries=20, retry_seconds=0.01)
+
+        # redeliveries and exports of a property landing together do not start a run twice
+        self.assertEqual(report['calls'], 6)
+        self.assertEqual(report['duplicate_calls'], 0)
+        self.assertEqual(report['undelivered_events'], 0)
+        self.assertEqual(report['deliveries'], report['events'] + report['failed_deliveries'])
+        self.assertLessEqual(report['latency_p50_ms'], report['latency_p99_ms'])
+        self.assertLessEqual(report['peak_instances'], 16)
+        self.assertGreaterEqual(report['instance_seconds'], round(report['deliveries'] * 0.1, 1))
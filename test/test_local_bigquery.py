@@ -0,0 +1,132 @@
+from datetime import date
+from unittest import TestCase
+from google.api_core.exceptions import BadRequest, Conflict
+from google.cloud import bigquery
+from test.local_bigquery import LocalClient
+
+EVENT_SCHEMA = [
+    bigquery.SchemaField('event_date', 'STRING'),
+    bigquery.SchemaField('user_pseudo_id', 'STRING'),
+    bigquery.SchemaField('event_params', 'RECORD', mode='REPEATED', fields=[
+        bigquery.SchemaField('key', 'STRING'),
+        bigquery.SchemaField('value', 'RECORD', fields=[bigquery.SchemaField('string_value', 'STRING')]),
+    ]),
+]
+
+
+def event(event_date, ga_id, **params):
+    return {
+        'event_date': event_date,
+        'user_pseudo_id': ga_id,
+        'event_params': [{'key': key, 'value': {'string_value': value}} for key, value in params.items()]
+    }
+
+
+class TestLocalBigQuery(TestCase):
+    def setUp(self):
+        self.client = LocalClient(project='nzaa-mkt-guid')
+        self.client.create_dataset('test_identity_resolution')
+        for table_id, rows in [
+            ('events_20250606', [event('20250606', 'ga_1', guid_email='a', guid_fb_id='fb_1')]),
+            ('events_20250607', [event('20250607', 'ga_2', guid_email='a'), event('20250607', 'ga_3')]),
+            ('events_intraday_20250608', [event('20250608', 'ga_4', guid_email='b')]),
+        ]:
+            table_ref = f'nzaa-mkt-guid.test_identity_resolution.{table_id}'
+            self.client.create_table(bigquery.Table(table_ref, EVENT_SCHEMA))
+            self.client.load_table_from_json(rows, table_ref).result()
+
+    def query(self, sql, parameters=None):
+        job_config = bigquery.QueryJobConfig(query_parameters=parameters or [])
+        return [dict(row.items()) for row in self.client.query(sql, job_config=job_config).result()]
+
+    def test_wildcard_table_suffix(self):
+        rows = self.query("""
+            SELECT _TABLE_SUFFIX AS suffix, COUNT(*) AS events
+            FROM `nzaa-mkt-guid.test_identity_resolution.events_*`
+            WHERE _TABLE_SUFFIX <= '99999999'
+            GROUP BY 1 ORDER BY 1
+        """)
+        self.assertEqual(rows, [{'suffix': '20250606', 'events': 1}, {'suffix': '20250607', 'events': 2}])
+
+    def test_unnest_repeated_records(self):
+        rows = self.query("""
+            SELECT
+              user_pseudo_id,
+              (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'guid_email') AS email,
+              param.key
+            FROM `nzaa-mkt-guid.test_identity_resolution.events_*` event
+            LEFT JOIN UNNEST(event.event_params) param
+            WHERE param.key IN UNNEST(['guid_fb_id']) OR param.key IS NULL
+            ORDER BY user_pseudo_id
+        """)
+        self.assertEqual(rows, [
+            {'user_pseudo_id': 'ga_1', 'email': 'a', 'key': 'guid_fb_id'},
+            {'user_pseudo_id': 'ga_3', 'email': None, 'key': None},
+        ])
+
+    def test_script_variables_and_parameters(self):
+        rows = self.query("""
+            DECLARE shards ARRAY<STRING>;
+            DECLARE first_shard, last_shard STRING;
+            DECLARE event_date STRING DEFAULT 'variable';
+            SET shards = (
+              SELECT ARRAY_AGG(DISTINCT _TABLE_SUFFIX ORDER BY _TABLE_SUFFIX)
+              FROM `nzaa-mkt-guid.test_identity_resolution.events_*`
+              WHERE _TABLE_SUFFIX >= @start_suffix
+            );
+            SET (first_shard, last_shard) = (SELECT AS STRUCT MIN(shard), MAX(shard) FROM UNNEST(shards) shard);
+            IF ARRAY_LENGTH(shards) > 1 THEN
+              -- the event_date column takes precedence over the variable
+              SELECT first_shard, last_shard, MAX(event_date) AS event_date
+              FROM `nzaa-mkt-guid.test_identity_resolution.events_*`;
+            END IF;
+        """, [
+            bigquery.ScalarQueryParameter('start_suffix', 'STRING', '20250607')
+        ])
+        self.assertEqual(rows, [{
+            'first_shard': '20250607', 'last_shard': 'intraday_20250608', 'event_date': '20250608'
+        }])
+
+    def test_procedure_exception_rolls_back(self):
+        self.client.create_table(bigquery.Table('nzaa-mkt-guid.test_identity_resolution.run_state', [
+            bigquery.SchemaField('shard_suffix', 'STRING'),
+            bigquery.SchemaField('processed', 'DATE'),
+        ]))
+        self.query("""
+            CREATE OR REPLACE PROCEDURE `nzaa-mkt-guid.test_identity_resolution.record`(suffix STRING)
+            BEGIN
+              BEGIN
+                BEGIN TRANSACTION;
+                INSERT INTO `nzaa-mkt-guid.test_identity_resolution.run_state`(shard_suffix, processed)
+                VALUES (suffix, PARSE_DATE("%Y%m%d", suffix));
+                COMMIT TRANSACTION;
+              EXCEPTION WHEN ERROR THEN
+                ROLLBACK TRANSACTION;
+                RAISE USING MESSAGE = FORMAT("failed for %s", suffix);
+              END;
+            END;
+        """)
+        self.query("CALL `nzaa-mkt-guid.test_identity_resolution.record`('20250606')")
+        with self.assertRaisesRegex(BadRequest, 'failed for not_a_date'):
+            self.query("CALL `nzaa-mkt-guid.test_identity_resolution.record`('not_a_date')")
+
+        rows = self.query("SELECT * FROM `nzaa-mkt-guid.test_identity_resolution.run_state`")
+        self.assertEqual(rows, [{'shard_suffix': '20250606', 'processed': date(2025, 6, 6)}])
+
+    def test_copy_table(self):
+        source = 'nzaa-mkt-guid.test_identity_resolution.events_20250607'
+        golden = 'nzaa-mkt-guid.test_identity_resolution.golden_events'
+        self.client.copy_table(source, golden).result()
+        self.client.copy_table(golden, source).result()
+        self.assertEqual(len(self.query(f"SELECT * FROM `{source}`")), 4)
+
+        truncate = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+        self.client.copy_table(golden, source, job_config=truncate).result()
+        rows = self.query(f"SELECT user_pseudo_id FROM `{source}` ORDER BY user_pseudo_id")
+        self.assertEqual(rows, [{'user_pseudo_id': 'ga_2'}, {'user_pseudo_id': 'ga_3'}])
+
+    def test_duplicate_job_id(self):
+        self.client.query("SELECT 1", job_id='identity_match_20250606_0')
+        with self.assertRaises(Conflict):
+            self.client.query("SELECT 1", job_id='identity_match_20250606_0')
+        self.assertEqual(self.client.get_job('identity_match_20250606_0').state, 'DONE')
@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+from unittest import TestCase
+from test.scan_baseline_identity_match import compare_scans, load_baseline, referenced_tables, run_gate
+
+
+class TestScanBaselineIdentityMatch(TestCase):
+    def test_referenced_tables(self):
+        child = SimpleNamespace(
+            statement_type='INSERT',
+            query='INSERT INTO "p"."d"."identity_match_history"(hashed_email) '
+                  'SELECT hashed_email FROM "p"."d"."identity_match" JOIN `p.other.identity_match` USING (ga_id)'
+        )
+
+        # the INSERT's target and other datasets' tables are not reads of the dataset
+        self.assertEqual(referenced_tables(child, 'd'), {'identity_match'})
+
+    def test_compare_scans(self):
+        baseline = {
+            'create identity_events': {'tables': ['events_20250607'], 'estimate': 1000},
+            'merge identity_match': {'tables': ['identity_match'], 'estimate': 500},
+        }
+        scans = {
+            'create identity_events': {'tables': ['events_20250601', 'events_20250607'], 'estimate': 7000},
+            'merge identity_match': {'tables': ['identity_match'], 'estimate': 540},
+            'merge identity_cluster': {'tables': ['identity_cluster'], 'estimate': 10},
+        }
+
+        self.assertEqual(compare_scans(scans, baseline), [
+            'create identity_events: now reads events_20250601',
+            'create identity_events: estimate 7000 exceeds baseline 1000 by more than 10%',
+            'merge identity_cluster: new stage reading identity_cluster',
+        ])
+        self.assertEqual(compare_scans(scans, baseline | {'merge identity_cluster': scans['merge identity_cluster']},
+                                       tolerance=6), ['create identity_events: now reads events_20250601'])
+
+    def test_local_scans_match_baseline(self):
+        scans = run_gate(backend='local')
+
+        self.assertEqual(scans['create identity_events']['tables'], ['events_*'])
+        self.assertEqual(compare_scans(scans, load_baseline()['local']), [])